@@ -6,11 +6,16 @@ import filelock # pip3 install filelock
 import traceback
 import argparse
 import os
+import signal
+import threading
 
 import pool
 import luks
 import common
 import disks
+import tracing
+import metrics
+import commands
 
 import backup_functions
 import scrub_functions
@@ -25,8 +30,6 @@ import initialize_functions
 # again later. To find the latest snapshot that is actually on a given backup-
 # pool one always has to check the snapshots on the backup-pool itself.
 
-# TODO: Add signal handler to clean correctly at Ctrl-C.
-
 # TODO: Add S.M.A.R.T. test as part of scrub
 
 # TODO: Implement create_added_removed_renamed_datasets_diff by saving a list
@@ -34,6 +37,27 @@ import initialize_functions
 
 approve_function = None
 
+# signal number of the first SIGINT or SIGTERM, None if not interrupted
+cancel_signal = None
+
+def stop_commands():
+    print("Interrupted, stopping running commands", flush=True)
+    commands.cancel_all()
+
+# The commands run in their own process groups and do not get the Ctrl-C of
+# the terminal, they are stopped here. The steps that were running then fail,
+# the run finishes normally (the disks are exported and closed) and exits
+# with 128 + the signal number. A second signal exits at once.
+def cancel(signum, frame):
+    global cancel_signal
+    
+    if cancel_signal != None:
+        os._exit(128 + signum)
+    cancel_signal = signum
+    
+    # killing the commands waits for them, not in the signal handler
+    threading.Thread(target=stop_commands, daemon=True).start()
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     init_group = parser.add_argument_group("initialize", "options for initializing new backup disk")
@@ -58,6 +82,9 @@ if __name__ == "__main__":
     scrub_group.add_argument(   "-s", "--scrub",                help="Perform scrub.", dest="operations", action="append_const", const="scrub")
     
     args=parser.parse_args()
+    
+    signal.signal(signal.SIGINT, cancel)
+    signal.signal(signal.SIGTERM, cancel)
 
     # settings
     common.read_settings(args.config_file)
@@ -132,6 +159,7 @@ if __name__ == "__main__":
             # perform operation(s)
             error_disks = list()
             error = False
+            tracing.start_run("backup.py " + " ".join(sys.argv[1:]))
 
             try:
                 lock = filelock.FileLock(os.path.realpath(__file__) + ".lock", timeout=0)
@@ -161,20 +189,25 @@ if __name__ == "__main__":
                     
                     # perform operation(s) on present and selected disks
                     if "import" in operations:
-                        print("Importing pool(s)")
-                        for disk in present_and_selected_disks:
-                            common.open_luks_and_import_pool(disk, 1)
+                        print("Importing pool(s)", flush=True)
+                        with tracing.span("import"):
+                            error_disks.extend(common.open_luks_and_import_pools(present_and_selected_disks, 1))
                         
                     if "export" in operations:
-                        print("Exporting pool(s)")
-                        for disk in present_and_selected_disks:
-                            common.export_pool_and_close_luks(disk, 1)
+                        print("Exporting pool(s)", flush=True)
+                        with tracing.span("export"):
+                            error_disks.extend(common.export_pools_and_close_luks(present_and_selected_disks, 1))
                             
                     if "destroy" in operations:
-                        destroy_functions.destroy_operation(present_and_selected_disks)
+                        with tracing.span("destroy"):
+                            destroy_functions.destroy_operation(present_and_selected_disks)
                         
                     if "backup" in operations:
-                        error_disks = backup_functions.backup_disks(pool_to_backup, present_and_selected_disks, True if "scrub" in operations else False, approve_function)
+                        with tracing.span("backup") as backup_span:
+                            error_disks_backup = backup_functions.backup_disks(pool_to_backup, present_and_selected_disks, True if "scrub" in operations else False, approve_function)
+                            if len(error_disks_backup) > 0:
+                                backup_span.failed()
+                        error_disks.extend([disk for disk in error_disks_backup if disk not in error_disks])
                                         
                     if "scrub" in operations:
                         for disk in error_disks:
@@ -183,13 +216,32 @@ if __name__ == "__main__":
                         scrub_disks = [disk for disk in present_and_selected_disks if disk not in error_disks]
                         
                         if len(scrub_disks) > 0:
-                            error_disks_scrub = scrub_functions.scrub_disks(scrub_disks)
-                            error_disks.append(error_disks_scrub)
+                            with tracing.span("scrub") as scrub_span:
+                                error_disks_scrub = scrub_functions.scrub_disks(scrub_disks)
+                                if len(error_disks_scrub) > 0:
+                                    scrub_span.failed()
+                            error_disks.extend(error_disks_scrub)
                         
             except filelock.Timeout as t:
                 print("Another instance of this script is currently running backup or scrub. Exiting.")
                 error = True
+            except Exception:
+                # a step that failed because its commands were stopped
+                if cancel_signal == None:
+                    raise
+                traceback.print_exc()
+                error = True
+            
+            metrics.save()
+            trace_summary = tracing.end_run(failed=len(error_disks) > 0 or error)
+            if trace_summary != None:
+                print(trace_summary, flush=True)
+                command_summary = commands.summary()
+                if command_summary != None:
+                    print(command_summary, flush=True)
         
+            if cancel_signal != None:
+                sys.exit(128 + cancel_signal)
             sys.exit(1 if len(error_disks) > 0 or error else 0)
         
     sys.exit(0)
@@ -7,95 +7,313 @@ import imaplib
 import traceback
 import datetime
 import time
+import tempfile
+import gzip
+import base64
+import threading
+import shutil
+import sys
+import queue
+import itertools
 
 import common
+import commands
 import pool
+import relay
+import zfsbackend
+import diffcache
+import diffrules
+import tracing
 
 date_regex = '([0-9]{4}-[0-9]{2}-[0-9]{2})(_([0-9]+))?'
 
+# A snapshot shared by several backup pools (see fan-out) is named
+# pool1:pool2_<date>_<number>
+snapshot_pool_separator = ':'
+
+# User property on the snapshot on pool_to_backup listing the backup pools
+# that no longer need a shared snapshot
+released_property = "zfs-offline-backup:released"
+
+# serializes the read-modify-write of released_property, groups of disks that
+# are backed up in parallel can release the same snapshot
+released_lock = threading.Lock()
+
+# characters of a diff kept in memory before it is written to a temporary file
+diff_spool_size = 1024*1024
+
 def backup_disks(pool_to_backup, disks, scrub, approve_function):
     settings = common.get_settings()
+    
+    # number of disks (or groups of disks when using fan-out) to back up at the same time
+    parallel_disks = settings["parallel-disks"] if "parallel-disks" in settings.keys() else 1
+    
+    # With fan-out, disks that have the same latest snapshot get one shared
+    # snapshot that is sent once and received by all of them
+    fan_out = settings["fan-out"] if "fan-out" in settings.keys() else False
+    
+    if "send-buffer" in settings.keys() and not ("send-relay" in settings.keys() and settings["send-relay"]):
+        print("Warning! \"send-buffer\" is only used with \"send-relay\": true (and for fan-out to several disks)", flush=True)
+    
     error_disks = list()
-    for disk in disks:
-        delete_created_snapshot = False
-        backup_made = False
+    
+    if fan_out:
+        groups, error_disks = group_disks_by_baseline(pool_to_backup, disks)
+    else:
+        groups = [([disk], None) for disk in disks]
+    
+    if len(groups) == 0:
+        return error_disks
+    
+    # Create a snapshot with a temporary name for each group first. A
+    # snapshot shall get it's final name only after it has been approved. The
+    # snapshots are created at the same time, so one approval of the diff
+    # covers all of them.
+    print("Creating temporary snapshot(s)", flush=True)
+    temp_snapshots = ["TEMP_SNAPSHOT_" + snapshot_pool_separator.join([disk["zpool"] for disk in group[0]]) for group in groups]
+    with tracing.span("snapshot-create") as snapshot_span:
+        # a group whose old temporary snapshot can not be removed is skipped
+        prepared = list()
+        for group,temp_snapshot in zip(groups, temp_snapshots):
+            try:
+                if snapshot_exists(pool_to_backup, temp_snapshot):
+                    delete_snapshot(pool_to_backup, temp_snapshot)
+                prepared.append((group, temp_snapshot))
+            except Exception as e:
+                traceback.print_exc()
+                print("  Backup aborted for " + ", ".join([disk["zpool"] for disk in group[0]]) + ": could not delete old snapshot " + temp_snapshot, flush=True)
+                error_disks += group[0]
+                snapshot_span.failed(e)
+        
+        # all snapshots are created together (atomically) or not at all
         try:
-            print("Performing backup from \"" + pool_to_backup + "\" to \"" + disk["zpool"] + "\"")
-            
-            # Create a snapshot with a temporary name first. A snapshot shall
-            # get it's final name only after it has been approved.
-            print("  Creating temporary snapshot: ", end="", flush=True)
-            temp_snapshot_name = "TEMP_SNAPSHOT_" + disk["zpool"]
-            if snapshot_exists(pool_to_backup, temp_snapshot_name):
-                delete_snapshot(pool_to_backup, temp_snapshot_name)
-            created_snapshot = create_snapshot(pool_to_backup, temp_snapshot_name)
-            print(created_snapshot)
-            delete_created_snapshot = True
-            
-            # import the pool
-            common.open_luks_and_import_pool(disk, 1)
+            if len(prepared) > 0:
+                create_snapshots(pool_to_backup, [temp_snapshot for group,temp_snapshot in prepared])
+                print("  " + ", ".join([temp_snapshot for group,temp_snapshot in prepared]), flush=True)
+        except Exception as e:
+            traceback.print_exc()
+            print("  Backup aborted for " + ", ".join([disk["zpool"] for group,temp_snapshot in prepared for disk in group[0]]) + ": could not create snapshots", flush=True)
+            error_disks += [disk for group,temp_snapshot in prepared for disk in group[0]]
+            snapshot_span.failed(e)
+            prepared = list()
+    
+    if len(prepared) == 0:
+        return [disk for disk in disks if disk in error_disks]
+    
+    groups = [group for group,temp_snapshot in prepared]
+    temp_snapshots = [temp_snapshot for group,temp_snapshot in prepared]
+    
+    # the approval is waited for in the background while the disks are prepared
+    approval = ApprovalRequest(pool_to_backup, [disk for group in groups for disk in group[0]], temp_snapshots[0], approve_function)
+    approval.start()
+    
+    group_error_disks = common.run_in_parallel(lambda index: backup_disk_group(pool_to_backup, groups[index][0], scrub, approval, temp_snapshots[index], groups[index][1], fan_out), list(range(len(groups))), parallel_disks)
+    
+    for group_errors in group_error_disks:
+        error_disks += group_errors
+    
+    # delete the temporary snapshots that have not been approved and renamed
+    for temp_snapshot in temp_snapshots:
+        try:
+            if snapshot_exists(pool_to_backup, temp_snapshot):
+                print("Deleting new snapshot: " + temp_snapshot, flush=True)
+                delete_snapshot(pool_to_backup, temp_snapshot)
+        except Exception as e:
+            traceback.print_exc()
+    
+    # keep the order of the disks
+    error_disks = [disk for disk in disks if disk in error_disks]
+    
+    return error_disks
+
+# returns a list of (disks, latest snapshot on these disks) and a list of the
+# disks where the latest snapshot could not be found. Disks in a group also
+# have the same send options since they share the send stream.
+def group_disks_by_baseline(pool_to_backup, disks):
+    print("Finding latest backup snapshot on the disk(s)", flush=True)
+    
+    groups = list()
+    error_disks = list()
+    
+    # returns (found, latest snapshot)
+    def find(disk):
+        try:
+            print("  " + disk["zpool"] + ":", flush=True)
+            return (True, find_latest_snapshot_on_disk(disk, 2))
+        except Exception as e:
+            traceback.print_exc()
+            print("  Backup aborted for " + disk["zpool"], flush=True)
             
-            print("  Finding latest backup snapshot on this disk: ", end="", flush=True)
-            latest_snapshot_this_disk = find_latest_snapshot(disk["zpool"],disk["zpool"])
-            if latest_snapshot_this_disk != None:
-                print(latest_snapshot_this_disk)
-            else:
-                print("none found")
+            try:
+                common.export_pool_and_close_luks(disk, 2)
+            except Exception as e:
+                print("  Could not export and close disk", flush=True)
+                traceback.print_exc()
                 
-            # export pool again. it may take hours to get approval
-            common.export_pool_and_close_luks(disk, 1)
+            return (False, None)
+    
+    # the disks are opened and closed several at a time
+    results = common.run_in_parallel(find, disks, common.get_parallel_bring_up())
+    
+    for disk,(found,latest_snapshot) in zip(disks, results):
+        if not found:
+            error_disks.append(disk)
+            continue
+        
+        for group in groups:
+            if group[1] == latest_snapshot and send_flags(group[0][0]) == send_flags(disk):
+                group[0].append(disk)
+                break
+        else:
+            groups.append(([disk], latest_snapshot))
             
-            print("  Finding latest approved snapshot: ", end="", flush=True)
-            latest_approved_snapshot = find_latest_snapshot(pool_to_backup,[disk["zpool"] for disk in settings["backup-disks"]])
-            if latest_approved_snapshot != None:
-                print(latest_approved_snapshot)
-            else:
-                raise Exception
+    return groups, error_disks
+
+def find_latest_snapshot_on_disk(disk, print_depth):
+    # import the pool
+    common.open_luks_and_import_pool(disk, print_depth)
+    
+    print("  "*print_depth + "Finding latest backup snapshot on this disk: ", end="", flush=True)
+    with tracing.span("find-latest-snapshot", disk=disk["zpool"]):
+        latest_snapshot = find_latest_snapshot(disk["zpool"],disk["zpool"])
+    if latest_snapshot != None:
+        print(latest_snapshot)
+    else:
+        print("none found")
+        
+    # export pool again. it may take hours to get approval
+    common.export_pool_and_close_luks(disk, print_depth)
+    
+    return latest_snapshot
+
+# Backs up a group of disks that all have the same latest snapshot, or a
+# single disk. If latest_snapshot_known is False the latest snapshot is looked
+# up on the disk, which is only possible for a single disk. created_snapshot
+# is the temporary snapshot for the group, it is renamed when the approval has
+# been received and is otherwise left to the caller to delete.
+# Returns a list of the disks where the backup failed.
+def backup_disk_group(pool_to_backup, disks, scrub, approval, created_snapshot, latest_snapshot=None, latest_snapshot_known=False):
+    settings = common.get_settings()
+    backup_pools = [disk["zpool"] for disk in disks]
+    error_disks = list()
+    backed_up_disks = list()
+    receiving_disks = list()
+    latest_snapshot_this_disk = latest_snapshot
+    disk_span = tracing.start_span("disk", disk=",".join(backup_pools))
+    try:
+        print("Performing backup from \"" + pool_to_backup + "\" to \"" + "\", \"".join(backup_pools) + "\"")
+        
+        if not latest_snapshot_known:
+            latest_snapshot_this_disk = find_latest_snapshot_on_disk(disks[0], 1)
+        
+        print("  Waiting for approval", flush=True)
+        with tracing.span("approval-wait") as wait_span:
+            ok_to_continue = approval.wait()
+            if not ok_to_continue:
+                wait_span.outcome = "denied"
+        
+        if not ok_to_continue:
+            print("  Omitting backup", flush=True)
+            error_disks = list(disks)
+        else:
+            print("  Continuing")
             
-            # create diff between new snapshot and last approved
-            # request approval if there are differences
-            # if no differences or approval received, continue
-            ok_to_continue = check_for_diff_and_get_approval(pool_to_backup, disk, latest_approved_snapshot, created_snapshot, approve_function)
+            # find the final name for the snapshot
+            print("    Finding next snapshot name: ", end="", flush=True)
+            next_snapshot_name = find_next_snapshot_name(pool_to_backup, backup_pools)
+            print(next_snapshot_name)
             
-            if not ok_to_continue:
-                print("  Omitting backup", flush=True)
-                error_disks.append(disk)
-            else:
-                print("  Continuing")
-                
-                # find the final name for the snapshot
-                print("    Finding next snapshot name: ", end="", flush=True)
-                next_snapshot_name = find_next_snapshot_name(pool_to_backup, disk["zpool"])
-                print(next_snapshot_name)
-                
-                # Rename the snapshot. Note that if something fails now we shall not remove this snapshot
-                # because it is the new baseline for what has been approved.
-                print("    Renaming snapshot " + created_snapshot + " to: ", end="", flush=True)                            
+            # Rename the snapshot. Note that if something fails now we shall not remove this snapshot
+            # because it is the new baseline for what has been approved.
+            print("    Renaming snapshot " + created_snapshot + " to: ", end="", flush=True)                            
+            with tracing.span("snapshot-rename"):
                 created_snapshot = rename_snapshot(pool_to_backup, created_snapshot, next_snapshot_name)
-                print(created_snapshot, flush=True)
-                delete_created_snapshot = False
-                                            
+            print(created_snapshot, flush=True)
+            
+            for disk in disks:
                 common.open_luks_and_import_pool(disk, 2)
+                receiving_disks.append(disk)
             
                 print("    Checking pool health: ", end="", flush=True)
                 healthy, msg = pool.pool_is_healthy(disk["zpool"])
                 print(msg, end="", flush=True) # output already contain newline
                 
                 if not healthy:
-                    raise Exception
+                    if len(disks) == 1:
+                        raise Exception
                     
-                if latest_snapshot_this_disk == None:
-                    print("    Performing first backup: ", end="", flush=True)
-                    backup_made,errormsg = perform_first_backup(pool_to_backup, disk["zpool"], created_snapshot)
-                else:
-                    print("    Performing incremental backup: ", end="", flush=True)
-                    backup_made,errormsg = perform_incremental_backup(pool_to_backup, disk["zpool"], latest_snapshot_this_disk, created_snapshot)
+                    error_disks.append(disk)
+                    receiving_disks.remove(disk)
+                    common.export_pool_and_close_luks(disk, 2)
+                    continue
+                
+                # finish receives that were interrupted in an earlier run
+                with tracing.span("resume-receives", disk=disk["zpool"]):
+                    resumed = resume_receives(pool_to_backup, disk["zpool"], 2)
+                
+                if resumed:
+                    print("    Finding latest backup snapshot on this disk: ", end="", flush=True)
+                    latest_snapshot_resumed = find_latest_snapshot(disk["zpool"],disk["zpool"])
+                    print(latest_snapshot_resumed if latest_snapshot_resumed != None else "none found", flush=True)
+                    
+                    if len(disks) == 1:
+                        latest_snapshot_this_disk = latest_snapshot_resumed
+                    elif latest_snapshot_resumed != latest_snapshot_this_disk:
+                        print("    The latest snapshot on " + disk["zpool"] + " changed when resuming, it will be backed up in the next run", flush=True)
+                        error_disks.append(disk)
+                        receiving_disks.remove(disk)
+                        common.export_pool_and_close_luks(disk, 2)
+            
+            # progress is reported on separate lines, the result is then printed on its own line
+            progress = "send-relay" in settings.keys() and settings["send-relay"] and "progress-interval" in settings.keys() and settings["progress-interval"]
+            
+            # the time from starting with the disk (opening, importing, ...) to sending
+            send_span = tracing.start_span("send-recv", incremental=latest_snapshot_this_disk != None, receivers=len(receiving_disks),
+                                           since_disk_start=round(time.time() - disk_span.start, 3))
+            try:
+                if len(receiving_disks) == 1:
+                    disk = receiving_disks[0]
+                    if latest_snapshot_this_disk == None:
+                        print("    Performing first backup:", end="\n" if progress else " ", flush=True)
+                        results = {disk["zpool"]: perform_first_backup(pool_to_backup, disk["zpool"], created_snapshot, send_flags(disk))}
+                    else:
+                        print("    Performing incremental backup:", end="\n" if progress else " ", flush=True)
+                        results = {disk["zpool"]: perform_incremental_backup(pool_to_backup, disk["zpool"], latest_snapshot_this_disk, created_snapshot, send_flags(disk))}
+                elif len(receiving_disks) > 1:
+                    if latest_snapshot_this_disk == None:
+                        print("    Performing first backup with a single send stream:", flush=True)
+                    else:
+                        print("    Performing incremental backup with a single send stream:", flush=True)
+                    results = perform_fan_out_backup(pool_to_backup, [disk["zpool"] for disk in receiving_disks], latest_snapshot_this_disk, created_snapshot, send_flags(receiving_disks[0]))
+                
+                if len(receiving_disks) > 0:
+                    # the stream is the same for all receivers
+                    backup_made,errormsg,stats = results[receiving_disks[0]["zpool"]]
+                    if stats != None:
+                        send_span.add_bytes(stats.bytes)
+                    if not all([results[disk["zpool"]][0] for disk in receiving_disks]):
+                        send_span.failed()
+            except Exception as e:
+                send_span.failed(e)
+                raise
+            finally:
+                tracing.end_span(send_span)
+            
+            print_pool_names = len(receiving_disks) > 1 or progress
+            
+            for disk in list(receiving_disks):
+                backup_made,errormsg,stats = results[disk["zpool"]]
+                
+                if print_pool_names:
+                    print("      " + disk["zpool"] + ": ", end="", flush=True)
                 
                 error = False
                 if backup_made:
-                    print("success")
+                    print("success" + (", " + str(stats) if stats != None else ""))
+                    backed_up_disks.append(disk)
                     
                     print("    Checking pool health: ", end="", flush=True)
+                    pool.invalidate_pool_states() # errors may have occurred during the receive
                     healthy, msg = pool.pool_is_healthy(disk["zpool"])
                     print(msg, end="", flush=True) # output already contain newline
             
@@ -110,55 +328,67 @@ def backup_disks(pool_to_backup, disks, scrub, approve_function):
             
                 # if we shall not scrub any disks or if the disk had an error, export and close now
                 if not scrub or error:
+                    receiving_disks.remove(disk)
                     common.export_pool_and_close_luks(disk, 1)
+    
+    except Exception as e:
+        traceback.print_exc()
+        print("  Backup aborted for \"" + "\", \"".join(backup_pools) + "\"", flush=True)
+        error_disks = list(disks)
         
-        except Exception as e:
-            traceback.print_exc()
-            print("  Backup aborted for " + disk["zpool"], flush=True)
-            error_disks.append(disk)
-            
+        for disk in disks:
             try:
                 common.export_pool_and_close_luks(disk, 1)
             except Exception as e:
                 print("  Could not export and close disk", flush=True)
                 traceback.print_exc()
-        
-        # delete old snapshots
-        if backup_made and latest_snapshot_this_disk != None:
-            all_snapshots_this_disk = find_all_snapshots(pool_to_backup, disk["zpool"])
-            for snapshot in all_snapshots_this_disk:
-                if snapshot != created_snapshot:
-                    print("  Deleting old snapshot: " + snapshot, flush=True)
-                    delete_snapshot(pool_to_backup, snapshot)
-            
-        # delete temporary snapshot, only if it has not been approved and renamed
-        if delete_created_snapshot:
-            print("  Deleting new snapshot: " + created_snapshot, flush=True)
-            delete_snapshot(pool_to_backup, created_snapshot)
+    
+    # delete old snapshots
+    if latest_snapshot_this_disk != None and len(backed_up_disks) > 0:
+        with tracing.span("prune"):
+            for disk in backed_up_disks:
+                all_snapshots_this_disk = find_all_snapshots(pool_to_backup, disk["zpool"])
+                for snapshot in all_snapshots_this_disk:
+                    if snapshot != created_snapshot:
+                        if release_snapshot(pool_to_backup, snapshot, disk["zpool"]):
+                            print("  Deleted old snapshot: " + snapshot, flush=True)
+                        else:
+                            print("  Released old snapshot: " + snapshot + " (still used by other disks)", flush=True)
+    
+    if len(error_disks) > 0:
+        disk_span.failed()
+    tracing.end_span(disk_span)
 
     return error_disks
 
 def create_snapshot(pool, snapshot_name):
-    # Create the snapshot    
-    cmd = "zfs snapshot -r " + pool + "@" + snapshot_name
-    cpinst = subprocess.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    
-    if cpinst.returncode != 0:
-        raise Exception("Error in \"" + cmd + "\":" + cpinst.stderr.decode("utf-8"))
+    return create_snapshots(pool, [snapshot_name])[0]
 
-    return snapshot_name
+# creates all snapshots at the same time, they have the same content
+def create_snapshots(pool, snapshot_names):
+    # Create the snapshots
+    zfsbackend.get_backend().create_snapshots(pool, snapshot_names)
+
+    for snapshot_name in snapshot_names:
+        get_snapshot_catalog(pool).add(snapshot_name)
+
+    return snapshot_names
         
-def find_next_snapshot_name(pool_to_backup, backup_pool):
-    basename = backup_pool + "_" + datetime.datetime.now().strftime("%Y-%m-%d")
+def find_next_snapshot_name(pool_to_backup, backup_pools):
+    # if only a single pool passed, make a list of it
+    if type(backup_pools) == str:
+        backup_pools = [backup_pools]
+    
+    basename = snapshot_pool_separator.join(backup_pools) + "_" + datetime.datetime.now().strftime("%Y-%m-%d")
     
     currentdate = datetime.date.today()
     
-    latest_snapshot = find_latest_snapshot(pool_to_backup, backup_pool)
+    latest_snapshot = find_latest_snapshot(pool_to_backup, backup_pools)
     
-    global date_regex
+    if latest_snapshot != None:
+        pools, latest_snapshot_date, latest_snapshot_number = parse_snapshot_name(latest_snapshot)
     
-    if latest_snapshot != None and re.search(date_regex, latest_snapshot)[1] == currentdate.isoformat():
-        latest_snapshot_number = int(re.search(date_regex, latest_snapshot)[3]) if re.search(date_regex, latest_snapshot)[3] != None else 0
+    if latest_snapshot != None and latest_snapshot_date == currentdate.isoformat():
         snapshot_name = basename + "_" + str(latest_snapshot_number + 1)
     else:
         snapshot_name = basename + "_1"
@@ -167,80 +397,166 @@ def find_next_snapshot_name(pool_to_backup, backup_pool):
 
 def rename_snapshot(pool, old_snapshot_name, new_snapshot_name):
     # Rename the snapshot    
-    cmd = "zfs rename -r " + pool + "@" + old_snapshot_name + " @" + new_snapshot_name
-    cpinst = subprocess.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    zfsbackend.get_backend().rename_snapshot(pool, old_snapshot_name, new_snapshot_name)
+    
+    get_snapshot_catalog(pool).rename(old_snapshot_name, new_snapshot_name)
     
-    if cpinst.returncode != 0:
-        raise Exception("Error in \"" + cmd + "\":" + cpinst.stderr.decode("utf-8"))
-        
     return new_snapshot_name
 
 def delete_snapshot(pool, snapshot):
-    cmd = "zfs destroy -r " + pool + "@" + snapshot
-    cpinst = subprocess.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    zfsbackend.get_backend().destroy_snapshot(pool, snapshot)
     
-    if cpinst.returncode != 0:
-        raise Exception("Error in \"" + cmd + "\":" + cpinst.stderr.decode("utf-8"))
+    get_snapshot_catalog(pool).remove(snapshot)
 
-# returns a list sorted by creationtime (latest snapshot last)
-def snapshot_exists(pool, snapshot):
-    # -H: without headers and with single tab between columns
-    # -r: recursive
-    # -d 1: depth 1 (only specified dataset)
-    # -t snapshot: only list snapshots
-    # -o name: only list name
-    # -s creation: sort by creation time
-    cmd = "zfs list -H -r -d 1 -t snapshot -o name " + pool
-    cpinst = subprocess.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    
-    if cpinst.returncode != 0:
-        raise Exception("Error in \"" + cmd + "\":\n" + cpinst.stderr.decode("utf-8"))
-    
-    stdout = cpinst.stdout.decode("utf-8")
+# Called when backup_pool no longer needs the snapshot. The snapshot is deleted
+# when no other backup pool in the config needs it. Returns True if deleted.
+def release_snapshot(pool, snapshot, backup_pool):
+    settings = common.get_settings()
+    config_pools = [disk["zpool"] for disk in settings["backup-disks"]]
     
-    snapshots = list()
+    if snapshot_backup_pools(snapshot) == [backup_pool]:
+        delete_snapshot(pool, snapshot)
+        return True
     
-    for line in stdout.splitlines():
-        words = line.split('@')
-        if words[1].strip() == snapshot:
+    with released_lock:
+        released_pools = get_snapshot_property(pool, snapshot, released_property)
+        released_pools = released_pools.split(',') if released_pools != '-' else list()
+        if backup_pool not in released_pools:
+            released_pools.append(backup_pool)
+        
+        still_used_by = [p for p in snapshot_backup_pools(snapshot) if p not in released_pools and p in config_pools]
+        
+        if len(still_used_by) == 0:
+            delete_snapshot(pool, snapshot)
             return True
-                
-    return False
-
-# returns a list sorted by creationtime (latest snapshot last)
-def find_all_snapshots(pool, backup_pools):
-    # if only a single disk dict passed, make a list of it
-    if type(backup_pools) == str:
-        new_list = list()
-        new_list.append(backup_pools)
-        backup_pools = new_list
+        else:
+            set_snapshot_property(pool, snapshot, released_property, ','.join(released_pools))
+            return False
 
-    # -H: without headers and with single tab between columns
-    # -r: recursive
-    # -d 1: depth 1 (only specified dataset)
-    # -t snapshot: only list snapshots
-    # -o name: only list name
-    # -s creation: sort by creation time
-    cmd = "zfs list -H -r -d 1 -t snapshot -o name -s creation " + pool
-    cpinst = subprocess.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+def get_snapshot_property(pool, snapshot, property_name):
+    name,property_name,value = zfsbackend.get_backend().get(pool + "@" + snapshot, [property_name])[0]
     
-    if cpinst.returncode != 0:
-        raise Exception("Error in \"" + cmd + "\":\n" + cpinst.stderr.decode("utf-8"))
+    return value
+
+def set_snapshot_property(pool, snapshot, property_name, value):
+    zfsbackend.get_backend().set(pool + "@" + snapshot, property_name, value)
+
+# returns (backup pools, date, number) for a backup snapshot or None if it is
+# not a backup snapshot
+def parse_snapshot_name(snapshot):
+    # group 1 will contain the pool(s), group 2 the date and group 4 the number (if any)
+    match = re.fullmatch('(.+?)_' + date_regex, snapshot)
     
-    stdout = cpinst.stdout.decode("utf-8")
+    if match != None:
+        return (match[1].split(snapshot_pool_separator), match[2], int(match[4]) if match[4] != None else 0)
+    else:
+        return None
+
+# returns the backup pools a snapshot was made for, or an empty list if it is
+# not a backup snapshot
+def snapshot_backup_pools(snapshot):
+    parsed = parse_snapshot_name(snapshot)
     
-    # group 1 will contain the date and group 3 the number (if any)
-    global date_regex
+    if parsed != None:
+        return parsed[0]
+    else:
+        return list()
+
+# The snapshots of a pool are listed once per run and then kept up to date by
+# create_snapshot, rename_snapshot and delete_snapshot. Backup snapshots are
+# indexed by backup pool.
+class SnapshotCatalog:
+    def __init__(self, pool):
+        self.pool = pool
+        self.lock = threading.Lock()
+        self.snapshots = None   # dict of snapshot: creation order
+        self.backup_snapshots = None    # dict of backup pool: list of snapshots sorted by creation
+        self.next_order = 0
+        
+    def load(self):
+        if self.snapshots != None:
+            return
+        
+        # depth 1: only the snapshots of the specified dataset, sorted by creation time
+        rows = zfsbackend.get_backend().list(self.pool, "snapshot", ["name"], depth=1, sort="creation")
+        
+        self.snapshots = dict()
+        self.backup_snapshots = dict()
+        
+        for name, in rows:
+            self.insert(name.split('@')[1])
     
-    snapshots = list()
+    def insert(self, snapshot):
+        self.snapshots[snapshot] = self.next_order
+        self.next_order += 1
+        
+        for backup_pool in snapshot_backup_pools(snapshot):
+            self.backup_snapshots.setdefault(backup_pool, list()).append(snapshot)
+        
+    def contains(self, snapshot):
+        with self.lock:
+            self.load()
+            return snapshot in self.snapshots
     
-    for line in stdout.splitlines():
-        words = line.split('@')
-        for backup_pool in backup_pools:
-            if re.fullmatch(backup_pool + '_' + date_regex, words[1]) != None:
-                snapshots.append(words[1])
+    def find(self, backup_pools):
+        with self.lock:
+            self.load()
+            snapshots = set()
+            for backup_pool in backup_pools:
+                snapshots.update(self.backup_snapshots.get(backup_pool, list()))
+            return sorted(snapshots, key=lambda snapshot: self.snapshots[snapshot])
+        
+    def add(self, snapshot):
+        with self.lock:
+            if self.snapshots != None:
+                self.insert(snapshot)
+            
+    def remove(self, snapshot):
+        with self.lock:
+            if self.snapshots != None and snapshot in self.snapshots:
+                del self.snapshots[snapshot]
+                for backup_pool in snapshot_backup_pools(snapshot):
+                    self.backup_snapshots[backup_pool].remove(snapshot)
+                    
+    def rename(self, old_snapshot, new_snapshot):
+        with self.lock:
+            if self.snapshots != None and old_snapshot in self.snapshots:
+                order = self.snapshots.pop(old_snapshot)
+                for backup_pool in snapshot_backup_pools(old_snapshot):
+                    self.backup_snapshots[backup_pool].remove(old_snapshot)
                 
-    return snapshots
+                # keep the creation order
+                self.snapshots[new_snapshot] = order
+                for backup_pool in snapshot_backup_pools(new_snapshot):
+                    snapshots = self.backup_snapshots.setdefault(backup_pool, list())
+                    snapshots.append(new_snapshot)
+                    snapshots.sort(key=lambda snapshot: self.snapshots[snapshot])
+
+snapshot_catalogs = dict()
+snapshot_catalogs_lock = threading.Lock()
+
+def get_snapshot_catalog(pool):
+    with snapshot_catalogs_lock:
+        if pool not in snapshot_catalogs:
+            snapshot_catalogs[pool] = SnapshotCatalog(pool)
+        return snapshot_catalogs[pool]
+
+# must be called when snapshots have been changed in other ways than by
+# create_snapshot, rename_snapshot and delete_snapshot, for example by zfs recv
+def invalidate_snapshot_catalog(pool):
+    with snapshot_catalogs_lock:
+        snapshot_catalogs.pop(pool, None)
+
+def snapshot_exists(pool, snapshot):
+    return get_snapshot_catalog(pool).contains(snapshot)
+
+# returns a list sorted by creationtime (latest snapshot last)
+def find_all_snapshots(pool, backup_pools):
+    # if only a single pool passed, make a list of it
+    if type(backup_pools) == str:
+        backup_pools = [backup_pools]
+    
+    return get_snapshot_catalog(pool).find(backup_pools)
 
 def find_latest_snapshot(pool, backup_pools):
     snapshots = find_all_snapshots(pool, backup_pools) # returns a list already sorted by creationtime
@@ -261,10 +577,12 @@ def create_added_removed_renamed_datasets_diff(pool, old_datasets):
 
     return diff_dict
     
-# return a dict of dataset,diff-text
+# Returns a file with the diff text of all datasets, positioned at its end.
+# The file is empty if nothing has changed.
 def create_diff(pool, prev_snapshot, new_snapshot, old_datasets=None):
+    settings = common.get_settings()
     datasets_on_pool = get_datasets(pool)
-    diff_dict = dict()
+    diff_file = new_diff_file()
     added_datasets = list() # needs to be visible later during normal diff
     
     # create diffs of added/removed/renamed datasets if we get a list of old ones
@@ -277,104 +595,327 @@ def create_diff(pool, prev_snapshot, new_snapshot, old_datasets=None):
         removed_datasets = datasets_diff_dict["removed"]
         renamed_datasets = datasets_diff_dict["renamed"]
         
-        diff = str()
+        diff = new_diff_file()
         
         # handle added_datasets
         for dataset in added_datasets:
-            diff = diff + '+\t' + dataset + '\n'
+            diff.write('+\t' + dataset + '\n')
 
         # handle removed_datasets
         for dataset in removed_datasets:
-            diff = diff + '-\t' + dataset + '\n'
+            diff.write('-\t' + dataset + '\n')
 
         # handle renamed_datasets
         for rename_diff in renamed_datasets:
-            diff = diff + 'R\t' + rename_diff["old-name"] + " -> " + rename_diff["new-name"] + '\n'
+            diff.write('R\t' + rename_diff["old-name"] + " -> " + rename_diff["new-name"] + '\n')
 
-        diff_dict[datasets_diff_name] = diff
+        append_diff(diff_file, datasets_diff_name, diff)
         
-    # create diffs for all datasets
-    for dataset in datasets_on_pool:
-        # check that dataset existed in last snapshot
-        cmd = "zfs list -H " + dataset + "@" + prev_snapshot
-        cpinst = subprocess.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    # number of datasets to diff at the same time
+    parallel_diffs = settings["parallel-diffs"] if "parallel-diffs" in settings.keys() else 1
+    
+    # bytes written in each dataset between the snapshots, datasets where
+    # nothing has been written are not diffed
+    written = get_written(pool, prev_snapshot, new_snapshot)
+    
+    # diffs of datasets that have not changed since an earlier run are taken from the cache
+    cache = diffcache.get_diff_cache()
+    cache_keys = get_diff_cache_keys(pool, prev_snapshot, new_snapshot) if cache != None else dict()
+    
+    # The diff of each dataset is appended to diff_file and closed as soon as
+    # the datasets before it are done, so that only the diffs finished out of
+    # order are open at the same time
+    finished = dict()   # index in datasets_on_pool: diff
+    next_index = 0
+    finished_lock = threading.Lock()
+    
+    def diff_dataset(index):
+        nonlocal next_index
+        dataset = datasets_on_pool[index]
+        diff = create_dataset_diff(dataset, prev_snapshot, new_snapshot, added_datasets, old_datasets, written.get(dataset), cache, cache_keys.get(dataset))
+        
+        with finished_lock:
+            finished[index] = diff
+            while next_index in finished.keys():
+                dataset = datasets_on_pool[next_index]
+                key = dataset + " (" + common.format_bytes(written[dataset]) + " written)" if dataset in written else dataset
+                append_diff(diff_file, key, finished.pop(next_index))
+                next_index += 1
+    
+    try:
+        common.run_in_parallel(diff_dataset, list(range(len(datasets_on_pool))), parallel_diffs)
+    except BaseException:
+        for diff in finished.values():
+            diff.close()
+        diff_file.close()
+        raise
+    
+    return diff_file
 
-        diff = str()
+# Appends the diff of a dataset with key as its heading to diff_file, if it
+# has any changes, and closes it
+def append_diff(diff_file, key, diff):
+    with diff:
+        if diff.tell() == 0:
+            return
+        
+        if diff_file.tell() > 0: # an extra newline before each new dataset
+            diff_file.write('\n')
+        
+        diff_file.write(key + '\n')
+        diff.seek(0)
+        shutil.copyfileobj(diff, diff_file)
+        diff_file.write('\n')
 
-        if cpinst.returncode == 1 and re.search("does not exist", cpinst.stderr.decode("utf-8")):
-            # previous snapshot did not exist in this dataset
-            # if the dataset has not been detected as added, print this info in the diff
-            if dataset not in added_datasets:
-                if old_datasets != None: # if we have performed a diff of dataset lists
-                    diff = "Warning: This dataset was not detected as added but did not have the previous snapshot."
-                else:
-                    diff = "Warning: This dataset did not have the previous snapshot. Is it a new dataset?"
-        elif cpinst.returncode != 0:
-            raise Exception("Error in \"" + cmd + "\":" + cpinst.stderr.decode("utf-8"))
-        else: # dataset existed in last snapshot, perform diff
-            cmd = "zfs diff -FHt " + dataset + "@" + prev_snapshot + " " + dataset + "@" + new_snapshot
-            cpinst = subprocess.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            
-            if cpinst.returncode != 0:
-                raise Exception("Error in \"" + cmd + "\":" + cpinst.stderr.decode("utf-8"))
-            
-            stdout = cpinst.stdout.decode("utf-8")
-            
-            for line in stdout.splitlines():
-                columns = line.split('\t')
-                
-                timestamp_str = columns[0]
-                timestamp = int(timestamp_str.split('.')[0])
-                dateandtime = str(datetime.datetime.fromtimestamp(timestamp))
-                difftype = columns[1]
-                filetype = columns[2]
-                filepath = columns[3]
-                
-                diff = diff + difftype + '\t' + filetype + '\t' + dateandtime + '\t' + filepath + '\n'
-                
-        if len(diff) > 0:
-            diff_dict[dataset] = diff
+# The diff of a dataset can be millions of lines. It is kept in memory only
+# up to diff_spool_size characters, beyond that it is written to a temporary
+# file.
+def new_diff_file():
+    return tempfile.SpooledTemporaryFile(max_size=diff_spool_size, mode='w+', encoding="utf-8")
+
+# returns a dict of dataset: bytes written between prev_snapshot and
+# new_snapshot. Datasets where this is not known, for example because they
+# don't have prev_snapshot, are not included.
+def get_written(pool, prev_snapshot, new_snapshot):
+    # snapshot: get written@prev_snapshot of the snapshots, not of the current data
+    values = zfsbackend.get_backend().get(pool, ["written@" + prev_snapshot], recursive=True, types="snapshot")
     
-    return diff_dict
+    written = dict()
+    
+    for name,property_name,value in values:
+        dataset,_,snapshot = name.partition('@')
+        
+        if snapshot == new_snapshot and value.isdigit():
+            written[dataset] = int(value)
+    
+    return written
 
-def create_diff_text(diff_dict):
-    diff_text = str()
-    first = True
-    for key in diff_dict:
-        if not first: # print an extra newline before each new dataset
-            diff_text += '\n'
+# returns a dict of dataset: (guid of prev_snapshot, guid of new_snapshot,
+# bytes referenced by new_snapshot) for the datasets that have both snapshots
+def get_diff_cache_keys(pool, prev_snapshot, new_snapshot):
+    rows = zfsbackend.get_backend().list(pool, "snapshot", ["name", "guid", "referenced"])
+    
+    prev_guids = dict()
+    new_snapshots = dict()
+    
+    for name,guid,referenced in rows:
+        dataset,_,snapshot = name.partition('@')
+        
+        if snapshot == prev_snapshot:
+            prev_guids[dataset] = guid
+        elif snapshot == new_snapshot:
+            new_snapshots[dataset] = (guid, int(referenced))
+    
+    return {dataset: (prev_guids[dataset],) + new_snapshots[dataset] for dataset in new_snapshots if dataset in prev_guids}
+
+# return the diff-file of a single dataset
+def create_dataset_diff(dataset, prev_snapshot, new_snapshot, added_datasets, old_datasets, written=None, cache=None, cache_key=None):
+    diff = new_diff_file()
+    
+    # nothing has been written since the previous snapshot
+    if written == 0:
+        return diff
+    
+    rules = diffrules.get_rules(dataset)
+    rules_signature = rules.signature if rules != None else str()
+    
+    use_cache = cache != None and cache_key != None and written != None
+    
+    if use_cache:
+        prev_guid,new_guid,referenced = cache_key
+        if cache.lookup(dataset, prev_guid, new_guid, written, referenced, rules_signature, diff):
+            return diff
+    
+    if written != None:
+        # written@prev_snapshot is only known if prev_snapshot exists
+        prev_snapshot_exists = True
+    else:
+        # check that dataset existed in last snapshot
+        prev_snapshot_exists = zfsbackend.get_backend().exists(dataset + "@" + prev_snapshot)
+
+    if not prev_snapshot_exists:
+        # previous snapshot did not exist in this dataset
+        # if the dataset has not been detected as added, print this info in the diff
+        if dataset not in added_datasets:
+            if old_datasets != None: # if we have performed a diff of dataset lists
+                diff.write("Warning: This dataset was not detected as added but did not have the previous snapshot.")
+            else:
+                diff.write("Warning: This dataset did not have the previous snapshot. Is it a new dataset?")
+    else: # dataset existed in last snapshot, perform diff
+        # with "diff-summary", zfs diff is stopped after "max-lines-per-dataset" lines
+        max_lines = get_diff_summary_settings().get("max-lines-per-dataset", None)
+        
+        # the changes matching "diff-rules" are removed while the diff streams through
+        zfs_diff_lines = run_zfs_diff(dataset, prev_snapshot, new_snapshot)
+        lines = zfs_diff_lines
+        rule_counts = {"ignore": 0, "approve": 0}
+        if rules != None:
+            lines = filter_diff_lines(lines, rules, rule_counts)
+        
+        try:
+            for count,line in enumerate(format_diff_lines(lines)):
+                if max_lines != None and count >= max_lines:
+                    diff.write("... (zfs diff stopped after " + str(max_lines) + " lines)\n")
+                    break
+                diff.write(line)
+        finally:
+            # stops zfs diff at once if the diff has been cut off
+            zfs_diff_lines.close()
+        
+        if rule_counts["approve"] > 0:
+            if diff.tell() > 0:
+                diff.write("... and " + str(rule_counts["approve"]) + " auto-approved changes\n")
+            else:
+                print("    " + dataset + ": only auto-approved changes (" + str(rule_counts["approve"]) + ")", flush=True)
+        
+        if use_cache:
+            cache.store(dataset, prev_guid, new_guid, written, referenced, rules_signature, diff)
+    
+    return diff
+
+# generator yielding the output lines of zfs diff -FHt without keeping the
+# whole output in memory
+def run_zfs_diff(dataset, prev_snapshot, new_snapshot):
+    with tempfile.TemporaryFile() as stderr:
+        pdiff = zfsbackend.get_backend().diff(dataset, prev_snapshot, new_snapshot, stdout=subprocess.PIPE, stderr=stderr, encoding="utf-8")
+        
+        try:
+            for line in pdiff.stdout:
+                yield line
+        finally:
+            pdiff.stdout.close()
+            if pdiff.poll() == None: # the consumer stopped early
+                pdiff.kill()
+            pdiff.wait()
+        
+        if pdiff.returncode != 0:
+            stderr.seek(0)
+            raise Exception("Error in \"" + " ".join(pdiff.args) + "\":" + stderr.read().decode("utf-8"))
+
+# generator leaving out the lines from zfs diff -FHt where all paths are
+# ignored or auto-approved by rules (see diffrules), which are counted in counts
+def filter_diff_lines(lines, rules, counts):
+    for line in lines:
+        # a renamed file has both the old and the new path
+        columns = line.rstrip('\n').split('\t', 4)
+        kind = rules.match(columns[3]) if len(columns) > 3 else None
+        
+        if kind != None and len(columns) > 4:
+            new_kind = rules.match(columns[4])
+            kind = None if new_kind == None else ("approve" if "approve" in (kind, new_kind) else "ignore")
+        
+        if kind == None:
+            yield line
         else:
-            first = False
-            
-        diff_text += key + '\n'
-        diff_text += diff_dict[key] + '\n'
+            counts[kind] += 1
+
+# generator turning lines from zfs diff -FHt into the lines shown in the diff
+def format_diff_lines(lines):
+    for line in lines:
+        columns = line.rstrip('\n').split('\t')
+        
+        timestamp_str = columns[0]
+        timestamp = int(timestamp_str.split('.')[0])
+        dateandtime = str(datetime.datetime.fromtimestamp(timestamp))
+        difftype = columns[1]
+        filetype = columns[2]
+        filepath = columns[3]
         
-    return diff_text
+        yield difftype + '\t' + filetype + '\t' + dateandtime + '\t' + filepath + '\n'
 
-def approve_by_console(diff_dict):
+# The settings of "diff-summary", an empty dict if not set. When the diff has
+# more than "inline-max-lines" lines, the approval shows a summary of changes
+# per directory instead, with the full diff in a compressed file.
+def get_diff_summary_settings():
+    settings = common.get_settings()
+    return settings["diff-summary"] if "diff-summary" in settings.keys() else dict()
+
+# Returns (file with the number of added, removed, modified and renamed files
+# per directory with at most depth levels (counted from /), number of lines
+# in the diff) for the diff_file of create_diff, which is read from the start.
+def create_diff_summary(diff_file, depth):
+    summary = new_diff_file()
+    total_lines = 0
+    key = None      # the heading of the dataset, None between datasets
+    counts = dict() # directory: dict of difftype: count
+    
+    diff_file.seek(0)
+    for line in itertools.chain(diff_file, ['\n']):
+        if line == '\n':
+            # the end of the diff of a dataset
+            if key != None:
+                write_diff_summary(summary, key, counts)
+            key = None
+            counts = dict()
+            continue
+        
+        if key == None:
+            key = line.rstrip('\n')
+            continue
+        
+        total_lines += 1
+        columns = line.rstrip('\n').split('\t')
+        
+        if len(columns) != 4:
+            continue
+        
+        difftype = columns[0]
+        directory = "/" + "/".join(columns[3].split('/')[1:-1][:depth])
+        
+        directory_counts = counts.setdefault(directory, dict())
+        directory_counts[difftype] = directory_counts.get(difftype, 0) + 1
+    
+    summary.seek(0)
+    return (summary, total_lines)
+
+def write_diff_summary(summary, key, counts):
+    summary.write(key + '\n')
+    summary.write("added\tremoved\tmodified\trenamed\tdirectory\n")
+    for directory in sorted(counts):
+        directory_counts = counts[directory]
+        summary.write('\t'.join([str(directory_counts.get(difftype, 0)) for difftype in ['+', '-', 'M', 'R']]) + '\t' + directory + '\n')
+    summary.write('\n')
+
+# Writes the diff compressed to a file in "full-diff-directory" and returns
+# its path. The file is removed when the approval has been answered.
+def save_full_diff(diff_file, new_snapshot):
+    directory = get_diff_summary_settings().get("full-diff-directory", tempfile.gettempdir())
+    filepath = os.path.join(directory, "diff-" + new_snapshot + "-" + datetime.datetime.now().strftime("%Y-%m-%d_%H%M%S") + ".txt.gz")
+    
+    with gzip.open(filepath, "wt", encoding="utf-8") as full_diff_file:
+        shutil.copyfileobj(diff_file, full_diff_file)
+    
+    return filepath
+
+def approve_by_console(diff_file, attachment=None):
+    # several disks may be backed up in parallel, only one at a time can use the console
+    # (the path of an attachment is already in the diff text)
+    with common.direct_output():
+        return approve_by_console_direct(diff_file)
+
+def approve_by_console_direct(diff_file):
     # present diff
     userinput = input("    Specify a viewer to use or leave empty to print to console: ")
     userinput = userinput.strip()
     editor = userinput if len(userinput) > 0 else None
     
-    diff_text = create_diff_text(diff_dict)
-
     if editor == None:
-        print(diff_text)
+        shutil.copyfileobj(diff_file, sys.stdout)
+        print()
     else:
-        diff_file = "BACKUP_TEMP.diff"
-        print("    Creating temporary diff file: " + diff_file, flush=True)
+        diff_filename = "BACKUP_TEMP.diff"
+        print("    Creating temporary diff file: " + diff_filename, flush=True)
 
-        with open(diff_file, 'w') as f:
-            f.write(diff_text)
+        with open(diff_filename, 'w') as f:
+            shutil.copyfileobj(diff_file, f)
         
-        cmd = editor + ' ' + diff_file
+        cmd = editor + ' ' + diff_filename
         
         try:
-            cpinst = subprocess.run(cmd.split(), stderr=subprocess.PIPE)
+            cpinst = commands.run(cmd.split(), stderr=subprocess.PIPE, interactive=True)
         finally:
             print("    Removing temporary diff file", flush=True)
-            os.remove(diff_file)
+            os.remove(diff_filename)
         
         if cpinst.returncode != 0:
             raise Exception("Error in \"" + cmd + "\": " + cpinst.stderr.decode("utf-8"))
@@ -406,7 +947,7 @@ def get_email_text(msg):
     else:
         raise Exception("Could not find 'text/plain' payload in e-mail")
         
-def approve_by_mail_single(diff_dict):
+def approve_by_mail_single(diff_file, attachment=None):
     # present diff
     settings = common.get_settings()
     approve_settings = settings["approve-method-mail-settings"]
@@ -423,205 +964,649 @@ Deny by replying "no" (also without the quotes).
     
 The changes:\n\n"""
 
-    diff_text = create_diff_text(diff_dict)
-    diffmsg = diffmsg + diff_text
-    
     cmd = ("sendmail", "-F", sender, approve_settings["recipient"])
-    cpinst = subprocess.run(cmd, input=subject+diffmsg, encoding="utf-8", stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     
-    if cpinst.returncode != 0:
-        raise Exception("Error in \"" + cmd + "\":" + cpinst.stderr)
+    # the diff is streamed to sendmail, stderr goes to a file so that sendmail can't block on it
+    with tempfile.TemporaryFile() as stderr:
+        psendmail = commands.popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=stderr, encoding="utf-8")
+        
+        try:
+            if attachment == None:
+                psendmail.stdin.write(subject + diffmsg)
+                shutil.copyfileobj(diff_file, psendmail.stdin)
+            else:
+                # a MIME message with the diff text and the file attached
+                boundary = "==BOUNDARY_" + randomstring
+                psendmail.stdin.write(subject + "MIME-Version: 1.0\nContent-Type: multipart/mixed; boundary=\"" + boundary + "\"\n\n")
+                psendmail.stdin.write("--" + boundary + "\nContent-Type: text/plain; charset=utf-8\n\n" + diffmsg)
+                shutil.copyfileobj(diff_file, psendmail.stdin)
+                write_mail_attachment(psendmail.stdin, boundary, attachment)
+                psendmail.stdin.write("\n--" + boundary + "--\n")
+            psendmail.stdin.close()
+        except BrokenPipeError:
+            pass # sendmail has exited, the error is in stderr
+        
+        psendmail.wait()
+        
+        if psendmail.returncode != 0:
+            stderr.seek(0)
+            raise Exception("Error in \"" + " ".join(cmd) + "\":" + stderr.read().decode("utf-8"))
     
     print("    Diff mail(s) sent.")
+    common.flush_buffered_output()
+
+    return wait_for_mail_reply(approve_settings, randomstring)
+
+# writes the file as a base64 encoded MIME part
+def write_mail_attachment(stream, boundary, filepath):
+    filename = os.path.basename(filepath)
+    stream.write("\n--" + boundary + "\nContent-Type: application/gzip; name=\"" + filename + "\"\n")
+    stream.write("Content-Transfer-Encoding: base64\nContent-Disposition: attachment; filename=\"" + filename + "\"\n\n")
+    
+    with open(filepath, "rb") as attachment_file:
+        while True:
+            chunk = attachment_file.read(57*1024) # a multiple of 57 bytes gives full 76 character lines
+            if len(chunk) == 0:
+                break
+            stream.write(base64.encodebytes(chunk).decode("ascii"))
 
+# seconds to wait in IMAP IDLE before it is restarted, servers may drop
+# connections that have been idle for 30 minutes
+imap_idle_interval = 25*60
+
+# seconds between checks for replies on servers without IDLE
+imap_poll_interval = 10
+
+# longest wait before logging in again after losing the connection
+imap_max_reconnect_delay = 300
+
+# seconds to wait for the server to answer IDLE and DONE
+imap_response_timeout = 60
+
+imap_idle_tags = itertools.count(1)
+
+# Waits for a reply to the mail with randomstring in the subject. Uses IMAP
+# IDLE on one connection to be notified of new mail if the server supports it
+# and "imap-idle" is not false in the settings, otherwise polls. Returns True
+# if the reply is "yes".
+def wait_for_mail_reply(approve_settings, randomstring):
     approval_received = False # did we receive an approval mail (with a "yes" or a "no")?
     approved = False # did we receive an approval mail saying "yes"?
     
+    use_ssl = approve_settings["imap-ssl"] if "imap-ssl" in approve_settings.keys() else True
+    use_idle = approve_settings["imap-idle"] if "imap-idle" in approve_settings.keys() else True
+    
     start_time = time.time()
+    end_time = start_time + approve_settings["timeout"]
+    reconnect_delay = 1
     
-    while not approval_received and time.time() < start_time + approve_settings["timeout"]:
-        # get approval
-        print("    Logging in to mail server to wait for replies...", end="", flush=True)
-        server = imaplib.IMAP4_SSL(approve_settings["imap-server"], port=approve_settings["imap-port"])
-        rv, data = server.login(approve_settings["imap-account"], approve_settings["imap-password"])
-        print("done", flush=True)
+    while not approval_received and time.time() < end_time:
+        server = None
+        logging_in = True
         
-        rv, data = server.select()
-        if rv == 'OK':
-            print("    Waiting for approval(s). Timeout is " + str(approve_settings["timeout"]) + " seconds.", flush=True)
+        try:
+            # get approval
+            print("    Logging in to mail server to wait for replies...", end="", flush=True)
+            if use_ssl:
+                server = imaplib.IMAP4_SSL(approve_settings["imap-server"], port=approve_settings["imap-port"])
+            else:
+                server = imaplib.IMAP4(approve_settings["imap-server"], port=approve_settings["imap-port"])
+            rv, data = server.login(approve_settings["imap-account"], approve_settings["imap-password"])
+            print("done", flush=True)
+            logging_in = False
+            
+            rv, data = server.select()
+            if rv != 'OK':
+                raise imaplib.IMAP4.error("Unable to open mailbox: " + str(rv))
+            
+            idle = use_idle and "IDLE" in server.capabilities
+            
+            print("    Waiting for approval(s)" + (" (IMAP IDLE)" if idle else "") + ". Timeout is " + str(int(end_time - time.time())) + " seconds.", flush=True)
+            common.flush_buffered_output()
+            
+            # the connection works, start over with a short delay the next time it is lost
+            reconnect_delay = 1
 
-            try:
-                while not approval_received and time.time() < start_time + approve_settings["timeout"]:
+            while not approval_received and time.time() < end_time:
+                if not idle:
                     server.recent()
-                    rv, data = server.search(None, "(SUBJECT " + randomstring + ")")
-                    if rv != 'OK':
-                        print("    Could not search mails!", flush=True)
-                        return
-
-                    for num in data[0].split():
-                        rv, data = server.fetch(num, '(RFC822)')
-                        if rv != 'OK':
-                            print("    ERROR fetching mail", num, flush=True)
-                            return
-
-                        msg = email.message_from_bytes(data[0][1])
-                        print("    Reply from " + str(msg['From']) + ": ", end="", flush=True)
-                        the_reply = get_email_text(msg)
-                        for line in the_reply.splitlines():
-                            strippedline = line.strip()
-                            if strippedline != '':
-                                if strippedline.lower() == "yes":
-                                    print("Approved!", flush=True)
-                                    approval_received = True
-                                    approved = True
-                                elif strippedline.lower() == "no":
-                                    print("Declined!", flush=True)
-                                    approval_received = True
-                                    approved = False
-                                else:
-                                    print("Invalid response:\n", flush=True)
-                                    for line in the_reply.splitlines():
-                                        print("    " + line)
-                                    print("\n    Still waiting.", flush=True)
-                                
-                                # we have found the first line that wasn't whitespace, don't process the rest
-                                break
-                                
-                        # delete the mail
-                        server.store(num, '+FLAGS', '\\Deleted')
-                    
-                    if not approval_received:
-                        time.sleep(10)
-                        
+                
+                approval_received, approved = check_mail_replies(server, randomstring)
+                common.flush_buffered_output()
+                
                 if not approval_received:
-                    print("    Timeout", flush=True)
+                    timeout = min(imap_idle_interval if idle else imap_poll_interval, end_time - time.time())
+                    if timeout > 0:
+                        if idle:
+                            imap_idle(server, timeout)
+                        else:
+                            time.sleep(timeout)
                     
-            except imaplib.IMAP4.abort as e:
-                print("    Disconnected.", flush=True);
+            if not approval_received:
+                print("    Timeout", flush=True)
             
-        else:
-            print("    ERROR: Unable to open mailbox ", rv, flush=True)
-
-    server.close()
-    server.logout()
+        except (imaplib.IMAP4.abort, imaplib.IMAP4.error, OSError) as e:
+            if logging_in:
+                print("failed", flush=True)
+            print("    Disconnected: " + str(e) + ". Reconnecting in " + str(reconnect_delay) + " seconds.", flush=True)
+            common.flush_buffered_output()
+            time.sleep(max(0, min(reconnect_delay, end_time - time.time())))
+            reconnect_delay = min(reconnect_delay * 2, imap_max_reconnect_delay)
+            
+        finally:
+            if server != None:
+                try:
+                    if server.state == 'SELECTED':
+                        server.close()
+                    server.logout()
+                except (imaplib.IMAP4.error, OSError):
+                    pass
     
     return approved
 
+# Looks for replies to the mail with randomstring in the subject and deletes
+# them. Returns (approval_received, approved).
+def check_mail_replies(server, randomstring):
+    rv, data = server.search(None, "(UNDELETED SUBJECT " + randomstring + ")")
+    if rv != 'OK':
+        raise imaplib.IMAP4.error("Could not search mails")
+
+    for num in data[0].split():
+        rv, data = server.fetch(num, '(RFC822)')
+        if rv != 'OK':
+            raise imaplib.IMAP4.error("Could not fetch mail " + num.decode("utf-8"))
+
+        msg = email.message_from_bytes(data[0][1])
+        print("    Reply from " + str(msg['From']) + ": ", end="", flush=True)
+        the_reply = get_email_text(msg)
+        
+        # delete the mail
+        server.store(num, '+FLAGS', '\\Deleted')
+        
+        for line in the_reply.splitlines():
+            strippedline = line.strip()
+            if strippedline != '':
+                if strippedline.lower() == "yes":
+                    print("Approved!", flush=True)
+                    return (True, True)
+                elif strippedline.lower() == "no":
+                    print("Declined!", flush=True)
+                    return (True, False)
+                else:
+                    print("Invalid response:\n", flush=True)
+                    for line in the_reply.splitlines():
+                        print("    " + line)
+                    print("\n    Still waiting.", flush=True)
+                
+                # we have found the first line that wasn't whitespace, don't process the rest
+                break
+    
+    return (False, False)
+
+# Waits in IMAP IDLE (RFC 2177) until the server reports a change in the
+# mailbox or timeout seconds have passed. imaplib has no support for IDLE
+# before Python 3.14, so the commands are sent directly. All responses are
+# read through imaplib's buffered reader, in a thread so that the wait can
+# time out: a response that has already been buffered is not missed.
+def imap_idle(server, timeout):
+    tag = ("IDLE" + str(next(imap_idle_tags))).encode("ascii")
+    lines = queue.Queue()
+    
+    # reads responses until the end of the IDLE command
+    def read_responses():
+        while True:
+            try:
+                line = server.readline()
+            except (imaplib.IMAP4.abort, OSError):
+                line = b""
+            lines.put(line)
+            if len(line) == 0 or line.startswith(tag + b" "):
+                return
+    
+    def next_line(wait):
+        try:
+            line = lines.get(timeout=wait)
+        except queue.Empty:
+            raise imaplib.IMAP4.abort("No response from server during IDLE")
+        if len(line) == 0:
+            raise imaplib.IMAP4.abort("Connection closed during IDLE")
+        return line
+    
+    server.send(tag + b" IDLE\r\n")
+    threading.Thread(target=read_responses, daemon=True).start()
+    
+    # untagged responses (such as "* 3 EXISTS") before the continuation
+    # report changes as well
+    changed = False
+    line = next_line(imap_response_timeout)
+    while line.startswith(b"*"):
+        changed = True
+        line = next_line(imap_response_timeout)
+    if not line.startswith(b"+"):
+        raise imaplib.IMAP4.error("IDLE not accepted: " + line.decode("utf-8", "replace").strip())
+    
+    if not changed:
+        try:
+            line = lines.get(timeout=timeout)
+        except queue.Empty:
+            line = None # no news within timeout
+        if line != None and len(line) == 0:
+            raise imaplib.IMAP4.abort("Connection closed during IDLE")
+    
+    server.send(b"DONE\r\n")
+    
+    while not next_line(imap_response_timeout).startswith(tag + b" "):
+        pass
+
 approve_methods = {"console": approve_by_console, "mail": approve_by_mail_single}
 
 def check_for_diff_and_get_approval(pool_to_backup, backup_disk, prev_snapshot, new_snapshot, approve_function):
     print("  Checking for diff from the last approved snapshot", flush=True)
-    diff_dict = create_diff(pool_to_backup, prev_snapshot, new_snapshot)
+    with tracing.span("create-diff"):
+        diff_file = create_diff(pool_to_backup, prev_snapshot, new_snapshot)
     
     # check if we have any differences
     ok_to_cont = False
-    if len(diff_dict) > 0:
+    if diff_file.tell() > 0:
         print("  Diff found. Continuing to get approval", flush=True)
+        
+        summary_settings = get_diff_summary_settings()
+        summary = None
+        
+        if len(summary_settings) > 0:
+            summary,total_lines = create_diff_summary(diff_file, summary_settings.get("depth", 3))
             
-        ok_to_cont = approve_function(diff_dict)
+            if total_lines <= summary_settings.get("inline-max-lines", 1000):
+                summary.close()
+                summary = None
+        
+        diff_file.seek(0)
+        with diff_file, tracing.span("approve") as approve_span:
+            if summary == None:
+                ok_to_cont = approve_function(diff_file)
+            else:
+                print("    Diff has " + str(total_lines) + " lines, sending a summary", flush=True)
+                full_diff_path = save_full_diff(diff_file, new_snapshot)
+                attach = summary_settings.get("attach-full-diff", False)
+                
+                # the full diff is only needed until the approval has been answered
+                try:
+                    with summary:
+                        summary.seek(0, os.SEEK_END)
+                        summary.write("The full diff" + (" is attached and" if attach else "") + " is kept in " + full_diff_path + " until the approval has been answered\n")
+                        summary.seek(0)
+                        
+                        if attach:
+                            ok_to_cont = approve_function(summary, full_diff_path)
+                        else:
+                            ok_to_cont = approve_function(summary)
+                finally:
+                    os.remove(full_diff_path)
+            
+            if not ok_to_cont:
+                approve_span.outcome = "denied"
     else:
+        diff_file.close()
         print("    No diff", flush=True)
         ok_to_cont = True
     
     return ok_to_cont
+
+# One approval for all disks in a run. The diff from the latest approved
+# snapshot to new_snapshot is created and approved in a background thread
+# while the disks are prepared, and each disk continues when wait() returns.
+class ApprovalRequest:
+    def __init__(self, pool_to_backup, disks, new_snapshot, approve_function):
+        self.pool_to_backup = pool_to_backup
+        self.disks = disks
+        self.new_snapshot = new_snapshot
+        self.approve_function = approve_function
+        self.approved = False
+        self.failed = False
+        self.done = threading.Event()
+        
+    def start(self):
+        thread = threading.Thread(target=common.run_buffered, args=(self.run, None), daemon=True)
+        thread.start()
+        
+    def run(self, item):
+        approval_span = tracing.start_span("approval", disk=",".join([disk["zpool"] for disk in self.disks]))
+        try:
+            print("Requesting approval for \"" + "\", \"".join([disk["zpool"] for disk in self.disks]) + "\"", flush=True)
+            
+            settings = common.get_settings()
+            print("  Finding latest approved snapshot: ", end="", flush=True)
+            latest_approved_snapshot = find_latest_snapshot(self.pool_to_backup, [disk["zpool"] for disk in settings["backup-disks"]])
+            if latest_approved_snapshot != None:
+                print(latest_approved_snapshot)
+            else:
+                raise Exception("No approved snapshot found")
+            
+            # create diff between new snapshot and last approved
+            # request approval if there are differences
+            # if no differences or approval received, continue
+            self.approved = check_for_diff_and_get_approval(self.pool_to_backup, self.disks, latest_approved_snapshot, self.new_snapshot, self.approve_function)
+            if not self.approved:
+                approval_span.outcome = "denied"
+        except Exception as e:
+            traceback.print_exc()
+            print("  Approval failed", flush=True)
+            approval_span.failed(e)
+            self.failed = True
+        finally:
+            tracing.end_span(approval_span)
+            self.done.set()
     
+    # blocks until the approval has been received or denied, returns True if
+    # approved. The approval can take hours, the wait ends early when the run
+    # is cancelled.
+    def wait(self):
+        while not self.done.wait(1):
+            if commands.cancelled:
+                raise Exception("The run has been cancelled while waiting for the approval")
+        
+        if self.failed:
+            raise Exception("The approval failed")
+        
+        return self.approved
+
 def get_datasets(pool):
-    cmd = "zfs list -rH -o name " + pool
-    
-    cpinst = subprocess.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    
-    if cpinst.returncode != 0:
-        raise Exception("Error in \"" + cmd + "\":" + cpinst.stderr.decode("utf-8"))
-    
-    lines = cpinst.stdout.decode("utf-8").splitlines()
+    rows = zfsbackend.get_backend().list(pool, "filesystem,volume", ["name"])
         
     datasets = list()
     
-    for line in lines:
-        if line != pool:
-            datasets.append(line)
+    for name, in rows:
+        if name != pool:
+            datasets.append(name)
             
     return datasets
 
-def check_snapshot_on_pool(pool, snapshot):
-    # Verify that all snapshots have been created on the backup pool
-    datasets = get_datasets(pool)
-    datasets_not_on_pool = list()
+# returns a dict of dataset: guid of snapshot (None if the dataset does not
+# have the snapshot) for all datasets in pool. The dataset names are relative
+# to the pool, the pool itself is ''.
+def get_snapshot_guids(pool, snapshot):
+    # filesystem,volume,snapshot: list the datasets too, to find the ones missing the snapshot
+    rows = zfsbackend.get_backend().list(pool, "filesystem,volume,snapshot", ["name", "guid"])
     
-    for dataset in datasets:
-        cmd = "zfs list -H " + dataset + "@" + snapshot
-        cpinst = subprocess.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    
-        if cpinst.returncode == 1 and re.search("does not exist", cpinst.stderr.decode("utf-8")):
-            datasets_not_on_pool.append(dataset)
-        elif cpinst.returncode != 0:
-            raise Exception("Error in \"" + cmd + "\":" + cpinst.stderr.decode("utf-8"))
-    
-    return datasets_not_on_pool
+    guids = dict()
     
-def perform_first_backup(pool_to_backup, backup_pool, snapshot):
-    backup_made = False
-    error = False
+    for name,guid in rows:
+        dataset,_,snapshot_name = name.partition('@')
+        dataset = dataset[len(pool)+1:]
+        
+        if snapshot_name == '':
+            guids.setdefault(dataset, None)
+        elif snapshot_name == snapshot:
+            guids[dataset] = guid
+            
+    return guids
 
-    cmd_send = "zfs send -R " + pool_to_backup + "@" + snapshot
-    cmd_recv = "zfs recv -Fdu " + backup_pool
+def check_snapshot_on_pool(pool, snapshot, pool_to_backup):
+    # Verify that all snapshots have been created on the backup pool and that
+    # they are the same snapshots as on pool_to_backup
+    guids = get_snapshot_guids(pool, snapshot)
+    source_guids = get_snapshot_guids(pool_to_backup, snapshot)
+    datasets_not_on_pool = list()
     
-    psend = subprocess.Popen(cmd_send.split(), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    precv = subprocess.Popen(cmd_recv.split(), stdin=psend.stdout, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    #psend.stdout.close()  # Allow send to receive a SIGPIPE if recv exits. (from subprocess docs example)
-    #   The above can't be used because we can't call communicate to read
-    #   stderr from send if we've closed the handle.
-    recv_stderr = precv.communicate()[1]
+    for dataset in guids:
+        if guids[dataset] == None and dataset != '':
+            datasets_not_on_pool.append(pool + '/' + dataset)
     
-    if precv.returncode != 0:
-        raise Exception("Error in \"" + cmd_recv + "\":" + recv_stderr.decode("utf-8"))
-
-    send_stderr = psend.communicate()[1]
+    for dataset in source_guids:
+        if source_guids[dataset] != None and guids.get(dataset) != source_guids[dataset]:
+            datasets_not_on_pool.append(pool + ('/' + dataset if dataset != '' else ''))
     
-    if psend.returncode != 0:
-        raise Exception("Error in \"" + cmd_send + "\":" + send_stderr.decode("utf-8"))
-        
-    datasets_not_backed_up = check_snapshot_on_pool(backup_pool, snapshot)
+    return datasets_not_on_pool
+
+# returns (backup_made, errormsg)
+def verify_backup(pool_to_backup, backup_pool, snapshot):
+    with tracing.span("verify", disk=backup_pool) as verify_span:
+        datasets_not_backed_up = check_snapshot_on_pool(backup_pool, snapshot, pool_to_backup)
+        if len(datasets_not_backed_up) > 0:
+            verify_span.failed()
     
     if len(datasets_not_backed_up) > 0:
-        error = "Error! Snapshot missing in backup on the following datasets: "
+        error = "Error! Snapshot missing or different in backup on the following datasets: "
         
         for dataset in datasets_not_backed_up:
             error = error + dataset + ' '
             
         return (False,error)
     else:
-        return (True,error)
+        return (True,False)
+    
+def perform_first_backup(pool_to_backup, backup_pool, snapshot, flags=""):
+    send_args = send_arguments(pool_to_backup, None, snapshot, flags)
+    recv_args = recv_arguments(backup_pool)
+    
+    stats = send_and_receive(send_args, recv_args, backup_pool)
+        
+    return verify_backup(pool_to_backup, backup_pool, snapshot) + (stats,)
+    
+def perform_incremental_backup(pool_to_backup, backup_pool, prev_snapshot, new_snapshot, flags=""):
+    send_args = send_arguments(pool_to_backup, prev_snapshot, new_snapshot, flags)
+    recv_args = recv_arguments(backup_pool)
     
-def perform_incremental_backup(pool_to_backup, backup_pool, prev_snapshot, new_snapshot):
-    backup_made = False
-    error = False
+    stats = send_and_receive(send_args, recv_args, backup_pool)
+
+    return verify_backup(pool_to_backup, backup_pool, new_snapshot) + (stats,)
+
+# zfs send flags for the options in the "send-options" of a backup disk
+send_options = {
+    "compressed": "-c",     # send compressed blocks as they are on disk
+    "large-block": "-L",    # allow blocks larger than 128 KiB
+    "embedded": "-e",       # send embedded (very small) blocks as they are
+    "raw": "-w"             # send encrypted datasets without decrypting them
+}
+
+# Returns the extra zfs send flags for disk, for example "-c -L ". Note that
+# once a stream with -L has been received, the following incremental streams
+# to that disk should also use -L.
+def send_flags(disk):
+    flags = str()
+    
+    if "send-options" in disk.keys():
+        for option in send_options:
+            if option in disk["send-options"].keys() and disk["send-options"][option]:
+                flags += send_options[option] + " "
+    
+    return flags
+
+# returns the keyword arguments to the send of the zfs backend for a
+# replication stream (-R), incremental from prev_snapshot if not None
+def send_arguments(pool_to_backup, prev_snapshot, new_snapshot, flags=""):
+    return {"pool": pool_to_backup, "new_snapshot": new_snapshot, "prev_snapshot": prev_snapshot, "flags": flags}
 
-    cmd_send = "zfs send -R -I " + pool_to_backup + "@" + prev_snapshot + " " + pool_to_backup + "@" + new_snapshot
-    cmd_recv = "zfs recv -Fdu " + backup_pool
+# returns the keyword arguments to relay.relay for the buffer between send and recv
+def send_buffer_arguments():
+    settings = common.get_settings()
+    
+    if "send-buffer" not in settings.keys():
+        return dict()
     
-    psend = subprocess.Popen(cmd_send.split(), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    precv = subprocess.Popen(cmd_recv.split(), stdin=psend.stdout, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    #psend.stdout.close()  # Allow send to receive a SIGPIPE if recv exits. (from subprocess docs example)
-    #   The above can't be used because we can't call communicate to read
-    #   stderr from send if we've closed the handle.
-    recv_stderr = precv.communicate()[1]
-    send_stderr = psend.communicate()[1]
+    buffer_settings = settings["send-buffer"]
+    arguments = {"buffer_size": buffer_settings["size-mib"]*1024*1024}
     
-    if precv.returncode != 0:
-        raise Exception("Error in \"" + cmd_recv + "\":" + recv_stderr.decode("utf-8"))
+    if "write-start-percent" in buffer_settings.keys():
+        arguments["write_start"] = buffer_settings["write-start-percent"]
+    if "read-resume-percent" in buffer_settings.keys():
+        arguments["read_resume"] = buffer_settings["read-resume-percent"]
     
-    if psend.returncode != 0:
-        raise Exception("Error in \"" + cmd_send + "\":" + send_stderr.decode("utf-8"))
+    return arguments
 
-    datasets_not_backed_up = check_snapshot_on_pool(backup_pool, new_snapshot)
+# Returns the TransferStats of the stream if it is relayed (see relay.py),
+# otherwise None. The stream is relayed if "send-relay" is set, the
+# "send-buffer" is only used then.
+def send_and_receive(send_args, recv_args, backup_pool):
+    settings = common.get_settings()
+    backend = zfsbackend.get_backend()
     
-    if len(datasets_not_backed_up) > 0:
-        error = "Error! Snapshot missing in backup on the following datasets: "
+    if "send-relay" in settings.keys() and settings["send-relay"]:
+        progress_interval = settings["progress-interval"] if "progress-interval" in settings.keys() else None
+        expected_size = backend.estimate_send_size(**send_args) if progress_interval else None
+        buffer_arguments = send_buffer_arguments()
         
-        for dataset in datasets_not_backed_up:
-            error = error + dataset + ' '
+        # stderr goes to files so that no process can block on a full stderr pipe
+        with tempfile.TemporaryFile() as send_stderr, tempfile.TemporaryFile() as recv_stderr:
+            psend = backend.send(**send_args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=send_stderr)
+            precv = backend.recv(**recv_args, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=recv_stderr)
             
-        return (False,error)
+            try:
+                stats,failed = relay.relay(psend.stdout.fileno(), {backup_pool: precv.stdin.fileno()}, expected_size, progress_interval, 3, **buffer_arguments)
+            finally:
+                if psend.poll() == None and precv.poll() != None:
+                    psend.kill() # nothing is receiving the stream any more
+                close_pipe(psend.stdout)
+                close_pipe(precv.stdin)
+                precv.wait()
+                psend.wait()
+                invalidate_snapshot_catalog(backup_pool)
+            
+            if precv.returncode != 0:
+                recv_stderr.seek(0)
+                raise Exception("Error in \"" + " ".join(precv.args) + "\":" + recv_stderr.read().decode("utf-8"))
+            
+            if psend.returncode != 0:
+                send_stderr.seek(0)
+                raise Exception("Error in \"" + " ".join(psend.args) + "\":" + send_stderr.read().decode("utf-8"))
+        
+        return stats
     else:
-        return (True,error)
+        psend = backend.send(**send_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        precv = backend.recv(**recv_args, stdin=psend.stdout, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        #psend.stdout.close()  # Allow send to receive a SIGPIPE if recv exits. (from subprocess docs example)
+        #   The above can't be used because we can't call communicate to read
+        #   stderr from send if we've closed the handle.
+        recv_stderr = precv.communicate()[1]
+        invalidate_snapshot_catalog(backup_pool)
+        send_stderr = psend.communicate()[1]
+        
+        if precv.returncode != 0:
+            raise Exception("Error in \"" + " ".join(precv.args) + "\":" + recv_stderr.decode("utf-8"))
+        
+        if psend.returncode != 0:
+            raise Exception("Error in \"" + " ".join(psend.args) + "\":" + send_stderr.decode("utf-8"))
+        
+        return None
+
+def close_pipe(pipe):
+    try:
+        pipe.close()
+    except OSError: # the other end has exited
+        pass
+
+# returns the keyword arguments to the recv of the zfs backend
+def recv_arguments(backup_pool):
+    settings = common.get_settings()
+    
+    # -s: keep the partially received state if interrupted, see resume_receives
+    if "resumable-receive" in settings.keys() and settings["resumable-receive"]:
+        return {"target": backup_pool, "flags": "-s -Fdu"}
+    else:
+        return {"target": backup_pool, "flags": "-Fdu"}
+
+# Resumes receives into backup_pool that were interrupted in an earlier run.
+# If the snapshot that was being sent no longer exists on pool_to_backup the
+# partially received state is discarded. Returns True if anything was done.
+def resume_receives(pool_to_backup, backup_pool, print_depth):
+    backend = zfsbackend.get_backend()
+    values = backend.get(backup_pool, ["receive_resume_token"], recursive=True, types="filesystem,volume")
+    
+    resumed = False
+    
+    for dataset,property_name,token in values:
+        
+        if token == '-':
+            continue
+        
+        resumed = True
+        print("  "*print_depth + "Resuming interrupted receive of " + dataset + ": ", end="", flush=True)
+        
+        psend = backend.send_resume(token, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        precv = backend.recv(dataset, "-s -u", stdin=psend.stdout, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        psend.stdout.close() # recv has its own handle, lets send get SIGPIPE if recv exits
+        recv_stderr = precv.communicate()[1]
+        send_stderr = psend.communicate()[1].decode("utf-8")
+        
+        if psend.returncode != 0 and re.search("no longer exists", send_stderr):
+            print("the sent snapshot no longer exists, aborting", flush=True)
+            
+            backend.abort_receive(dataset)
+        elif psend.returncode != 0:
+            raise Exception("Error in \"" + " ".join(psend.args) + "\":" + send_stderr)
+        elif precv.returncode != 0:
+            raise Exception("Error in \"" + " ".join(precv.args) + "\":" + recv_stderr.decode("utf-8"))
+        else:
+            print("done", flush=True)
+    
+    if resumed:
+        invalidate_snapshot_catalog(backup_pool)
+    
+    return resumed
+
+# Sends new_snapshot (incrementally from prev_snapshot if not None) once and
+# receives the stream on all backup_pools. A failing receiver does not stop
+# the others. Returns a dict of backup pool: (backup_made, errormsg, TransferStats)
+def perform_fan_out_backup(pool_to_backup, backup_pools, prev_snapshot, new_snapshot, flags=""):
+    settings = common.get_settings()
+    progress_interval = settings["progress-interval"] if "progress-interval" in settings.keys() else None
+    
+    backend = zfsbackend.get_backend()
+    send_args = send_arguments(pool_to_backup, prev_snapshot, new_snapshot, flags)
+    expected_size = backend.estimate_send_size(**send_args) if progress_interval else None
+    buffer_arguments = send_buffer_arguments()
+    
+    # stderr goes to files so that no process can block on a full stderr pipe
+    send_stderr = tempfile.TemporaryFile()
+    psend = None
+    receivers = dict()
+    
+    try:
+        psend = backend.send(**send_args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=send_stderr)
+        
+        for backup_pool in backup_pools:
+            recv_stderr = tempfile.TemporaryFile()
+            receivers[backup_pool] = (None, recv_stderr)
+            receivers[backup_pool] = (backend.recv(**recv_arguments(backup_pool), stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=recv_stderr), recv_stderr)
+        
+        # copy the stream to all receivers that are still alive, the errors of
+        # failed receivers are read from their stderr below
+        stats,failed = relay.relay(psend.stdout.fileno(), {backup_pool: receivers[backup_pool][0].stdin.fileno() for backup_pool in backup_pools}, expected_size, progress_interval, 3, **buffer_arguments)
+    finally:
+        # every process that has been started is waited for and the files are
+        # closed, also if starting a receiver or the relay failed
+        started = [(backup_pool, precv) for backup_pool,(precv,recv_stderr) in receivers.items() if precv != None]
+        
+        if psend != None:
+            if psend.poll() == None and all([precv.poll() != None for backup_pool,precv in started]):
+                psend.kill() # nothing is receiving the stream any more
+            close_pipe(psend.stdout)
+        for backup_pool,precv in started:
+            close_pipe(precv.stdin)
+            precv.wait()
+            invalidate_snapshot_catalog(backup_pool)
+        if psend != None:
+            psend.wait()
+        
+        send_stderr.seek(0)
+        send_errormsg = "Error in \"" + " ".join(psend.args) + "\":" + send_stderr.read().decode("utf-8") if psend != None else None
+        send_stderr.close()
+        
+        recv_errormsgs = dict()
+        for backup_pool,(precv,recv_stderr) in receivers.items():
+            recv_stderr.seek(0)
+            recv_errormsgs[backup_pool] = "Error in \"" + " ".join(precv.args) + "\":" + recv_stderr.read().decode("utf-8") if precv != None else None
+            recv_stderr.close()
+    
+    results = dict()
+    for backup_pool in backup_pools:
+        precv, recv_stderr = receivers[backup_pool]
+        
+        if precv.returncode != 0:
+            results[backup_pool] = (False, recv_errormsgs[backup_pool], stats)
+        elif psend.returncode != 0:
+            results[backup_pool] = (False, send_errormsg, stats)
+        else:
+            results[backup_pool] = verify_backup(pool_to_backup, backup_pool, new_snapshot) + (stats,)
+    
+    return results
@@ -0,0 +1,223 @@
+#!/usr/bin/python3
+
+# Times backup.py --probe, --backup, --scrub and --remove against the
+# simulated tools in sim/toolchain.py. For each size a pool with that many
+# datasets is created, with files and a history of snapshots (at most
+# --max-snapshots in total), and --disks backup disks with LUKS containers
+# and exported pools. Then the phases are run one after the other:
+#
+#   probe                 backup.py --probe
+#   backup (first)        backup.py --backup, full send to the empty pools
+#   backup (incremental)  backup.py --backup after files in --changed
+#                         percent of the datasets have been changed
+#   scrub                 backup.py --scrub
+#   remove                backup.py --remove of all backup pools
+#
+# The wall time, the time spent importing pools and the number of processes
+# started (zfs, zpool, cryptsetup, ...) are reported for each phase, with the
+# most frequent commands. --host-devices other disks are attached, which an
+# import without -d has to search. With --cachefile the pools are imported
+# through cachefiles. The approvals are answered on the console (stdin). The output of
+# backup.py, with the trace summary of each run, is written to output.log and
+# the spans to trace.jsonl (see --keep).
+#
+# Runs without root and without zfs, but the python modules used by
+# backup.py (filelock) must be installed.
+
+import argparse
+import collections
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+repository = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+sys.path.insert(0, os.path.join(repository, "sim"))
+
+import toolchain
+
+pool_to_backup = "tank"
+
+def dataset_name(index):
+    # two levels, like home directories or containers below a parent
+    return pool_to_backup + "/group" + str(index // 100) + "/data" + str(index)
+
+def populate(root, dataset_count, snapshots_per_dataset, files_per_dataset, disk_count, host_devices, changed):
+    db = toolchain.open_state(root)
+    random.seed(1)
+
+    device = os.path.join(root, "dev", pool_to_backup)
+    open(device, "a").close()
+    toolchain.add_pool(db, pool_to_backup, device)
+
+    datasets = [dataset_name(index) for index in range(dataset_count)]
+    groups = sorted(set([dataset.rpartition('/')[0] for dataset in datasets]))
+    toolchain.add_datasets(db, groups + datasets)
+    toolchain.write_files(db, [(dataset, "/file" + str(number), random.randint(4096, 4*1024*1024)) for dataset in datasets for number in range(files_per_dataset)])
+
+    for number in range(host_devices):
+        toolchain.add_disk(root, "sim-host-disk-" + str(number), formatted=False)
+
+    disks = list()
+    for number in range(disk_count):
+        ident = "sim-disk-" + str(number) + "-part1"
+        keyfile = os.path.join(root, ident + ".key")
+        with open(keyfile, "w") as f:
+            f.write("key")
+
+        toolchain.add_disk(root, ident)
+        disk = {"zpool": "backup" + str(number), "id": ident, "luks": "luks-" + ident, "luks-keyfile": keyfile,
+                "send-options": {"compressed": True, "large-block": True, "embedded": True, "raw": False}}
+        toolchain.add_pool(db, disk["zpool"], os.path.join(root, "dev", "mapper", disk["luks"]), imported=False)
+        disks.append(disk)
+
+    # the last snapshot of the history is the approved starting point the
+    # first backup is compared with, as if made by an earlier backup
+    for number in range(snapshots_per_dataset):
+        change_files(db, datasets, changed, "history" + str(number))
+        if number < snapshots_per_dataset - 1:
+            toolchain.create_snapshots(db, [pool_to_backup + "@auto-" + str(number)])
+        else:
+            toolchain.create_snapshots(db, [pool_to_backup + "@" + ":".join([disk["zpool"] for disk in disks]) + "_2000-01-01"])
+
+    return db, datasets, disks
+
+# writes a new file and replaces an old one in changed percent of the datasets
+def change_files(db, datasets, changed, name):
+    count = max(1, len(datasets) * changed // 100)
+    selected = random.sample(datasets, min(count, len(datasets)))
+    toolchain.write_files(db, [(dataset, path, random.randint(4096, 1024*1024)) for dataset in selected for path in ["/" + name, "/file0"]])
+
+def write_config(root, disks, cachefile):
+    config = {
+        "pool-to-backup": pool_to_backup,
+        "backup-disks": disks,
+        "approve-method": "console",
+        "device-directories": {"disk-by-id": os.path.join(root, "dev", "disk", "by-id"), "mapper": os.path.join(root, "dev", "mapper")},
+        "trace": {"file": os.path.join(root, "trace.jsonl"), "summary": True}
+    }
+    if cachefile:
+        config["pool-cachefile-directory"] = root
+
+    filepath = os.path.join(root, "backup-config.json")
+    with open(filepath, "w") as f:
+        json.dump(config, f, indent=3)
+    return filepath
+
+def read_processes(root):
+    filepath = os.path.join(root, "processes.log")
+    if not os.path.exists(filepath):
+        return list()
+    with open(filepath) as f:
+        return f.read().splitlines()
+
+# the seconds of the spans with the name in the runs after the first before
+# lines of the trace
+def span_seconds(root, name, before):
+    filepath = os.path.join(root, "trace.jsonl")
+    if not os.path.exists(filepath):
+        return 0.0
+    with open(filepath) as f:
+        records = [json.loads(line) for line in f.read().splitlines()[before:]]
+    return sum([record["seconds"] for record in records if record["name"] == name])
+
+def count_lines(filepath):
+    if not os.path.exists(filepath):
+        return 0
+    with open(filepath) as f:
+        return len(f.read().splitlines())
+
+# returns (exit code, seconds, seconds importing pools, Counter of "tool subcommand")
+def run_phase(root, config, arguments, answers):
+    env = dict(os.environ)
+    env["PATH"] = os.path.join(root, "bin") + os.pathsep + env["PATH"]
+    env[toolchain.root_variable] = root
+
+    before = len(read_processes(root))
+    traced_before = count_lines(os.path.join(root, "trace.jsonl"))
+
+    start = time.monotonic()
+    with open(os.path.join(root, "output.log"), "a") as output:
+        output.write("\n### backup.py " + " ".join(arguments) + "\n")
+        output.flush()
+        cpinst = subprocess.run([sys.executable, os.path.join(repository, "backup.py"), "-c", config] + arguments,
+                                input=answers.encode("utf-8"), stdout=output, stderr=subprocess.STDOUT, env=env)
+    seconds = time.monotonic() - start
+
+    commands = collections.Counter([" ".join(line.split()[:2]) for line in read_processes(root)[before:]])
+
+    return (cpinst.returncode, seconds, span_seconds(root, "pool-import", traced_before), commands)
+
+def benchmark(dataset_count, args):
+    # the datasets, their parents and the pool itself have snapshots
+    snapshots_per_dataset = max(1, min(args.snapshots_per_dataset, args.max_snapshots // (dataset_count + (dataset_count + 99) // 100 + 1)))
+    root = tempfile.mkdtemp(prefix="zfs-offline-backup-bench-", dir=args.directory)
+
+    try:
+        toolchain.install(os.path.join(root, "bin"))
+
+        start = time.monotonic()
+        db,datasets,disks = populate(root, dataset_count, snapshots_per_dataset, args.files_per_dataset, args.disks, args.host_devices, args.changed)
+        config = write_config(root, disks, args.cachefile)
+
+        # the scrubs take --scrub-seconds
+        total_size = sum([toolchain.referenced(db, dataset) for dataset in datasets])
+        toolchain.set_config(db, "scrub-rate", max(1, total_size // max(args.scrub_seconds, 0.001)))
+
+        snapshot_count, = db.execute("SELECT COUNT(*) FROM snapshots").fetchone()
+        print("%d datasets, %d snapshots, %d disks (set up in %.1f s)" % (dataset_count, snapshot_count, len(disks), time.monotonic() - start), flush=True)
+
+        pools = [disk["zpool"] for disk in disks]
+        approvals = "\nYES\n" * 10
+        phases = [
+            ("probe", ["--probe"], "", None),
+            ("backup (first)", ["--backup"], approvals, lambda: change_files(db, datasets, args.changed, "first")),
+            ("backup (incremental)", ["--backup"], approvals, lambda: change_files(db, datasets, args.changed, "incremental")),
+            ("scrub", ["--scrub"], "", None),
+            ("remove", ["--remove"] + pools, "YES\n", None)
+        ]
+
+        results = list()
+        for name,arguments,answers,prepare in phases:
+            if prepare != None:
+                prepare()
+            returncode,seconds,import_seconds,commands = run_phase(root, config, arguments, answers)
+            results.append((name, returncode, seconds, import_seconds, commands))
+
+            most_frequent = ", ".join([command + " " + str(count) for command,count in commands.most_common(args.top)])
+            print("  %-22s exit %d %9.2f s  import %6.2f s %7d processes  %s" % (name, returncode, seconds, import_seconds, sum(commands.values()), most_frequent), flush=True)
+
+        if any([returncode != 0 for name,returncode,seconds,import_seconds,commands in results]):
+            print("  Some phases failed, see " + os.path.join(root, "output.log"), flush=True)
+            args.keep = True
+
+        return results
+    finally:
+        if args.keep:
+            print("  Kept " + root, flush=True)
+        else:
+            shutil.rmtree(root)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="10,1000,10000", help="Comma separated numbers of datasets (default=10,1000,10000).")
+    parser.add_argument("--snapshots-per-dataset", type=int, default=50, help="Snapshots in the history of each dataset (default=50).")
+    parser.add_argument("--max-snapshots", type=int, default=50000, help="At most this many snapshots in total, fewer per dataset for large sizes (default=50000).")
+    parser.add_argument("--files-per-dataset", type=int, default=10, help="Files in each dataset (default=10).")
+    parser.add_argument("--changed", type=int, default=1, help="Percent of the datasets changed between snapshots, at least one dataset (default=1).")
+    parser.add_argument("--disks", type=int, default=2, help="Number of backup disks (default=2).")
+    parser.add_argument("--host-devices", type=int, default=20, help="Other disks attached to the host (default=20).")
+    parser.add_argument("--cachefile", action="store_true", help="Import the pools through cachefiles.")
+    parser.add_argument("--scrub-seconds", type=float, default=2, help="Duration of a simulated scrub (default=2).")
+    parser.add_argument("--top", type=int, default=4, help="Number of most frequent commands to show per phase (default=4).")
+    parser.add_argument("--directory", default=None, help="Directory for the simulated state (default=system temp directory).")
+    parser.add_argument("--keep", action="store_true", help="Keep the simulated state and the output of backup.py.")
+    args = parser.parse_args()
+
+    for size in [int(size) for size in args.sizes.split(',')]:
+        benchmark(size, args)
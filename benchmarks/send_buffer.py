@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+
+# Compares the throughput from a bursty source to a bursty destination when
+# they are connected directly with a pipe, like zfs send | zfs recv, and when
+# the stream passes through the StreamBuffer in relay.py.
+#
+# The source produces --source-burst-mib at full speed and then stalls for
+# --pause seconds, like reads from a raidz. The destination consumes
+# --destination-burst-mib and then stalls for --pause seconds, like an SMR
+# disk flushing its cache. With only a pipe between them every stall of one
+# side also stalls the other.
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import relay
+
+source_script = """
+import os, sys, time
+total, burst, pause = int(sys.argv[1]), int(sys.argv[2]), float(sys.argv[3])
+chunk = b'x' * (1024*1024)
+written = 0
+while written < total:
+    end = written + burst
+    while written < min(end, total):
+        written += os.write(1, chunk[:min(len(chunk), total - written)])
+    time.sleep(pause)
+"""
+
+destination_script = """
+import os, sys, time
+burst, pause = int(sys.argv[1]), float(sys.argv[2])
+received = 0
+next_pause = burst
+while True:
+    data = os.read(0, 1024*1024)
+    if len(data) == 0:
+        break
+    received += len(data)
+    if received >= next_pause:
+        time.sleep(pause)
+        next_pause += burst
+"""
+
+def run(total, source_burst, destination_burst, pause, buffer_size, write_start=0, read_resume=100):
+    source = subprocess.Popen([sys.executable, "-c", source_script, str(total), str(source_burst), str(pause)], stdout=subprocess.PIPE)
+    destination = subprocess.Popen([sys.executable, "-c", destination_script, str(destination_burst), str(pause)], stdin=subprocess.PIPE if buffer_size != None else source.stdout)
+
+    start = time.monotonic()
+
+    if buffer_size != None:
+        relay.relay(source.stdout.fileno(), {"destination": destination.stdin.fileno()}, buffer_size=buffer_size, write_start=write_start, read_resume=read_resume)
+        destination.stdin.close()
+
+    source.stdout.close()
+    destination.wait()
+    source.wait()
+
+    return time.monotonic() - start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--total-mib", type=int, default=1024, help="Bytes to transfer (default=1024).")
+    parser.add_argument("--source-burst-mib", type=int, default=64, help="MiB read from the source between stalls (default=64).")
+    parser.add_argument("--destination-burst-mib", type=int, default=40, help="MiB written to the destination between stalls (default=40).")
+    parser.add_argument("--pause", type=float, default=0.3, help="Seconds to stall between bursts (default=0.3).")
+    parser.add_argument("--buffer-mib", type=int, nargs='*', default=[64, 256, 1024], help="Buffer sizes to test (default=64 256 1024).")
+    parser.add_argument("--write-start", type=int, default=0, help="Percent filled before writing starts (default=0).")
+    parser.add_argument("--read-resume", type=int, default=100, help="Percent emptied to before reading resumes (default=100).")
+    args = parser.parse_args()
+
+    total = args.total_mib*1024*1024
+    source_burst = args.source_burst_mib*1024*1024
+    destination_burst = args.destination_burst_mib*1024*1024
+
+    print("%-16s %10s %12s" % ("mode", "seconds", "MiB/s"))
+
+    seconds = run(total, source_burst, destination_burst, args.pause, None)
+    print("%-16s %10.2f %12.1f" % ("direct pipe", seconds, args.total_mib / seconds), flush=True)
+
+    for buffer_mib in args.buffer_mib:
+        seconds = run(total, source_burst, destination_burst, args.pause, buffer_mib*1024*1024, args.write_start, args.read_resume)
+        print("%-16s %10.2f %12.1f" % ("buffer " + str(buffer_mib) + " MiB", seconds, args.total_mib / seconds), flush=True)
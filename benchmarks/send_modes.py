@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+
+# Measures zfs send/recv with the different "send-options" of a backup disk.
+# A pool backed by a file is created with one compressed dataset and one
+# encrypted and compressed dataset, filled with partly compressible data and
+# snapshotted. Each dataset is then sent with each mode and received on a
+# second file backed pool. The wall time and the bytes in the stream are
+# reported.
+#
+# Must be run as root on a host with zfs. The pools are created in --directory
+# and destroyed afterwards.
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import backup_functions
+import relay
+
+modes = [
+    ("none", {}),
+    ("compressed", {"compressed": True}),
+    ("large-block", {"large-block": True}),
+    ("compressed,large-block,embedded", {"compressed": True, "large-block": True, "embedded": True}),
+    ("raw", {"raw": True})
+]
+
+def run(cmd):
+    cpinst = subprocess.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    if cpinst.returncode != 0:
+        raise Exception("Error in \"" + cmd + "\":" + cpinst.stderr.decode("utf-8"))
+
+def fill(path, size):
+    # every other MiB compresses well
+    with open(path, "wb") as f:
+        for i in range(size // (1024*1024)):
+            f.write(os.urandom(1024*1024) if i % 2 == 0 else b"backup " * (1024*1024 // 7) + b"x" * (1024*1024 % 7))
+
+def send_and_receive(cmd_send, cmd_recv):
+    psend = subprocess.Popen(cmd_send.split(), stdout=subprocess.PIPE)
+    precv = subprocess.Popen(cmd_recv.split(), stdin=subprocess.PIPE)
+
+    start = time.monotonic()
+    stats,failed = relay.relay(psend.stdout.fileno(), {"recv": precv.stdin.fileno()})
+    precv.stdin.close()
+    psend.stdout.close()
+    precv.wait()
+    psend.wait()
+    seconds = time.monotonic() - start
+
+    if psend.returncode != 0 or precv.returncode != 0 or len(failed) > 0:
+        raise Exception("Error in \"" + cmd_send + " | " + cmd_recv + "\"")
+
+    return (seconds, stats.bytes)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--directory", default="/var/tmp", help="Directory for the pool files (default=/var/tmp).")
+    parser.add_argument("--size-mib", type=int, default=1024, help="MiB of data in each dataset (default=1024).")
+    args = parser.parse_args()
+
+    source_pool = "sendbench_source"
+    target_pool = "sendbench_target"
+    pool_size = str(args.size_mib * 4 + 512) + "M"
+    source_file = os.path.join(args.directory, source_pool + ".img")
+    target_file = os.path.join(args.directory, target_pool + ".img")
+    key_file = os.path.join(args.directory, source_pool + ".key")
+
+    with open(key_file, "wb") as f:
+        f.write(os.urandom(32))
+
+    try:
+        run("truncate -s " + pool_size + " " + source_file)
+        run("truncate -s " + pool_size + " " + target_file)
+        run("zpool create -O compression=lz4 -O recordsize=1M " + source_pool + " " + source_file)
+        run("zpool create " + target_pool + " " + target_file)
+        run("zfs create " + source_pool + "/plain")
+        run("zfs create -o encryption=aes-256-gcm -o keyformat=raw -o keylocation=file://" + key_file + " " + source_pool + "/encrypted")
+
+        for dataset in ["plain", "encrypted"]:
+            fill("/" + source_pool + "/" + dataset + "/data", args.size_mib*1024*1024)
+
+        run("zfs snapshot -r " + source_pool + "@bench")
+
+        print("%-12s %-34s %10s %14s" % ("dataset", "mode", "seconds", "MiB on wire"))
+
+        for dataset in ["plain", "encrypted"]:
+            for name,options in modes:
+                flags = backup_functions.send_flags({"send-options": options})
+                cmd_send = "zfs send " + flags + source_pool + "/" + dataset + "@bench"
+                cmd_recv = "zfs recv -u " + target_pool + "/" + dataset
+
+                seconds,size = send_and_receive(cmd_send, cmd_recv)
+                print("%-12s %-34s %10.2f %14.1f" % (dataset, name, seconds, size / 1024 / 1024), flush=True)
+
+                run("zfs destroy -r " + target_pool + "/" + dataset)
+    finally:
+        subprocess.run(["zpool", "destroy", source_pool], stderr=subprocess.DEVNULL)
+        subprocess.run(["zpool", "destroy", target_pool], stderr=subprocess.DEVNULL)
+
+        for path in [source_file, target_file, key_file]:
+            if os.path.exists(path):
+                os.remove(path)
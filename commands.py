@@ -0,0 +1,211 @@
+import os
+import time
+import signal
+import threading
+import subprocess
+
+import common
+import metrics
+
+# All external commands (zfs, zpool, cryptsetup, sgdisk, systemctl, sendmail,
+# ...) are started through this module. run() and popen() take the same
+# arguments as subprocess.run() and subprocess.Popen(), and in addition:
+#
+# - Each command runs in its own process group, so that it and everything it
+#   started can be killed together: when its timeout expires or when the run
+#   is cancelled with cancel_all() (on Ctrl-C or SIGTERM). After that only
+#   the commands needed to clean up (cleanup_classes) are started, the others
+#   fail at once.
+# - The timeout depends on the class of the command, the tool and for tools
+#   with subcommands the subcommand ("zfs list", "cryptsetup open", "sgdisk").
+#   The defaults can be changed with the setting
+#     "command-timeouts": {"default": 3600, "cryptsetup open": 120, "zfs recv": null}
+#   in seconds, null for no timeout. A command that times out is killed and
+#   run() returns it as failed, with the timeout in stderr.
+# - The latency of each command is added to a histogram per class, in the
+#   metrics file and in summary().
+#
+# Interactive commands (an editor, cryptsetup asking for a passphrase) stay in
+# the foreground process group to have the terminal and have no timeout.
+
+default_timeouts = {
+    "default": 3600,
+    "cryptsetup open": 300,
+    "cryptsetup close": 300,
+    # streams last as long as the transfer
+    "zfs send": None,
+    "zfs recv": None,
+    "zfs diff": None,
+    "zpool wait": None
+}
+
+# the class of these includes the subcommand
+subcommand_tools = ["zfs", "zpool", "cryptsetup", "systemctl"]
+
+# upper bounds of the latency buckets, in seconds
+latency_buckets = [0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, 300, 1800]
+
+# seconds between SIGTERM and SIGKILL to the process group
+kill_grace_period = 10
+
+# still run after cancel_all(), to remove the temporary snapshots and leave
+# the disks exported and closed
+cleanup_classes = ["zpool list", "zpool export", "cryptsetup close", "zfs list", "zfs destroy"]
+
+running = set()     # Process
+cancelled = False
+running_lock = threading.Lock()
+
+def command_class(args):
+    words = args.split() if type(args) == str else [str(arg) for arg in args]
+    tool = os.path.basename(words[0]) if len(words) > 0 else str()
+
+    if tool in subcommand_tools:
+        subcommands = [word for word in words[1:] if not word.startswith('-')]
+        if len(subcommands) > 0:
+            return tool + " " + subcommands[0]
+    return tool
+
+def get_timeout(command_class_name):
+    settings = common.get_settings()
+    timeouts = dict(default_timeouts)
+    if settings != None and "command-timeouts" in settings.keys():
+        timeouts.update(settings["command-timeouts"])
+
+    return timeouts[command_class_name] if command_class_name in timeouts.keys() else timeouts["default"]
+
+# A subprocess.Popen in its own process group which is killed if it is not
+# done after the timeout of its class, and whose latency is recorded when it
+# has been waited for
+class Process(subprocess.Popen):
+    def __init__(self, args, interactive=False, **popen_arguments):
+        self.command_class = command_class(args)
+        self.started = time.monotonic()
+        self.recorded = False
+        self.timed_out = False
+        self.timer = None
+
+        super().__init__(args, start_new_session=not interactive, **popen_arguments)
+        self.own_group = not interactive
+
+        # cancel_all() either sees this process or it is killed here
+        with running_lock:
+            running.add(self)
+            kill = cancelled and self.command_class not in cleanup_classes
+        if kill:
+            self.kill_group()
+
+        timeout = get_timeout(self.command_class) if not interactive else None
+        if timeout != None:
+            self.timer = threading.Timer(timeout, self.expire, args=(timeout,))
+            self.timer.daemon = True
+            self.timer.start()
+
+    def expire(self, timeout):
+        if self.poll() == None:
+            self.timed_out = True
+            print("Command \"" + " ".join([str(arg) for arg in self.args]) + "\" timed out after " + str(timeout) + " s, killing it", flush=True)
+            self.kill_group()
+
+    # SIGTERM to the process group, then SIGKILL if it is still running after
+    # the grace period. Does not wait longer than that, a process stuck in
+    # the kernel can not be killed.
+    def kill_group(self):
+        if not self.own_group:
+            self.kill()
+            return
+
+        for signal_number,wait_time in [(signal.SIGTERM, kill_grace_period), (signal.SIGKILL, kill_grace_period)]:
+            try:
+                os.killpg(self.pid, signal_number)
+            except ProcessLookupError:
+                return
+            try:
+                super().wait(wait_time)
+                return
+            except subprocess.TimeoutExpired:
+                pass
+
+    def finished(self):
+        with running_lock:
+            if self.recorded:
+                return
+            self.recorded = True
+            running.discard(self)
+
+        if self.timer != None:
+            self.timer.cancel()
+
+        metrics.observe("command_duration_seconds", {"command": self.command_class}, time.monotonic() - self.started,
+                        "Duration of the external commands", latency_buckets)
+
+    def poll(self):
+        returncode = super().poll()
+        if returncode != None:
+            self.finished()
+        return returncode
+
+    def wait(self, timeout=None):
+        returncode = super().wait(timeout)
+        self.finished()
+        return returncode
+
+def popen(args, interactive=False, **popen_arguments):
+    if cancelled and command_class(args) not in cleanup_classes:
+        raise Exception("Not running \"" + " ".join([str(arg) for arg in args]) + "\", the run has been cancelled")
+
+    return Process(args, interactive, **popen_arguments)
+
+# Like subprocess.run. If timeout is given it is used instead of the timeout
+# of the class and subprocess.TimeoutExpired is raised when it expires, as
+# with subprocess.run.
+def run(args, input=None, timeout=None, interactive=False, **popen_arguments):
+    if input != None:
+        popen_arguments["stdin"] = subprocess.PIPE
+
+    with popen(args, interactive, **popen_arguments) as process:
+        try:
+            stdout,stderr = process.communicate(input, timeout=timeout)
+        except BaseException:
+            # the timeout or for example KeyboardInterrupt
+            process.kill_group()
+            process.finished()
+            raise
+
+    if process.timed_out and popen_arguments.get("stderr") == subprocess.PIPE:
+        stderr = (stderr if stderr != None else b"") + ("timed out after " + str(get_timeout(process.command_class)) + " s").encode("utf-8")
+
+    return subprocess.CompletedProcess(process.args, process.returncode, stdout, stderr)
+
+# Kills all running commands and refuses to start new ones except for
+# cleanup_classes, for example when the run is interrupted
+def cancel_all():
+    global cancelled
+
+    with running_lock:
+        cancelled = True
+        processes = list(running)
+
+    for process in processes:
+        if process.poll() == None:
+            print("Stopping \"" + " ".join([str(arg) for arg in process.args]) + "\"", flush=True)
+            process.kill_group()
+
+# A table of the number and duration of the commands per class, the classes
+# that took the most time first
+def summary():
+    histograms = metrics.get_histograms("command_duration_seconds")
+    if len(histograms) == 0:
+        return None
+
+    columns = [(0, 0.1, "<0.1s"), (0.1, 1, "<1s"), (1, 10, "<10s"), (10, 60, "<1m"), (60, float("inf"), ">=1m")]
+    lines = ["Commands",
+             "  %-24s %5s %9s %8s %8s " % ("Command", "Count", "Seconds", "Mean", "Max") + " ".join(["%6s" % label for lower,upper,label in columns])]
+
+    for labels,histogram in sorted(histograms.items(), key=lambda item: -item[1].sum):
+        counts = [histogram.count_between(lower, upper) for lower,upper,label in columns]
+        counts[-1] += histogram.count - sum(counts)    # above the largest bucket
+        lines.append("  %-24s %5d %9.1f %8.3f %8.3f " % (dict(labels)["command"], histogram.count, histogram.sum, histogram.sum / histogram.count, histogram.max) +
+                     " ".join(["%6d" % count for count in counts]))
+
+    return "\n".join(lines)
@@ -1,8 +1,18 @@
 import os.path
+import sys
+import time
+import io
 import json
+import threading
+import traceback
+import contextlib
+import concurrent.futures
 
 import pool
 import luks
+import disks
+import tracing
+import metrics
 
 settings_filepath = str()
 settings = None
@@ -22,25 +32,152 @@ def save_settings():
     with open(settings_filepath,'w') as json_file:
         json.dump(settings, json_file, indent=3)
 
+# Output from functions run by run_in_parallel is collected per thread and
+# printed in one piece when the function returns, so that the output of
+# different disks does not get interleaved. Output of threads that are not
+# buffered waits while another thread uses the console (direct_output).
+class ThreadOutput:
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+        
+    def write(self, text):
+        buffer = getattr(self.local, "buffer", None)
+        if buffer != None:
+            return buffer.write(text)
+        else:
+            with output_lock:
+                return self.stream.write(text)
+            
+    def flush(self):
+        if getattr(self.local, "buffer", None) == None:
+            self.stream.flush()
+            
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+output_lock = threading.RLock()
+thread_output = None
+
+def start_buffered_output():
+    global thread_output
+    
+    with output_lock:
+        if thread_output == None:
+            thread_output = ThreadOutput(sys.stdout)
+            sys.stdout = thread_output
+            sys.stderr = thread_output # stderr ends up in the same buffer to keep the order
+            
+    thread_output.local.buffer = io.StringIO()
+
+# Prints the output collected so far. If wait is False and the console is
+# used by another thread (direct_output), the output stays in the buffer, so
+# that for example a transfer does not stop while a question is asked.
+def flush_buffered_output(wait=False):
+    buffer = getattr(thread_output.local, "buffer", None) if thread_output != None else None
+    
+    if buffer != None and buffer.tell() > 0:
+        if not output_lock.acquire(blocking=wait):
+            return
+        try:
+            thread_output.stream.write(buffer.getvalue())
+            thread_output.stream.flush()
+        finally:
+            output_lock.release()
+        buffer.seek(0)
+        buffer.truncate()
+
+def end_buffered_output():
+    flush_buffered_output(True)
+    thread_output.local.buffer = None
+
+# Write directly to the console while inside this block, for example when
+# asking the user a question. Only one thread at a time may do this.
+@contextlib.contextmanager
+def direct_output():
+    with output_lock:
+        buffered = thread_output != None and getattr(thread_output.local, "buffer", None) != None
+        if buffered:
+            flush_buffered_output()
+            thread_output.local.buffer = None
+        try:
+            yield
+        finally:
+            if buffered:
+                thread_output.local.buffer = io.StringIO()
+
+def run_buffered(function, item):
+    if thread_output != None and getattr(thread_output.local, "buffer", None) != None:
+        # already buffered by the caller
+        return function(item)
+    
+    start_buffered_output()
+    try:
+        return function(item)
+    finally:
+        end_buffered_output()
+
+# Call function(item) for each item using at most max_workers threads and
+# return the results in the same order as items. The output is buffered also
+# when the items are run one after the other in this thread, another thread
+# may be asking the user for the approval.
+def run_in_parallel(function, items, max_workers):
+    if max_workers <= 1 or len(items) <= 1:
+        return [run_buffered(function, item) for item in items]
+    
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(run_buffered, function, item) for item in items]
+        
+    return [future.result() for future in futures]
+
+def format_bytes(num_bytes):
+    for unit in ["B", "KiB", "MiB", "GiB", "TiB"]:
+        if num_bytes < 1024 or unit == "TiB":
+            break
+        num_bytes /= 1024
+    
+    if unit == "B":
+        return str(num_bytes) + " B"
+    else:
+        return "%.1f %s" % (num_bytes, unit)
+
+# The cachefile of the pool of the disk in the directory in the setting
+# "pool-cachefile-directory", None if that is not set
+def get_pool_cachefile(disk):
+    if settings == None or "pool-cachefile-directory" not in settings.keys():
+        return None
+    
+    return os.path.join(settings["pool-cachefile-directory"], disk["zpool"] + ".cache")
+
 def open_luks_and_import_pool(disk, print_depth):
     name = disk["zpool"]
     ident = disk["id"]
     luksname = disk["luks"]
     luks_keyfile = disk["luks-keyfile"]
 
-    luks_path = "/dev/mapper/" + luksname
-    partpath = "/dev/disk/by-id/" + ident
+    luks_path = disks.mapper_path(luksname)
+    partpath = disks.disk_path(ident)
     if not os.path.exists(luks_path):
         print("  "*print_depth + "Opening LUKS container: " + luks_path)
-        retval,errormsg = luks.luksopen(partpath, luksname, luks_keyfile)
-        if retval != 0:
-            raise Exception(errormsg)
+        with tracing.span("luks-open", disk=name):
+            retval,errormsg = luks.luksopen(partpath, luksname, luks_keyfile)
+            if retval != 0:
+                raise Exception(errormsg)
     else:
         print("  "*print_depth + "LUKS container already open: " + luks_path)
         
     if not pool.pool_is_imported(name):
-        print("  "*print_depth + "Importing pool: " + name)
-        pool.import_pool(name)
+        print("  "*print_depth + "Importing pool: " + name, flush=True)
+        start = time.monotonic()
+        with tracing.span("pool-import", disk=name) as import_span:
+            method,errors = pool.import_pool(name, luks_path, get_pool_cachefile(disk))
+            import_span.attributes["method"] = method
+        seconds = time.monotonic() - start
+        
+        for errormsg in errors:
+            print("  "*print_depth + "  Import through " + errormsg, flush=True)
+        print("  "*print_depth + "  Imported in %.1f s (%s)" % (seconds, "from cachefile" if method == "cachefile" else ("searched " + luks_path if method == "device" else "searched all devices")), flush=True)
+        metrics.set_value("pool_import_seconds", {"pool": name}, round(seconds, 3), "Duration of the last import of the pool")
     else:
         print("  "*print_depth + "Pool already imported: " + name)
         
@@ -50,15 +187,50 @@ def export_pool_and_close_luks(disk, print_depth):
 
     if pool.pool_is_imported(name):
         print("  "*print_depth + "Exporting pool: " + name)
-        pool.export_pool(name)
+        with tracing.span("pool-export", disk=name):
+            pool.export_pool(name)
     else:
         print("  "*print_depth + "Pool already exported: " + name)
 
-    luks_path = "/dev/mapper/" + luksname
+    luks_path = disks.mapper_path(luksname)
     if os.path.exists(luks_path):
         print("  "*print_depth + "Closing LUKS container: " + luks_path)
-        retval,errormsg = luks.luksclose(luksname)
-        if retval != 0:
-            raise Exception(errormsg)
+        with tracing.span("luks-close", disk=name):
+            retval,errormsg = luks.luksclose(luksname)
+            if retval != 0:
+                raise Exception(errormsg)
     else:
         print("  "*print_depth + "LUKS container already closed: " + luks_path)
+
+# Number of disks that are opened and imported, or exported and closed, at
+# the same time (setting "parallel-bring-up"). Opening a LUKS container runs
+# its PBKDF, which takes a second or two of CPU and with argon2 up to 1 GiB of
+# memory.
+def get_parallel_bring_up():
+    return settings["parallel-bring-up"] if settings != None and "parallel-bring-up" in settings.keys() else 4
+
+# Calls function(disk) for the disks, get_parallel_bring_up() at a time. The
+# output of each disk is printed in one piece. An exception only fails its
+# own disk and is printed with its traceback. Returns the list of results
+# (None for failed disks) and the list of failed disks, in the order of
+# disk_list.
+def run_for_disks(function, disk_list, print_depth):
+    def run(disk):
+        try:
+            return (function(disk), False)
+        except Exception as e:
+            traceback.print_exc()
+            print("  "*print_depth + "Failed for pool " + disk["zpool"] + ": " + type(e).__name__ + ": " + str(e).strip(), flush=True)
+            return (None, True)
+    
+    outcomes = run_in_parallel(run, disk_list, get_parallel_bring_up())
+    
+    return [result for result,failed in outcomes], [disk for disk,(result,failed) in zip(disk_list, outcomes) if failed]
+
+# returns the list of disks that could not be opened and imported
+def open_luks_and_import_pools(disk_list, print_depth):
+    return run_for_disks(lambda disk: open_luks_and_import_pool(disk, print_depth), disk_list, print_depth)[1]
+
+# returns the list of disks that could not be exported and closed
+def export_pools_and_close_luks(disk_list, print_depth):
+    return run_for_disks(lambda disk: export_pool_and_close_luks(disk, print_depth), disk_list, print_depth)[1]
@@ -67,7 +67,7 @@ def remove_pools(disks):
             print("    Deleting snapshot '" + snapshot + "': ", end="", flush=True)
             if snapshot != latest_approved:
                 try:
-                    backup_functions.delete_snapshot(pool_to_backup, snapshot)
+                    deleted = backup_functions.release_snapshot(pool_to_backup, snapshot, pool)
                     error = False
                 except Exception as e:
                     error = True
@@ -76,8 +76,10 @@ def remove_pools(disks):
                 if error:
                     print(errormsg)
                     all_snapshots_deleted = False
-                else:
+                elif deleted:
                     print("done")
+                else:
+                    print("released, still used by other disks")
             else:
                 print("failed. This is the latest approved snapshot. Perform a backup to another disk and then issue --remove again.")
                 all_snapshots_deleted = False
@@ -89,11 +91,11 @@ def remove_pools(disks):
             common.save_settings()
             print("done")
 
-def destroy_pools(disks):
+def destroy_pools(disks_to_destroy):
     destroyed_disks = list()
-    for disk in disks:
+    for disk in disks_to_destroy:
         print("  Destroying '" + disk["zpool"] + "'...", end="", flush=True)
-        partpath = "/dev/disk/by-id/" + disk["id"]
+        partpath = disks.disk_path(disk["id"])
         keyfile = disk["luks-keyfile"]
         retval,errormsg = luks.lukserase(partpath, keyfile)
         
@@ -0,0 +1,116 @@
+import os
+import json
+import gzip
+import shutil
+import threading
+import time
+
+import common
+
+# A cache on disk of the diffs of single datasets, so that a run after a
+# failed or timed out approval does not have to run zfs diff again for
+# datasets that have not changed since.
+#
+# An entry is stored under (dataset, guid of the previous snapshot, guid of
+# the new snapshot). The new snapshot is a new temporary snapshot in every
+# run, so an entry is also used for a new snapshot with another guid if the
+# bytes written since the previous snapshot and the bytes referenced are the
+# same as when the entry was stored. Entries stored with other diff rules
+# (see diffrules) are not used. The least recently used entries are removed
+# when the cache grows beyond its size.
+
+index_filename = "index.json"
+
+class DiffCache:
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        
+        os.makedirs(directory, exist_ok=True)
+        
+        try:
+            with open(os.path.join(directory, index_filename)) as index_file:
+                self.index = json.load(index_file)
+        except (OSError, ValueError):
+            self.index = dict()
+        
+    def save_index(self):
+        filepath = os.path.join(self.directory, index_filename)
+        with open(filepath + ".tmp", "w") as index_file:
+            json.dump(self.index, index_file)
+        os.replace(filepath + ".tmp", filepath)
+    
+    # Copies the cached diff to diff_file and returns True, or returns False if
+    # there is no usable entry
+    def lookup(self, dataset, prev_guid, new_guid, written, referenced, rules_signature, diff_file):
+        with self.lock:
+            for key,entry in self.index.items():
+                if entry["dataset"] == dataset and entry["prev-guid"] == prev_guid and entry.get("rules", "") == rules_signature and \
+                   (entry["new-guid"] == new_guid or (entry["written"] == written and entry["referenced"] == referenced)):
+                    try:
+                        with gzip.open(os.path.join(self.directory, entry["file"]), "rt", encoding="utf-8") as cached_file:
+                            shutil.copyfileobj(cached_file, diff_file)
+                    except OSError:
+                        # the file has been removed or is damaged, forget the entry
+                        diff_file.seek(0)
+                        diff_file.truncate()
+                        del self.index[key]
+                        self.save_index()
+                        return False
+                    
+                    entry["used"] = time.time()
+                    self.save_index()
+                    return True
+                
+        return False
+    
+    # Stores the content of diff_file, which is left at its end
+    def store(self, dataset, prev_guid, new_guid, written, referenced, rules_signature, diff_file):
+        key = dataset + "\t" + prev_guid + "\t" + new_guid
+        filename = prev_guid + "-" + new_guid + ".diff.gz"
+        
+        diff_file.seek(0)
+        with gzip.open(os.path.join(self.directory, filename), "wt", encoding="utf-8") as cached_file:
+            shutil.copyfileobj(diff_file, cached_file)
+        
+        with self.lock:
+            self.index[key] = {"dataset": dataset, "prev-guid": prev_guid, "new-guid": new_guid,
+                               "written": written, "referenced": referenced, "rules": rules_signature, "file": filename,
+                               "size": os.path.getsize(os.path.join(self.directory, filename)), "used": time.time()}
+            self.evict()
+            self.save_index()
+    
+    # removes the least recently used entries until the cache fits in max_size
+    def evict(self):
+        total_size = sum([entry["size"] for entry in self.index.values()])
+        
+        for key,entry in sorted(self.index.items(), key=lambda item: item[1]["used"]):
+            if total_size <= self.max_size:
+                break
+            
+            try:
+                os.remove(os.path.join(self.directory, entry["file"]))
+            except FileNotFoundError:
+                pass
+            
+            total_size -= entry["size"]
+            del self.index[key]
+
+diff_cache = None
+diff_cache_lock = threading.Lock()
+
+# returns the DiffCache for the setting "diff-cache", or None if it is not set
+def get_diff_cache():
+    global diff_cache
+    
+    settings = common.get_settings()
+    
+    if "diff-cache" not in settings.keys():
+        return None
+    
+    with diff_cache_lock:
+        if diff_cache == None:
+            cache_settings = settings["diff-cache"]
+            diff_cache = DiffCache(cache_settings["directory"], cache_settings["size-mib"]*1024*1024)
+        return diff_cache
@@ -0,0 +1,86 @@
+import re
+import fnmatch
+import threading
+
+import common
+
+# Paths in the diff that are not shown or do not need approval, from the
+# setting "diff-rules", for example
+#   "diff-rules": {
+#      "tank/home": {"ignore": ["*/.cache/*", "*/.thumbnails/*"], "auto-approve": ["*.log"]}
+#   }
+# The patterns are shell-style wildcards (see fnmatch) matched against the
+# whole path from zfs diff, where * also matches /. The rules of a dataset
+# also apply to all datasets below it.
+#
+# Ignored changes are left out of the diff. Auto-approved changes are also
+# left out, but they are counted and the count is shown. A diff with only
+# ignored and auto-approved changes does not need approval.
+
+class DiffRules:
+    def __init__(self, ignore_patterns, auto_approve_patterns):
+        # the patterns of each kind are compiled into one regular expression
+        self.ignore_regex = compile_patterns(ignore_patterns)
+        self.approve_regex = compile_patterns(auto_approve_patterns)
+        self.signature = repr((sorted(ignore_patterns), sorted(auto_approve_patterns)))
+    
+    # returns "ignore", "approve" or None
+    def match(self, path):
+        if self.ignore_regex != None and self.ignore_regex.search(path):
+            return "ignore"
+        elif self.approve_regex != None and self.approve_regex.search(path):
+            return "approve"
+        else:
+            return None
+
+def compile_patterns(patterns):
+    if len(patterns) == 0:
+        return None
+    return re.compile("|".join([translate(pattern) for pattern in patterns]), re.DOTALL)
+
+# Translates a pattern to a regular expression used with search(). A leading
+# or trailing * becomes an unanchored end instead of .*, which is much faster
+# than matching the whole path.
+def translate(pattern):
+    start = "\\A"
+    end = "\\Z"
+    
+    if pattern.startswith("*"):
+        pattern = pattern[1:]
+        start = str()
+    if pattern.endswith("*"):
+        pattern = pattern[:-1]
+        end = str()
+    
+    # fnmatch.translate gives (?s:...)\Z, or (?s:...)\z in newer versions
+    regex = fnmatch.translate(pattern)
+    regex = regex[len("(?s:"):-len(")\\Z")]
+    
+    return "(?:" + start + regex + end + ")"
+
+compiled_rules = dict()
+compiled_rules_lock = threading.Lock()
+
+# returns the DiffRules of a dataset, or None if there are no rules for it
+def get_rules(dataset):
+    settings = common.get_settings()
+    
+    if "diff-rules" not in settings.keys():
+        return None
+    
+    with compiled_rules_lock:
+        if dataset not in compiled_rules:
+            ignore_patterns = list()
+            auto_approve_patterns = list()
+            
+            for rules_dataset,rules in settings["diff-rules"].items():
+                if dataset == rules_dataset or dataset.startswith(rules_dataset + "/"):
+                    ignore_patterns += rules.get("ignore", list())
+                    auto_approve_patterns += rules.get("auto-approve", list())
+            
+            if len(ignore_patterns) > 0 or len(auto_approve_patterns) > 0:
+                compiled_rules[dataset] = DiffRules(ignore_patterns, auto_approve_patterns)
+            else:
+                compiled_rules[dataset] = None
+                
+        return compiled_rules[dataset]
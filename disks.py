@@ -1,22 +1,42 @@
 import subprocess
 import os.path
 
+import common
+import commands
+
+# The directories of the disk and LUKS device nodes can be changed with the
+# setting "device-directories", for example to run against the simulated
+# tools in sim/
+default_device_directories = {"disk-by-id": "/dev/disk/by-id", "mapper": "/dev/mapper"}
+
+def device_directory(name):
+    settings = common.get_settings()
+    directories = settings["device-directories"] if settings != None and "device-directories" in settings.keys() else dict()
+    
+    return directories[name] if name in directories.keys() else default_device_directories[name]
+
+def disk_path(ident):
+    return os.path.join(device_directory("disk-by-id"), ident)
+
+def mapper_path(luksname):
+    return os.path.join(device_directory("mapper"), luksname)
+
 def zap_disk(devicepath):
     cmd = "sgdisk --zap-all " + devicepath
-    cpinst = subprocess.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    cpinst = commands.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     
     return (cpinst.returncode, "Error in \"" + cmd + "\":" + cpinst.stderr.decode("utf-8"))
     
 def create_partition(devicepath, partname):
     cmd = "sgdisk -n0:0:0 -t0:8300 -c0:"+partname+" "+ devicepath
-    cpinst = subprocess.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    cpinst = commands.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     
     return (cpinst.returncode, "Error in \"" + cmd + "\":" + cpinst.stderr.decode("utf-8"))
     
 def get_present_disks(disks):
     present_disks = []
     for disk in disks:
-        if os.path.exists("/dev/disk/by-id/" + disk["id"]):
+        if os.path.exists(disk_path(disk["id"])):
             present_disks.append(disk)
     return present_disks
 
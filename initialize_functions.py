@@ -2,6 +2,7 @@ import os
 import subprocess
 
 import common
+import commands
 import luks
 import disks
 import pool
@@ -20,7 +21,9 @@ def initialize(diskname, partname, poolname):
         print("Backup pool '"+poolname+"' already exist. Aborting.")
         sys.exit(1)
     else:
-        init_disk = {"zpool": poolname, "id": partname, "luks": "luks-"+partname, "luks-keyfile": "/keys/"+partname+".key"}
+        # plain zfs send by default, the send options can be turned on per disk in the config
+        init_disk = {"zpool": poolname, "id": partname, "luks": "luks-"+partname, "luks-keyfile": "/keys/"+partname+".key",
+                     "send-options": {"compressed": False, "large-block": False, "embedded": False, "raw": False}}
 
         if initialize_disk(diskname, init_disk) == 0:
             settings["backup-disks"].append(init_disk)
@@ -33,10 +36,10 @@ def initialize(diskname, partname, poolname):
                 print("Skipping.", flush=True)
             
 def initialize_disk(diskname, diskrec):
-    diskpath = "/dev/disk/by-id/"+diskname
-    partpath = "/dev/disk/by-id/"+diskrec["id"]
+    diskpath = disks.disk_path(diskname)
+    partpath = disks.disk_path(diskrec["id"])
     partname = diskrec["id"]
-    lukspath = "/dev/mapper/"+diskrec["luks"]
+    lukspath = disks.mapper_path(diskrec["luks"])
     luksname = diskrec["luks"]
     keypath = diskrec["luks-keyfile"]
     poolname = diskrec["zpool"]
@@ -121,7 +124,7 @@ def enable_attach_script(disks, print_depth):
         # Enable the service
         print("  "*print_depth + "  Enabling the service...", end="", flush=True)
         cmd = "systemctl enable " + servicefile_name
-        cpinst = subprocess.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        cpinst = commands.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         
         if cpinst.returncode != 0:
             print("error.", flush=True)
@@ -132,7 +135,7 @@ def enable_attach_script(disks, print_depth):
         # Reload systemd
         print("  "*print_depth + "  systemctl daemon-reload...", end="", flush=True)
         cmd = "systemctl daemon-reload"
-        cpinst = subprocess.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        cpinst = commands.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         
         if cpinst.returncode != 0:
             print("error.", flush=True)
@@ -154,7 +157,7 @@ def remove_attach_script(disks, print_depth):
         # Disable the service
         print("  "*print_depth + "  Disabling the service...", end="", flush=True)
         cmd = "systemctl disable " + servicefile_name
-        cpinst = subprocess.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        cpinst = commands.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         
         if cpinst.returncode != 0:
             print("error.", flush=True)
@@ -2,41 +2,43 @@ import subprocess
 import re
 import os
 
+import commands
+
 # luks functions
 
 def luksformat(partpath):
     cmd = "cryptsetup luksFormat -c aes-xts-plain64 -s 256 -h sha256 "+partpath
-    cpinst = subprocess.run(cmd.split())
+    cpinst = commands.run(cmd.split(), interactive=True)
     
     return (cpinst.returncode, "Error in \"" + cmd + "\"")
 
 def lukscreatekeyfile(keypath):
     cmd = "dd if=/dev/urandom of="+keypath+" bs=1024 count=4"
-    cpinst = subprocess.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    cpinst = commands.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     
     if cpinst.returncode != 0:
         return (cpinst.returncode, "Error in \"" + cmd + "\": " + cpinst.stderr.decode("utf-8"))
     
     cmd = "chmod 0400 "+keypath
-    cpinst = subprocess.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    cpinst = commands.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     
     return (cpinst.returncode, "Error in \"" + cmd + "\": " + cpinst.stderr.decode("utf-8"))
 
 def luksaddkey(partpath, keypath):
     cmd = "cryptsetup luksAddKey "+partpath+" "+keypath
-    cpinst = subprocess.run(cmd.split())
+    cpinst = commands.run(cmd.split(), interactive=True)
     
     return (cpinst.returncode, "Error in \"" + cmd + "\"")
 
 def luksopen(partpath, luksname, luks_keyfile):
     cmd = "cryptsetup open --type luks --key-file " + luks_keyfile + " " + partpath + " " + luksname
-    cpinst = subprocess.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    cpinst = commands.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     
     return (cpinst.returncode, "Error in \"" + cmd + "\": " + cpinst.stderr.decode("utf-8"))
 
 def luksclose(luksname):
     cmd = "cryptsetup close " + luksname
-    cpinst = subprocess.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    cpinst = commands.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     
     return (cpinst.returncode, "Error in \"" + cmd + "\": " + cpinst.stderr.decode("utf-8"))
 
@@ -66,7 +68,7 @@ def lukserase(partpath, keyfile):
     
 def erase_keys(partpath):
     cmd = "cryptsetup luksErase -v -q "+partpath
-    cpinst = subprocess.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    cpinst = commands.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     
     return (cpinst.returncode, "Error in \"" + cmd + "\": " + cpinst.stdout.decode("utf-8"))
     
@@ -92,7 +94,7 @@ def overwrite_header(partpath):
 
 def dump_header(partpath):
     cmd = "cryptsetup luksDump -v "+partpath
-    cpinst = subprocess.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    cpinst = commands.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     
     if cpinst.returncode != 0:
         return (cpinst.returncode, "Error in \"" + cmd + "\": " + cpinst.stdout.decode("utf-8"), '')
@@ -101,7 +103,7 @@ def dump_header(partpath):
 
 def overwrite_with_zeroes(partpath, blocksize, count):
     cmd = "dd if=/dev/zero of=" + partpath + " bs=" + str(blocksize) + " count=" + str(count)
-    cpinst = subprocess.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    cpinst = commands.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     
     if cpinst.returncode != 0:
         return (cpinst.returncode, "Error in \"" + cmd + "\":" + cpinst.stderr.decode("utf-8"), '')
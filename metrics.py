@@ -0,0 +1,112 @@
+import os
+import threading
+
+import common
+
+# Metrics in the Prometheus text format, written to the file in the setting
+# "metrics-file" (for example in the directory of the node_exporter textfile
+# collector) so that monitoring can follow long running operations.
+
+prefix = "zfs_offline_backup_"
+
+# name: (help, type, dict of label tuple: value), the value of a histogram is
+# a Histogram
+metrics = dict()
+metrics_lock = threading.Lock()
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets                  # upper bounds, ascending
+        self.counts = [0] * len(buckets)        # not cumulative
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        for index,bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    # the number of values in (lower, upper]
+    def count_between(self, lower, upper):
+        return sum([count for bound,count in zip(self.buckets, self.counts) if bound > lower and bound <= upper])
+
+    def lines(self, name, labels):
+        lines = list()
+        cumulative = 0
+        for bound,count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(name + "_bucket" + format_labels(labels + (("le", str(bound)),)) + " " + str(cumulative))
+        lines.append(name + "_bucket" + format_labels(labels + (("le", "+Inf"),)) + " " + str(self.count))
+        lines.append(name + "_sum" + format_labels(labels) + " " + str(self.sum))
+        lines.append(name + "_count" + format_labels(labels) + " " + str(self.count))
+        return lines
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return str()
+    return "{" + ",".join(key + "=\"" + str(value) + "\"" for key,value in labels) + "}"
+
+# Sets the metric name with the labels (a dict) to value and rewrites the
+# metrics file
+def set_value(name, labels, value, helptext, metric_type="gauge"):
+    with metrics_lock:
+        if name not in metrics.keys():
+            metrics[name] = (helptext, metric_type, dict())
+        metrics[name][2][tuple(sorted(labels.items()))] = value
+        
+        write_metrics()
+
+# Adds value to the histogram name with the labels (a dict). This is called
+# for every external command, so the metrics file is not rewritten here but
+# with the next set_value() or save().
+def observe(name, labels, value, helptext, buckets):
+    with metrics_lock:
+        if name not in metrics.keys():
+            metrics[name] = (helptext, "histogram", dict())
+        values = metrics[name][2]
+        key = tuple(sorted(labels.items()))
+        if key not in values.keys():
+            values[key] = Histogram(buckets)
+        values[key].observe(value)
+
+# Rewrites the metrics file, at the end of the run
+def save():
+    with metrics_lock:
+        write_metrics()
+
+# Returns a dict of label tuple: Histogram of the histogram name
+def get_histograms(name):
+    with metrics_lock:
+        return dict(metrics[name][2]) if name in metrics.keys() else dict()
+
+def write_metrics():
+    settings = common.get_settings()
+    
+    if settings == None or "metrics-file" not in settings.keys():
+        return
+    
+    filepath = settings["metrics-file"]
+    lines = list()
+    
+    for name,(helptext,metric_type,values) in sorted(metrics.items()):
+        lines.append("# HELP " + prefix + name + " " + helptext)
+        lines.append("# TYPE " + prefix + name + " " + metric_type)
+        for labels,value in values.items():
+            if metric_type == "histogram":
+                lines.extend(value.lines(prefix + name, labels))
+            else:
+                lines.append(prefix + name + format_labels(labels) + " " + str(value))
+    
+    # replace the file in one step so that it is never read half written
+    try:
+        with open(filepath + ".tmp", "w") as metrics_file:
+            metrics_file.write("\n".join(lines) + "\n")
+        os.replace(filepath + ".tmp", filepath)
+    except OSError as e:
+        # metrics must never stop a backup
+        print("Could not write metrics to " + filepath + ": " + str(e), flush=True)
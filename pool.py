@@ -1,64 +1,242 @@
-import subprocess
+import os
+import re
+import json
+import time
+import shutil
+import threading
+
+import zfsbackend
 
 # pool functions
 
 def create_pool(poolname, lukspath):
-    cmd = "zpool create -o ashift=12 "+poolname+" "+lukspath
-    cpinst = subprocess.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        zfsbackend.get_backend().create_pool(poolname, lukspath)
+        return (0, str())
+    except Exception as e:
+        return (1, str(e))
+    finally:
+        invalidate_pool_states()
     
-    return (cpinst.returncode, "Error in \"" + cmd + "\":" + cpinst.stderr.decode("utf-8"))
+# The state of all imported pools is read with one "zpool list" and one
+# "zpool status -x" and kept until it is invalidated by importing, exporting,
+# creating or scrubbing a pool, or by invalidate_pool_states().
+state_properties = ["name", "health", "size", "allocated", "free", "fragmentation", "capacity"]
+pool_states = None      # pool name: dict of the properties in state_properties
+unhealthy_pools = None  # pool name: the output of "zpool status -x" for the pool
+pool_state_lock = threading.RLock()
+
+def invalidate_pool_states():
+    global pool_states
+    global unhealthy_pools
     
-def pool_is_healthy(poolname):
-    cmd = "zpool status -x " + poolname
-    cpinst = subprocess.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    with pool_state_lock:
+        pool_states = None
+        unhealthy_pools = None
+
+# returns a dict of pool name: dict of property: value (as strings)
+def get_pool_states():
+    global pool_states
     
-    if cpinst.returncode != 0:
-        raise Exception("Error in \"" + cmd + "\":\n" + cpinst.stderr.decode("utf-8"))
+    with pool_state_lock:
+        if pool_states == None:
+            pool_states = dict()
+            for words in zfsbackend.get_backend().list_pools(state_properties):
+                if len(words) == len(state_properties):
+                    pool_states[words[0]] = dict(zip(state_properties, words))
+                
+        return pool_states
+
+# returns the dict of properties of the pool, or None if it is not imported
+def get_pool_state(poolname):
+    return get_pool_states().get(poolname, None)
+
+def get_unhealthy_pools():
+    global unhealthy_pools
+    
+    with pool_state_lock:
+        if unhealthy_pools == None:
+            # the output is "all pools are healthy" or one section per unhealthy
+            # pool, starting with "  pool: <name>"
+            unhealthy_pools = dict()
+            name = None
+            for line in zfsbackend.get_backend().unhealthy_pools_status().splitlines(keepends=True):
+                match = re.match(r"\s*pool: (\S+)", line)
+                if match:
+                    name = match.group(1)
+                    unhealthy_pools[name] = str()
+                if name != None:
+                    unhealthy_pools[name] += line
+                    
+        return unhealthy_pools
+
+# returns (healthy, status message) of an imported pool
+def pool_is_healthy(poolname):
+    if not pool_is_imported(poolname):
+        raise Exception("Can not check the health of pool " + poolname + ", it is not imported")
     
-    stdout = cpinst.stdout.decode("utf-8")
+    unhealthy = get_unhealthy_pools()
     
-    if stdout.find("is healthy") != -1:
-        return (True,stdout)
+    if poolname in unhealthy.keys():
+        return (False,unhealthy[poolname])
     else:
-        return (False,stdout)
+        return (True,"pool '" + poolname + "' is healthy\n")
 
+# returns True if the scrub could not be started
 def start_scrub(poolname):
-    cmd = "zpool scrub " + poolname
-    cpinst = subprocess.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    started = zfsbackend.get_backend().start_scrub(poolname)
     
-    if cpinst.returncode != 0:
-        return True
-    else:
-        return False
+    invalidate_pool_states()
+    
+    return not started
+
+# Blocks until the scrub of the pool is no longer running or timeout seconds
+# have passed. Returns False if this could not be done, for example with ZFS
+# versions without "zpool wait".
+def wait_scrub(poolname, timeout=None):
+    return zfsbackend.get_backend().wait_scrub(poolname, timeout)
+
+# Status of the last or current scrub of a pool. Sizes are in bytes, rate in
+# bytes per second and eta in seconds. Values that are not known are None.
+class ScrubStatus:
+    def __init__(self):
+        self.state = None       # "scanning", "finished", "canceled" or None if no scrub has been run
+        self.scanned = None
+        self.issued = None
+        self.total = None
+        self.rate = None
+        self.eta = None
+        self.repaired = None
+        self.errors = None
+        
+    def percent_done(self):
+        if self.issued == None or self.total == None or self.total == 0:
+            return None
+        return min(100.0, self.issued * 100 / self.total)
+
+# None until it is known if "zpool status -j" can be used
+json_status_supported = None
+
+def get_scrub_status(poolname):
+    global json_status_supported
+    
+    if json_status_supported != False:
+        output = zfsbackend.get_backend().pool_status_json(poolname)
+        
+        if output != None:
+            json_status_supported = True
+            return parse_scrub_status_json(output, poolname)
+        elif json_status_supported == None and pool_is_imported(poolname):
+            # the pool exists, so the options are not supported by this version of ZFS
+            json_status_supported = False
+        else:
+            raise Exception("Could not get the status of pool " + poolname)
+    
+    stdout = zfsbackend.get_backend().pool_status(poolname)
+    
+    return (parse_scrub_status_text(stdout), stdout)
+
+# returns (ScrubStatus, the scan part of the output)
+def parse_scrub_status_json(output, poolname):
+    status = ScrubStatus()
+    scan = output["pools"][poolname].get("scan_stats", None)
+    
+    if scan == None or scan["function"] != "SCRUB":
+        return (status, json.dumps(scan))
+    
+    status.state = {"SCANNING": "scanning", "FINISHED": "finished", "CANCELED": "canceled"}.get(scan["state"], None)
+    status.scanned = int(scan["examined"])
+    status.issued = int(scan["issued"])
+    status.total = int(scan["to_examine"])
+    status.repaired = int(scan["processed"])
+    status.errors = int(scan["errors"])
+    
+    if status.state == "scanning":
+        # the same calculation as zpool status: issued in this pass divided by
+        # the time it has not been paused
+        elapsed = time.time() - int(scan["pass_start"]) - int(scan["scrub_spent_paused"])
+        status.rate = int(scan["issued_bytes_per_scan"]) / max(1, elapsed)
+        if status.rate > 0:
+            status.eta = int(max(0, status.total - status.issued) / status.rate)
+    
+    return (status, json.dumps(scan))
+
+size_units = {"B": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4, "P": 1024**5, "E": 1024**6}
+size_pattern = r"([0-9.]+)([BKMGTPE]?)"
+
+def parse_size(number, unit):
+    return int(float(number) * size_units[unit if unit != "" else "B"])
+
+# Parses the "scan:" part of the text output from zpool status, for example
+#   scan: scrub in progress since Sun Jul 25 16:07:49 2021
+#         1.23T scanned at 1.00G/s, 512G issued at 400M/s, 3.00T total
+#         0B repaired, 16.67% done, 01:15:00 to go
+#   scan: scrub repaired 0B in 00:10:02 with 0 errors on Sun Jul 25 16:17:51 2021
+#   scan: scrub canceled on Sun Jul 25 16:10:00 2021
+def parse_scrub_status_text(stdout):
+    status = ScrubStatus()
+    
+    if stdout.find("scrub in progress") >= 0:
+        status.state = "scanning"
+    elif stdout.find("scrub canceled") >= 0:
+        status.state = "canceled"
+    elif stdout.find("scrub repaired") >= 0:
+        status.state = "finished"
+    
+    match = re.search(size_pattern + r" scanned(?: at " + size_pattern + r"/s)?", stdout)
+    if match:
+        status.scanned = parse_size(match.group(1), match.group(2))
+    
+    match = re.search(size_pattern + r" issued(?: at " + size_pattern + r"/s)?", stdout)
+    if match:
+        status.issued = parse_size(match.group(1), match.group(2))
+        if match.group(3) != None:
+            status.rate = parse_size(match.group(3), match.group(4))
+    
+    match = re.search(size_pattern + r" total", stdout)
+    if match:
+        status.total = parse_size(match.group(1), match.group(2))
+    
+    match = re.search(r"(?:scrub )?repaired " + size_pattern + r"|" + size_pattern + r" repaired", stdout)
+    if match:
+        status.repaired = parse_size(*(match.group(1,2) if match.group(1) != None else match.group(3,4)))
+    
+    match = re.search(r"with ([0-9]+) errors", stdout)
+    if match:
+        status.errors = int(match.group(1))
+    
+    match = re.search(r"(?:([0-9]+) days )?([0-9]+):([0-9]+):([0-9]+) to go", stdout)
+    if match:
+        days = int(match.group(1)) if match.group(1) != None else 0
+        status.eta = ((days * 24 + int(match.group(2))) * 60 + int(match.group(3))) * 60 + int(match.group(4))
+    
+    return status
 
+# returns (completed, error, errormsg, ScrubStatus)
 def check_scrub(poolname):
     errormsg = str()
     completed = False
     error = False
+    status = None
     
     try:
-        cmd = "zpool status " + poolname
-        cpinst = subprocess.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        
-        if cpinst.returncode != 0:
-            raise Exception("Error in \"" + cmd + "\":\n" + cpinst.stderr.decode("utf-8"))
+        status,output = get_scrub_status(poolname)
         
-        stdout = cpinst.stdout.decode("utf-8")
-        
-        if stdout.find("scrub in progress") >= 0:
+        if status.state == "scanning":
             completed = False
-        elif stdout.find("scrub canceled") >= 0:
+        elif status.state == "canceled":
             completed = True
             error = True
             errormsg = "Scrub aborted"
-        elif stdout.find("scrub repaired") >= 0:
+        elif status.state == "finished":
             completed = True
         else:
             completed = True
             error = True
-            errormsg = "Error in scrub status, this is the output from '" + cmd + "':\n" + stdout
+            errormsg = "Error in scrub status, this is the output from 'zpool status':\n" + output
         
         if completed:
+            invalidate_pool_states()
             healthy, msg = pool_is_healthy(poolname)
         
             if not healthy:
@@ -69,34 +247,49 @@ def check_scrub(poolname):
         errormsg = str(e)
         error = True
 
-    return completed,error,errormsg
+    return completed,error,errormsg,status
     
 def pool_is_imported(poolname):
-    cmd = "zpool list -H"
-    cpinst = subprocess.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    
-    if cpinst.returncode != 0:
-        raise Exception("Error in \"" + cmd + "\":" + cpinst.stderr.decode("utf-8"))
-    
-    stdout = cpinst.stdout.decode("utf-8")
-    
-    for line in stdout.splitlines():
-        words = line.split('\t')
-        if words[0] == poolname:
-            return True
-    
-    return False
+    return get_pool_state(poolname) != None
 
-def import_pool(name):
-    cmd = "zpool import -N " + name
-    cpinst = subprocess.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+# Imports the pool. Without device "zpool import" reads the labels of every
+# block device of the host to find it, which takes seconds with many disks.
+# With device only that device is searched. With cachefile the configuration
+# of the pool is kept in that file, and a copy of it (cachefile + ".import",
+# ZFS removes the pool from the cachefile on export) is read at the next import
+# instead of searching at all. If the faster way fails the slower one is tried.
+# Returns (the way it was imported: "cachefile", "device" or "scan", list of
+# the errors of the ways that failed).
+def import_pool(name, device=None, cachefile=None):
+    backend = zfsbackend.get_backend()
+    attempts = list()
+    errors = list()
     
-    if cpinst.returncode != 0:
-        raise Exception("Error in \"" + cmd + "\":" + cpinst.stderr.decode("utf-8"))
+    if cachefile != None and os.path.exists(cachefile + ".import"):
+        attempts.append(("cachefile", {"read_cachefile": cachefile + ".import"}))
+    if device != None:
+        attempts.append(("device", {"device": device}))
+    attempts.append(("scan", dict()))
+    
+    try:
+        for method,arguments in attempts:
+            try:
+                backend.import_pool(name, cachefile=cachefile, **arguments)
+                break
+            except Exception as e:
+                if method == "scan":
+                    raise
+                errors.append(method + ": " + str(e).strip())
+        
+        if cachefile != None and os.path.exists(cachefile):
+            shutil.copyfile(cachefile, cachefile + ".import")
+        
+        return (method, errors)
+    finally:
+        invalidate_pool_states()
         
 def export_pool(name):
-    cmd = "zpool export " + name
-    cpinst = subprocess.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    
-    if cpinst.returncode != 0:
-        raise Exception("Error in \"" + cmd + "\":" + cpinst.stderr.decode("utf-8"))
+    try:
+        zfsbackend.get_backend().export_pool(name)
+    finally:
+        invalidate_pool_states()
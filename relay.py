@@ -0,0 +1,223 @@
+import os
+import time
+import errno
+import threading
+import collections
+
+import common
+
+# Copies the stream from zfs send to one or more zfs recv in this process
+# instead of connecting them directly, to be able to measure and report the
+# progress.
+
+# bytes copied at a time
+chunk_size = 1024*1024
+
+class TransferStats:
+    def __init__(self):
+        self.bytes = 0
+        self.start_time = time.monotonic()
+        self.end_time = None
+
+    def seconds(self):
+        end_time = self.end_time if self.end_time != None else time.monotonic()
+        return end_time - self.start_time
+
+    # bytes per second
+    def rate(self):
+        seconds = self.seconds()
+        return self.bytes / seconds if seconds > 0 else 0
+
+    def __str__(self):
+        return common.format_bytes(self.bytes) + " in " + format_duration(self.seconds()) + " (" + common.format_bytes(int(self.rate())) + "/s)"
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+def progress_text(stats, expected_size):
+    text = common.format_bytes(stats.bytes)
+    rate = stats.rate()
+
+    if expected_size != None and expected_size > 0:
+        text += " of " + common.format_bytes(expected_size) + " (" + str(min(100, stats.bytes * 100 // expected_size)) + "%)"
+
+    text += ", " + common.format_bytes(int(rate)) + "/s"
+
+    if expected_size != None and rate > 0:
+        text += ", ETA " + format_duration(max(0, expected_size - stats.bytes) / rate)
+
+    return text
+
+# A large buffer between zfs send and zfs recv, like mbuffer. Without it the
+# reads from the source and the writes to the backup disk stall each other,
+# because they happen in bursts and the pipe between them is small.
+#
+# When the buffer is empty, writing to the destination resumes when the
+# buffer has been filled to write_start percent. When the buffer is full,
+# reading from the source resumes when the buffer has been emptied to
+# read_resume percent. The size is at least one chunk, a smaller buffer
+# could never take a chunk. Writing also starts when the reading waits for
+# space, the write_start level can not always be reached with the chunks
+# the source delivers.
+class StreamBuffer:
+    def __init__(self, size, write_start, read_resume):
+        if size < chunk_size:
+            raise Exception("The buffer size must be at least " + common.format_bytes(chunk_size) + ", not " + common.format_bytes(size))
+        for name,percent in [("write_start", write_start), ("read_resume", read_resume)]:
+            if percent < 0 or percent > 100:
+                raise Exception("The " + name + " percentage of the buffer must be between 0 and 100, not " + str(percent))
+        
+        self.size = size
+        self.write_start_level = min(size * write_start // 100, size - chunk_size)
+        self.read_resume_level = size * read_resume // 100
+        self.chunks = collections.deque()
+        self.fill = 0
+        self.eof = False
+        self.closed = False
+        self.reading_paused = False
+        self.writing_paused = True
+        self.error = None
+        self.condition = threading.Condition()
+
+    # called by the reading thread, returns False if the buffer has been closed
+    def put(self, chunk):
+        with self.condition:
+            if self.fill + len(chunk) > self.size:
+                self.reading_paused = True
+                self.condition.notify_all()
+
+            while not self.closed and ((self.reading_paused and self.fill > self.read_resume_level) or self.fill + len(chunk) > self.size):
+                self.condition.wait()
+
+            self.reading_paused = False
+
+            if self.closed:
+                return False
+
+            self.chunks.append(chunk)
+            self.fill += len(chunk)
+            self.condition.notify_all()
+            return True
+
+    # called by the writing thread, returns an empty chunk at the end of the stream
+    def get(self):
+        with self.condition:
+            if self.fill == 0:
+                self.writing_paused = True
+
+            while not self.eof and (self.fill == 0 or (self.writing_paused and self.fill < self.write_start_level and not self.reading_paused)):
+                self.condition.wait()
+
+            self.writing_paused = False
+
+            if self.fill == 0:
+                return b''
+
+            chunk = self.chunks.popleft()
+            self.fill -= len(chunk)
+            self.condition.notify_all()
+            return chunk
+
+    # end of the stream, everything has been put in the buffer
+    def finish(self):
+        with self.condition:
+            self.eof = True
+            self.condition.notify_all()
+
+    # nothing more will be read from the buffer
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def fill_from(self, source):
+        try:
+            while True:
+                chunk = os.read(source, chunk_size)
+                if len(chunk) == 0 or not self.put(chunk):
+                    break
+        except Exception as e:
+            self.error = e
+        finally:
+            self.finish()
+
+def write_all(fd, data):
+    view = memoryview(data)
+    while len(view) > 0:
+        written = os.write(fd, view)
+        view = view[written:]
+
+# Copies everything from the file descriptor source to all file descriptors
+# in destinations (a dict of name: file descriptor) until source is closed or
+# all destinations have failed. A destination that fails, for example because
+# the receiving process has exited, is dropped and the copy continues to the
+# others. If progress_interval is set the progress is printed that often (in
+# seconds), with an ETA if expected_size (bytes) is known. If buffer_size is
+# set the data passes through a StreamBuffer of that many bytes.
+# Returns (TransferStats, list of names of failed destinations)
+def relay(source, destinations, expected_size=None, progress_interval=None, print_depth=0, buffer_size=None, write_start=0, read_resume=100):
+    stats = TransferStats()
+    active = dict(destinations)
+    failed = list()
+    next_progress = time.monotonic() + progress_interval if progress_interval else None
+
+    if buffer_size:
+        buffer = StreamBuffer(buffer_size, write_start, read_resume)
+        reader = threading.Thread(target=buffer.fill_from, args=(source,), daemon=True)
+        reader.start()
+    else:
+        buffer = None
+
+    # splice() moves data between pipes inside the kernel, it can only be used
+    # with a single destination and without a buffer
+    use_splice = hasattr(os, "splice") and len(active) == 1 and buffer == None
+
+    while len(active) > 0:
+        if use_splice:
+            name,fd = next(iter(active.items()))
+            try:
+                count = os.splice(source, fd, chunk_size)
+            except BrokenPipeError:
+                failed.append(name)
+                del active[name]
+                break
+            except OSError as e:
+                if e.errno in (errno.EINVAL, errno.ENOSYS):
+                    use_splice = False
+                    continue
+                raise
+
+            if count == 0:
+                break
+        else:
+            chunk = buffer.get() if buffer != None else os.read(source, chunk_size)
+            count = len(chunk)
+
+            if count == 0:
+                break
+
+            for name,fd in list(active.items()):
+                try:
+                    write_all(fd, chunk)
+                except OSError: # the receiver has exited
+                    failed.append(name)
+                    del active[name]
+
+        stats.bytes += count
+
+        if next_progress != None and time.monotonic() >= next_progress:
+            print("  "*print_depth + progress_text(stats, expected_size), flush=True)
+            common.flush_buffered_output()
+            next_progress += progress_interval
+
+    if buffer != None:
+        buffer.close()
+        reader.join()
+        
+        if buffer.error != None:
+            raise buffer.error
+
+    stats.end_time = time.monotonic()
+
+    return (stats, failed)
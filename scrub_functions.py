@@ -1,43 +1,128 @@
 import common
+import commands
 import pool
+import relay
+import metrics
+import tracing
 import time
 
+# seconds between checks when the scrub can not be waited for with "zpool wait"
+poll_interval = 60
+
 def scrub_disks(disks):
-    scrubbing_disks = list()
-    error_disks = list()
-    
-    # start scrub
+    # start scrub, several disks at a time
     print("Starting scrub of pool(s)", flush=True)
-    for disk in disks:
-        if not pool.pool_is_imported(disk["zpool"]):
-            common.open_luks_and_import_pool(disk, 1)
-
-        if pool.start_scrub(disk["zpool"]) != -1:
-            print("  Started scrub of pool " + disk["zpool"], flush=True)
-            scrubbing_disks.append(disk)
-        else:
-            print("  Failed to start scrub of pool " + disk["zpool"], flush=True)
-            
-        if disk not in scrubbing_disks:
-            common.export_pool_and_close_luks(disk, 2)
-    
-    # wait for scrub to complete and export/encrypt when finished
+    started,failed_disks = common.run_for_disks(start_scrub_on_disk, disks, 1)
+    
+    scrubbing_disks = [disk for disk,scrubbing in zip(disks, started) if scrubbing]
+    error_disks = [disk for disk in disks if disk not in scrubbing_disks]
+    
+    # wait for scrub to complete and export/encrypt each disk when its scrub
+    # has finished, one thread per disk
     print("Waiting for scrub(s) to complete", flush=True)
-    while len(scrubbing_disks) > 0:
-            
-        for disk in scrubbing_disks:
-            completed,error,errormsg = pool.check_scrub(disk["zpool"])
-            
-            if error:
-                print("  Scrub failed for " + disk["zpool"] + ": " + errormsg, flush=True)
-                error_disks.append(disk)
-                scrubbing_disks.remove(disk)
-                common.export_pool_and_close_luks(disk, 2)
-            elif completed:
-                print("  Scrub succeeded for " + disk["zpool"], flush=True)
-                scrubbing_disks.remove(disk)
-                common.export_pool_and_close_luks(disk, 2)
-                
-        time.sleep(60)
+    errors = common.run_in_parallel(wait_for_scrub, scrubbing_disks, len(scrubbing_disks))
+    
+    for disk,error in zip(scrubbing_disks, errors):
+        if error:
+            error_disks.append(disk)
 
     return error_disks
+
+# Imports the pool of the disk if needed and starts the scrub. Returns True if
+# the scrub is running, otherwise the pool is exported again.
+def start_scrub_on_disk(disk):
+    if not pool.pool_is_imported(disk["zpool"]):
+        common.open_luks_and_import_pool(disk, 1)
+
+    with tracing.span("scrub-start", disk=disk["zpool"]) as start_span:
+        failed = pool.start_scrub(disk["zpool"])
+        if failed:
+            start_span.failed()
+    
+    if not failed:
+        print("  Started scrub of pool " + disk["zpool"], flush=True)
+        return True
+    
+    print("  Failed to start scrub of pool " + disk["zpool"], flush=True)
+    common.export_pool_and_close_luks(disk, 2)
+    return False
+
+# Waits for the scrub of disk to finish and exports the pool. Returns True if
+# the scrub failed. The progress is printed every "progress-interval" seconds
+# if that is set.
+def wait_for_scrub(disk):
+    settings = common.get_settings()
+    progress_interval = settings["progress-interval"] if "progress-interval" in settings.keys() else None
+    waited = True
+    scrub_span = tracing.start_span("scrub", disk=disk["zpool"])
+    
+    while True:
+        completed,error,errormsg,status = pool.check_scrub(disk["zpool"])
+        
+        if status != None:
+            update_scrub_metrics(disk["zpool"], status)
+        
+        if completed:
+            break
+        
+        if commands.cancelled:
+            error = True
+            errormsg = "The run has been cancelled"
+            break
+        
+        if progress_interval != None and status != None:
+            print("  Scrub of " + disk["zpool"] + ": " + format_scrub_status(status), flush=True)
+            common.flush_buffered_output()
+        
+        if waited:
+            waited = pool.wait_scrub(disk["zpool"], progress_interval)
+        if not waited and not commands.cancelled:
+            # "zpool wait" is not available, poll instead
+            time.sleep(min(poll_interval, progress_interval) if progress_interval != None else poll_interval)
+    
+    if error:
+        print("  Scrub failed for " + disk["zpool"] + ": " + errormsg, flush=True)
+        scrub_span.failed(errormsg)
+    else:
+        print("  Scrub succeeded for " + disk["zpool"] + ": " + format_scrub_status(status), flush=True)
+    
+    if status != None and status.issued != None:
+        scrub_span.add_bytes(status.issued)
+    tracing.end_span(scrub_span)
+        
+    common.export_pool_and_close_luks(disk, 2)
+    
+    return error
+
+def format_scrub_status(status):
+    text = str(status.state)
+    
+    if status.state == "scanning":
+        if status.percent_done() != None:
+            text += ", " + common.format_bytes(status.issued) + " of " + common.format_bytes(status.total) + " issued (%.1f%%)" % status.percent_done()
+        if status.rate != None:
+            text += ", " + common.format_bytes(int(status.rate)) + "/s"
+        if status.eta != None:
+            text += ", ETA " + relay.format_duration(status.eta)
+    
+    if status.repaired != None:
+        text += ", " + common.format_bytes(status.repaired) + " repaired"
+    if status.errors != None:
+        text += ", " + str(status.errors) + " errors"
+        
+    return text
+
+def update_scrub_metrics(poolname, status):
+    labels = {"pool": poolname}
+    
+    metrics.set_value("scrub_running", labels, 1 if status.state == "scanning" else 0, "1 while a scrub is running on the pool")
+    
+    for name,value,helptext in [("scrub_scanned_bytes", status.scanned, "Bytes scanned by the scrub"),
+                                ("scrub_issued_bytes", status.issued, "Bytes issued by the scrub"),
+                                ("scrub_total_bytes", status.total, "Bytes to scrub"),
+                                ("scrub_rate_bytes_per_second", status.rate, "Issue rate of the scrub"),
+                                ("scrub_eta_seconds", status.eta, "Estimated time until the scrub is done"),
+                                ("scrub_repaired_bytes", status.repaired, "Bytes repaired by the scrub"),
+                                ("scrub_errors", status.errors, "Errors found by the scrub")]:
+        if value != None:
+            metrics.set_value(name, labels, int(value), helptext)
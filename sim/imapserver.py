@@ -0,0 +1,173 @@
+#!/usr/bin/python3
+
+# A small IMAP server standing in for a real mail server when trying out the
+# mail approval without a mail account. It has a single mailbox and supports
+# the commands used by backup_functions.wait_for_mail_reply: CAPABILITY,
+# LOGIN, SELECT, NOOP, SEARCH (UNDELETED and SUBJECT), FETCH (RFC822),
+# STORE, IDLE, CLOSE and LOGOUT. Any account and password is accepted.
+#
+# It plays the human too: the first time a subject is searched for, a reply
+# with that subject and the text given by --reply is delivered --reply-delay
+# seconds later, and clients in IDLE are notified.
+#
+# Use it with these in "approve-method-mail-settings":
+#   "imap-server": "localhost", "imap-port": 1143, "imap-ssl": false
+
+import argparse
+import re
+import select
+import socketserver
+import threading
+
+class Mailbox:
+    def __init__(self, reply, reply_delay):
+        self.reply = reply
+        self.reply_delay = reply_delay
+        self.messages = list()  # list of [message bytes, deleted]
+        self.searched_subjects = set()
+        self.condition = threading.Condition()
+        
+    def deliver(self, subject):
+        message = ("From: Human <human@localhost>\r\n"
+                   "Subject: Re: " + subject + "\r\n"
+                   "Content-Type: text/plain; charset=utf-8\r\n"
+                   "\r\n" + self.reply + "\r\n\r\n> I am the little backup robot.\r\n").encode("utf-8")
+        
+        with self.condition:
+            self.messages.append([message, False])
+            self.condition.notify_all()
+            
+    def search(self, subject, undeleted):
+        with self.condition:
+            if subject != None and subject not in self.searched_subjects:
+                self.searched_subjects.add(subject)
+                timer = threading.Timer(self.reply_delay, self.deliver, args=(subject,))
+                timer.daemon = True
+                timer.start()
+                
+            return [str(num + 1) for num,(message,deleted) in enumerate(self.messages)
+                    if (subject == None or subject.lower() in message.decode("utf-8").lower()) and not (undeleted and deleted)]
+    
+    def expunge(self):
+        with self.condition:
+            self.messages = [entry for entry in self.messages if not entry[1]]
+
+class IMAPHandler(socketserver.StreamRequestHandler):
+    def send(self, line):
+        self.wfile.write(line.encode("utf-8") + b"\r\n")
+        self.wfile.flush()
+    
+    def handle(self):
+        mailbox = self.server.mailbox
+        self.reported = 0   # the number of messages last reported with EXISTS
+        self.send("* OK IMAP4rev1 stand-in ready")
+        
+        while True:
+            line = self.rfile.readline()
+            if len(line) == 0:
+                return
+            
+            words = line.decode("utf-8").strip().split(" ", 2)
+            if len(words) < 2:
+                self.send("* BAD missing command")
+                continue
+            
+            tag = words[0]
+            command = words[1].upper()
+            arguments = words[2] if len(words) > 2 else str()
+            
+            if command == "CAPABILITY":
+                self.send("* CAPABILITY IMAP4rev1 AUTH=PLAIN" + (" IDLE" if self.server.idle else ""))
+                self.send(tag + " OK CAPABILITY completed")
+            elif command == "LOGIN":
+                self.send(tag + " OK LOGIN completed")
+            elif command == "SELECT":
+                with mailbox.condition:
+                    self.reported = len(mailbox.messages)
+                self.send("* " + str(self.reported) + " EXISTS")
+                self.send("* 0 RECENT")
+                self.send(tag + " OK [READ-WRITE] SELECT completed")
+            elif command == "NOOP":
+                self.send(tag + " OK NOOP completed")
+            elif command == "SEARCH":
+                match = re.search(r"SUBJECT (\"[^\"]*\"|[^ )]+)", arguments, re.IGNORECASE)
+                subject = match.group(1).strip('"') if match else None
+                numbers = mailbox.search(subject, arguments.upper().find("UNDELETED") >= 0)
+                self.send("* SEARCH" + "".join([" " + num for num in numbers]))
+                self.send(tag + " OK SEARCH completed")
+            elif command == "FETCH":
+                num = int(arguments.split(" ")[0])
+                with mailbox.condition:
+                    message = mailbox.messages[num - 1][0]
+                self.wfile.write(("* " + str(num) + " FETCH (RFC822 {" + str(len(message)) + "}\r\n").encode("utf-8") + message + b")\r\n")
+                self.send(tag + " OK FETCH completed")
+            elif command == "STORE":
+                num = int(arguments.split(" ")[0])
+                with mailbox.condition:
+                    if arguments.find("\\Deleted") >= 0:
+                        mailbox.messages[num - 1][1] = True
+                self.send("* " + str(num) + " FETCH (FLAGS (\\Deleted))")
+                self.send(tag + " OK STORE completed")
+            elif command == "IDLE" and self.server.idle:
+                self.idle(tag)
+            elif command == "CLOSE":
+                mailbox.expunge()
+                self.send(tag + " OK CLOSE completed")
+            elif command == "LOGOUT":
+                self.send("* BYE logging out")
+                self.send(tag + " OK LOGOUT completed")
+                return
+            else:
+                self.send(tag + " BAD unknown command")
+    
+    def idle(self, tag):
+        mailbox = self.server.mailbox
+        
+        # Messages that arrived since the last EXISTS are reported right away,
+        # in the same packet as the continuation like some servers do, so
+        # that the client has it buffered already
+        with mailbox.condition:
+            count = len(mailbox.messages)
+        if count != self.reported:
+            self.wfile.write(b"+ idling\r\n* " + str(count).encode("utf-8") + b" EXISTS\r\n")
+            self.wfile.flush()
+            self.reported = count
+        else:
+            self.send("+ idling")
+        
+        while True:
+            # wait for DONE from the client or new messages
+            readable,writable,exceptional = select.select([self.connection], [], [], 0.2)
+            
+            if readable:
+                line = self.rfile.readline()
+                if len(line) == 0:
+                    return
+                if line.strip().upper() == b"DONE":
+                    self.send(tag + " OK IDLE terminated")
+                    return
+            
+            with mailbox.condition:
+                if len(mailbox.messages) != count:
+                    count = len(mailbox.messages)
+                    self.reported = count
+                    self.send("* " + str(count) + " EXISTS")
+
+class IMAPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=1143, help="Port to listen on (default=1143).")
+    parser.add_argument("--reply", default="yes", help="Text of the replies (default=yes).")
+    parser.add_argument("--reply-delay", type=float, default=5, help="Seconds from the first search for a subject until the reply arrives (default=5).")
+    parser.add_argument("--no-idle", action="store_true", help="Do not support IDLE, to try out polling.")
+    args = parser.parse_args()
+    
+    server = IMAPServer(("localhost", args.port), IMAPHandler)
+    server.mailbox = Mailbox(args.reply, args.reply_delay)
+    server.idle = not args.no_idle
+    
+    print("Listening on localhost:" + str(args.port), flush=True)
+    server.serve_forever()
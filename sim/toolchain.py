@@ -0,0 +1,863 @@
+#!/usr/bin/python3
+
+# Stand-ins for zfs, zpool, cryptsetup, sgdisk, sendmail and systemctl, for
+# running backup.py without pools, disks or a mail server. The script is run
+# through symlinks with the names of the tools, which are created with
+#
+#   toolchain.py install BINDIR
+#
+# and BINDIR is put first in PATH. All tools keep their state in the sqlite
+# database state.db in the directory given by the environment variable
+# ZFS_OFFLINE_BACKUP_SIM, together with:
+#   dev/disk/by-id/  the disks and partitions (plain files)
+#   dev/mapper/      the open LUKS containers (plain files)
+#   mail/            the mails given to sendmail
+#   processes.log    one line per run of a tool, for counting processes
+#
+# Set "device-directories" in the config to the two dev directories.
+#
+# Only the commands and options used by this project are supported. The
+# contents of files are not stored, only their paths and sizes, and send
+# streams carry the snapshots and their properties but not the data. Scrubs
+# run at "scrub-rate" bytes per second (see set_config), without reading
+# anything. "zpool import" takes "device-scan-seconds" for each device it
+# searches: all devices in dev/, only the one given with -d, none with -c.
+# "cryptsetup open" takes "pbkdf-seconds" for deriving the key.
+# Cachefiles are JSON files of pool name: device.
+
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import contextlib
+
+tools = ["zfs", "zpool", "cryptsetup", "sgdisk", "sendmail", "systemctl"]
+
+root_variable = "ZFS_OFFLINE_BACKUP_SIM"
+
+schema = """
+CREATE TABLE IF NOT EXISTS config(key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS pools(name TEXT PRIMARY KEY, device TEXT, imported INTEGER, health TEXT, size INTEGER,
+                                 scrub_start REAL, scrub_end REAL, scrub_total INTEGER, cachefile TEXT);
+CREATE TABLE IF NOT EXISTS datasets(name TEXT PRIMARY KEY, guid TEXT, txg INTEGER, creation REAL, received INTEGER, resume_token TEXT);
+CREATE TABLE IF NOT EXISTS files(dataset TEXT, path TEXT, size INTEGER, birth INTEGER, death INTEGER);
+CREATE INDEX IF NOT EXISTS files_birth ON files(dataset, birth);
+CREATE INDEX IF NOT EXISTS files_death ON files(dataset, death);
+CREATE TABLE IF NOT EXISTS snapshots(dataset TEXT, name TEXT, guid TEXT, txg INTEGER, creation REAL, referenced INTEGER,
+                                     PRIMARY KEY(dataset, name));
+CREATE TABLE IF NOT EXISTS properties(name TEXT, property TEXT, value TEXT, PRIMARY KEY(name, property));
+CREATE TABLE IF NOT EXISTS luks(device TEXT PRIMARY KEY, keys INTEGER);
+CREATE TABLE IF NOT EXISTS mappings(name TEXT PRIMARY KEY, device TEXT);
+"""
+
+default_config = {"txg": "1", "scrub-rate": str(1024**3), "pool-size": str(4 * 1024**4), "device-scan-seconds": "0.05", "pbkdf-seconds": "0.5"}
+
+class ToolError(Exception):
+    def __init__(self, message, returncode=1):
+        super().__init__(message)
+        self.returncode = returncode
+
+def get_root():
+    if root_variable not in os.environ.keys():
+        raise ToolError(root_variable + " is not set")
+    return os.environ[root_variable]
+
+def device_directory(root, name):
+    return os.path.join(root, "dev", "disk", "by-id") if name == "disk-by-id" else os.path.join(root, "dev", "mapper")
+
+def open_state(root=None):
+    root = root if root != None else get_root()
+
+    for directory in [device_directory(root, "disk-by-id"), device_directory(root, "mapper"), os.path.join(root, "mail")]:
+        os.makedirs(directory, exist_ok=True)
+
+    db = sqlite3.connect(os.path.join(root, "state.db"), timeout=600, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.executescript(schema)
+    db.executemany("INSERT OR IGNORE INTO config VALUES (?, ?)", default_config.items())
+
+    return db
+
+@contextlib.contextmanager
+def transaction(db):
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+        db.execute("COMMIT")
+    except:
+        db.execute("ROLLBACK")
+        raise
+
+def get_config(db, key):
+    return db.execute("SELECT value FROM config WHERE key=?", (key,)).fetchone()[0]
+
+def set_config(db, key, value):
+    db.execute("INSERT OR REPLACE INTO config VALUES (?, ?)", (key, str(value)))
+
+# the txg that writes go to is the one after the current
+def current_txg(db):
+    return int(get_config(db, "txg"))
+
+def next_txg(db):
+    db.execute("UPDATE config SET value=value+1 WHERE key='txg'")
+    return current_txg(db)
+
+def new_guid():
+    return str(random.getrandbits(63))
+
+def pool_of(name):
+    return name.split('@')[0].split('/')[0]
+
+# range of names below dataset in the sort order: dataset + "/" <= name < dataset + "0"
+def below(dataset):
+    return (dataset + "/", dataset + "0")
+
+def check_imported(db, name):
+    row = db.execute("SELECT imported FROM pools WHERE name=?", (pool_of(name),)).fetchone()
+    if row == None or not row[0]:
+        raise ToolError("cannot open '" + name + "': dataset does not exist")
+
+def dataset_exists(db, name):
+    return db.execute("SELECT 1 FROM datasets WHERE name=?", (name,)).fetchone() != None
+
+def snapshot_row(db, dataset, snapshot):
+    return db.execute("SELECT guid, txg, creation, referenced FROM snapshots WHERE dataset=? AND name=?", (dataset, snapshot)).fetchone()
+
+def referenced(db, dataset):
+    received, = db.execute("SELECT received FROM datasets WHERE name=?", (dataset,)).fetchone()
+    size, = db.execute("SELECT SUM(size) FROM files WHERE dataset=? AND death IS NULL", (dataset,)).fetchone()
+    return received + (size if size != None else 0)
+
+# datasets of root (including root) in sorted order
+def datasets_of(db, root):
+    rows = db.execute("SELECT name FROM datasets WHERE name=? OR (name>=? AND name<?) ORDER BY name", (root,) + below(root))
+    return [row[0] for row in rows]
+
+# setup, used by the tools and by the benchmarks
+
+def add_pool(db, name, device, imported=True):
+    with transaction(db):
+        if db.execute("SELECT 1 FROM pools WHERE name=?", (name,)).fetchone() != None:
+            raise ToolError("cannot create '" + name + "': pool already exists")
+        db.execute("INSERT INTO pools VALUES (?, ?, ?, 'ONLINE', ?, NULL, NULL, NULL, NULL)", (name, device, int(imported), int(get_config(db, "pool-size"))))
+        db.execute("INSERT INTO datasets VALUES (?, ?, ?, ?, 0, NULL)", (name, new_guid(), current_txg(db), time.time()))
+
+def add_datasets(db, names):
+    with transaction(db):
+        txg = current_txg(db)
+        db.executemany("INSERT INTO datasets VALUES (?, ?, ?, ?, 0, NULL)", [(name, new_guid(), txg, time.time()) for name in names])
+
+# files is a list of (dataset, path, size). A file that exists is replaced.
+def write_files(db, files):
+    with transaction(db):
+        txg = current_txg(db) + 1
+        db.executemany("UPDATE files SET death=? WHERE dataset=? AND path=? AND death IS NULL", [(txg, dataset, path) for dataset,path,size in files])
+        db.executemany("INSERT INTO files VALUES (?, ?, ?, ?, NULL)", [(dataset, path, size, txg) for dataset,path,size in files])
+
+# files is a list of (dataset, path)
+def remove_files(db, files):
+    with transaction(db):
+        txg = current_txg(db) + 1
+        db.executemany("UPDATE files SET death=? WHERE dataset=? AND path=? AND death IS NULL", [(txg, dataset, path) for dataset,path in files])
+
+# creates the snapshots of all datasets of the pools in one txg, like zfs snapshot -r
+def create_snapshots(db, names):
+    with transaction(db):
+        rows = list()
+        txg = next_txg(db)
+        creation = time.time()
+
+        for name in names:
+            pool,_,snapshot = name.partition('@')
+            check_imported(db, pool)
+            if not dataset_exists(db, pool):
+                raise ToolError("cannot open '" + pool + "': dataset does not exist")
+
+            # referenced of all datasets with one query
+            sizes = dict(db.execute("SELECT dataset, SUM(size) FROM files WHERE (dataset=? OR (dataset>=? AND dataset<?)) AND death IS NULL GROUP BY dataset", (pool,) + below(pool)))
+            for dataset,received in db.execute("SELECT name, received FROM datasets WHERE name=? OR (name>=? AND name<?)", (pool,) + below(pool)).fetchall():
+                if snapshot_row(db, dataset, snapshot) != None:
+                    raise ToolError("cannot create snapshot '" + dataset + "@" + snapshot + "': dataset already exists")
+                rows.append((dataset, snapshot, new_guid(), txg, creation, received + (sizes[dataset] if dataset in sizes.keys() else 0)))
+
+        db.executemany("INSERT INTO snapshots VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+def add_disk(root, ident, formatted=True):
+    db = open_state(root)
+    path = os.path.join(device_directory(root, "disk-by-id"), ident)
+    open(path, "a").close()
+    if formatted:
+        db.execute("INSERT OR REPLACE INTO luks VALUES (?, 1)", (path,))
+    return path
+
+# options
+
+# Splits the arguments into a dict of options and a list of the other
+# arguments. Options in with_value take a value, either in the same argument
+# (-d1, --type=luks) or in the next.
+def parse_options(args, with_value=()):
+    options = dict()
+    positional = list()
+    index = 0
+
+    while index < len(args):
+        arg = args[index]
+
+        if arg.startswith("--"):
+            name,equals,value = arg[2:].partition('=')
+            if equals:
+                options[name] = value
+            elif name in with_value:
+                index += 1
+                options[name] = args[index]
+            else:
+                options[name] = True
+        elif arg.startswith("-") and len(arg) > 1:
+            for position,letter in enumerate(arg[1:]):
+                if letter in with_value:
+                    value = arg[position+2:]
+                    if value == "":
+                        index += 1
+                        value = args[index]
+                    options[letter] = value
+                    break
+                options[letter] = True
+        else:
+            positional.append(arg)
+
+        index += 1
+
+    return options, positional
+
+def format_size(size):
+    for unit in ["B", "K", "M", "G", "T", "P"]:
+        if size < 1024 or unit == "P":
+            break
+        size /= 1024
+    return (str(int(size)) if unit == "B" else "%.2f" % size) + unit
+
+def format_seconds(seconds):
+    seconds = int(seconds)
+    return "%02d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+# zfs
+
+# Returns the datasets and snapshots of root down to depth (None for all) as
+# dicts with the keys name, dataset, snapshot (None for datasets), guid, txg,
+# creation and referenced
+def list_objects(db, root, types, depth):
+    check_imported(db, root)
+    objects = list()
+
+    if '@' in root:
+        dataset,_,snapshot = root.partition('@')
+        row = snapshot_row(db, dataset, snapshot)
+        if row == None:
+            raise ToolError("cannot open '" + root + "': dataset does not exist")
+        return [{"name": root, "dataset": dataset, "snapshot": snapshot, "guid": row[0], "txg": row[1], "creation": row[2], "referenced": row[3]}]
+
+    if not dataset_exists(db, root):
+        raise ToolError("cannot open '" + root + "': dataset does not exist")
+
+    snapshots = dict()
+    if "snapshot" in types:
+        for dataset,name,guid,txg,creation,size in db.execute("SELECT dataset, name, guid, txg, creation, referenced FROM snapshots WHERE dataset=? OR (dataset>=? AND dataset<?) ORDER BY dataset, txg, rowid", (root,) + below(root)):
+            snapshots.setdefault(dataset, list()).append({"name": dataset + "@" + name, "dataset": dataset, "snapshot": name, "guid": guid, "txg": txg, "creation": creation, "referenced": size})
+
+    sizes = dict()
+    if "filesystem" in types:
+        sizes = dict(db.execute("SELECT dataset, SUM(size) FROM files WHERE (dataset=? OR (dataset>=? AND dataset<?)) AND death IS NULL GROUP BY dataset", (root,) + below(root)))
+
+    for name,guid,txg,creation,received in db.execute("SELECT name, guid, txg, creation, received FROM datasets WHERE name=? OR (name>=? AND name<?) ORDER BY name", (root,) + below(root)).fetchall():
+        dataset_depth = name.count('/') - root.count('/')
+        if depth != None and dataset_depth > depth:
+            continue
+        if "filesystem" in types:
+            objects.append({"name": name, "dataset": name, "snapshot": None, "guid": guid, "txg": txg, "creation": creation, "referenced": received + (sizes[name] if name in sizes.keys() else 0)})
+        if depth == None or dataset_depth + 1 <= depth:
+            objects.extend(snapshots.get(name, list()))
+
+    return objects
+
+# the depth of zfs list and zfs get: -d, all with -r, otherwise only the dataset itself
+def list_depth(options):
+    if "d" in options.keys():
+        return int(options["d"])
+    return None if "r" in options.keys() else 0
+
+def types_option(options, default):
+    types = options.get("t", default).replace("all", "filesystem,snapshot")
+    return ["filesystem" if t == "volume" else t for t in types.split(',')]
+
+def user_properties(db, objects, properties):
+    if not any([':' in property_name for property_name in properties]):
+        return dict()
+
+    names = set([obj["name"] for obj in objects])
+    values = dict()
+    for name,property_name,value in db.execute("SELECT name, property, value FROM properties"):
+        if name in names:
+            values[(name, property_name)] = value
+    return values
+
+def written_since(db, dataset, prev_txg, txg):
+    size, = db.execute("SELECT SUM(size) FROM files WHERE dataset=? AND birth>? AND birth<=? AND (death IS NULL OR death>?)", (dataset, prev_txg, txg, txg)).fetchone()
+    return size if size != None else 0
+
+def property_value(db, obj, property_name, user_values, written_txgs):
+    if property_name == "name":
+        return obj["name"]
+    elif property_name == "type":
+        return "snapshot" if obj["snapshot"] != None else "filesystem"
+    elif property_name in ("guid", "referenced", "creation"):
+        return str(int(obj[property_name]))
+    elif property_name == "createtxg":
+        return str(obj["txg"])
+    elif property_name == "used":
+        return str(obj["referenced"]) if obj["snapshot"] == None else "0"
+    elif property_name == "mountpoint":
+        return "/" + obj["dataset"] if obj["snapshot"] == None else "-"
+    elif property_name == "receive_resume_token" and obj["snapshot"] == None:
+        token, = db.execute("SELECT resume_token FROM datasets WHERE name=?", (obj["name"],)).fetchone()
+        return token if token != None else "-"
+    elif property_name.startswith("written@"):
+        prev_txg = written_txgs.get(obj["dataset"], None)
+        if prev_txg == None or prev_txg >= obj["txg"]:
+            return "-"
+        return str(written_since(db, obj["dataset"], prev_txg, obj["txg"]))
+    elif ':' in property_name:
+        return user_values.get((obj["name"], property_name), "-")
+    else:
+        return "-"
+
+def written_txgs(db, objects, properties):
+    txgs = dict()
+    for property_name in properties:
+        if property_name.startswith("written@"):
+            prev_snapshot = property_name.split('@')[1]
+            for dataset in set([obj["dataset"] for obj in objects]):
+                row = snapshot_row(db, dataset, prev_snapshot)
+                if row != None:
+                    txgs[dataset] = row[1]
+    return txgs
+
+def zfs_list(db, args):
+    options,positional = parse_options(args, "dots")
+    types = types_option(options, "filesystem")
+    properties = options.get("o", "name,used,avail,refer,mountpoint").split(',')
+
+    objects = list()
+    for root in positional:
+        objects.extend(list_objects(db, root, types, list_depth(options)))
+
+    if "s" in options.keys():
+        objects.sort(key=lambda obj: obj["txg"] if options["s"] in ("creation", "createtxg") else obj[options["s"]])
+
+    user_values = user_properties(db, objects, properties)
+    for obj in objects:
+        print("\t".join([property_value(db, obj, property_name, user_values, {}) for property_name in properties]))
+
+def zfs_get(db, args):
+    options,positional = parse_options(args, "dots")
+    properties = positional[0].split(',')
+    types = types_option(options, "filesystem,snapshot")
+    fields = options.get("o", "name,property,value,source").split(',')
+
+    for root in positional[1:]:
+        objects = list_objects(db, root, types, list_depth(options))
+        user_values = user_properties(db, objects, properties)
+        txgs = written_txgs(db, objects, properties)
+
+        for obj in objects:
+            for property_name in properties:
+                value = property_value(db, obj, property_name, user_values, txgs)
+                field_values = {"name": obj["name"], "property": property_name, "value": value, "source": "local" if ':' in property_name else "-"}
+                print("\t".join([field_values[field] for field in fields]))
+
+def zfs_set(db, args):
+    options,positional = parse_options(args)
+    property_name,_,value = positional[0].partition('=')
+
+    with transaction(db):
+        for name in positional[1:]:
+            list_objects(db, name, ["filesystem", "snapshot"], 0)
+            db.execute("INSERT OR REPLACE INTO properties VALUES (?, ?, ?)", (name, property_name, value))
+
+def zfs_snapshot(db, args):
+    options,positional = parse_options(args)
+    create_snapshots(db, positional)
+
+def zfs_rename(db, args):
+    options,positional = parse_options(args)
+    pool,_,old_snapshot = positional[0].partition('@')
+    new_snapshot = positional[1].lstrip('@')
+
+    with transaction(db):
+        check_imported(db, pool)
+        if snapshot_row(db, pool, old_snapshot) == None:
+            raise ToolError("cannot open '" + positional[0] + "': dataset does not exist")
+
+        for dataset in datasets_of(db, pool):
+            if snapshot_row(db, dataset, old_snapshot) == None:
+                continue
+            if snapshot_row(db, dataset, new_snapshot) != None:
+                raise ToolError("cannot rename to '" + dataset + "@" + new_snapshot + "': dataset already exists")
+            db.execute("UPDATE snapshots SET name=? WHERE dataset=? AND name=?", (new_snapshot, dataset, old_snapshot))
+            db.execute("UPDATE properties SET name=? WHERE name=?", (dataset + "@" + new_snapshot, dataset + "@" + old_snapshot))
+
+def zfs_destroy(db, args):
+    options,positional = parse_options(args)
+    pool,_,snapshot = positional[0].partition('@')
+
+    with transaction(db):
+        check_imported(db, pool)
+        if snapshot_row(db, pool, snapshot) == None:
+            raise ToolError("could not find any snapshots to destroy; check snapshot names.")
+
+        for dataset in datasets_of(db, pool) if "r" in options.keys() else [pool]:
+            db.execute("DELETE FROM snapshots WHERE dataset=? AND name=?", (dataset, snapshot))
+            db.execute("DELETE FROM properties WHERE name=?", (dataset + "@" + snapshot,))
+
+# The stream is JSON lines: a header, one line per dataset with the
+# snapshots to receive and the guid of the snapshot it is incremental from
+# (None for a full stream), and an end line.
+def zfs_send(db, args):
+    options,positional = parse_options(args, "It")
+
+    if "t" in options.keys():
+        raise ToolError("cannot resume send: resume token is corrupt")
+
+    pool,_,new_snapshot = positional[0].partition('@')
+    prev_snapshot = options["I"].partition('@')[2] if "I" in options.keys() else None
+
+    check_imported(db, pool)
+    if snapshot_row(db, pool, new_snapshot) == None:
+        raise ToolError("cannot open '" + positional[0] + "': dataset does not exist")
+    if prev_snapshot != None and snapshot_row(db, pool, prev_snapshot) == None:
+        raise ToolError("cannot open '" + pool + "@" + prev_snapshot + "': dataset does not exist")
+
+    records = list()
+    total_size = 0
+
+    for dataset in datasets_of(db, pool) if "R" in options.keys() else [pool]:
+        new_row = snapshot_row(db, dataset, new_snapshot)
+        if new_row == None:
+            continue
+        prev_row = snapshot_row(db, dataset, prev_snapshot) if prev_snapshot != None else None
+        prev_txg = prev_row[1] if prev_row != None else 0
+
+        # snapshots created in the same txg are ordered by when they were added
+        all_snapshots = db.execute("SELECT name, guid, txg, creation, referenced FROM snapshots WHERE dataset=? ORDER BY txg, rowid", (dataset,)).fetchall()
+        names = [row[0] for row in all_snapshots]
+        first = names.index(prev_snapshot) + 1 if prev_row != None else 0
+        last = names.index(new_snapshot)
+
+        snapshots = list()
+        for name,guid,txg,creation,size in all_snapshots[first:last+1]:
+            properties = dict(db.execute("SELECT property, value FROM properties WHERE name=?", (dataset + "@" + name,)))
+            snapshots.append({"name": name, "guid": guid, "creation": creation, "referenced": size, "properties": properties})
+
+        # with -R all snapshots of the source are listed, recv -F renames and
+        # destroys the snapshots of the destination to match
+        records.append({"dataset": dataset[len(pool):].lstrip('/'), "base_guid": prev_row[0] if prev_row != None else None, "snapshots": snapshots,
+                        "source_snapshots": {row[1]: row[0] for row in all_snapshots} if "R" in options.keys() else None})
+        total_size += written_since(db, dataset, prev_txg, new_row[1])
+
+    if "n" in options.keys():
+        if "v" in options.keys():
+            print("size\t" + str(total_size) if "P" in options.keys() else "total estimated size is " + format_size(total_size), file=sys.stderr)
+        return
+
+    out = sys.stdout.buffer
+    out.write((json.dumps({"stream": "zfs-offline-backup-sim", "pool": pool, "snapshot": new_snapshot}) + "\n").encode("utf-8"))
+    for record in records:
+        out.write((json.dumps(record) + "\n").encode("utf-8"))
+    out.write(b'{"end": true}\n')
+    out.flush()
+
+def zfs_recv(db, args):
+    options,positional = parse_options(args)
+    target = positional[0]
+
+    if "A" in options.keys():
+        with transaction(db):
+            check_imported(db, target)
+            row = db.execute("SELECT resume_token FROM datasets WHERE name=?", (target,)).fetchone()
+            if row == None or row[0] == None:
+                raise ToolError("'" + target + "' does not have any resumable receive state to abort")
+            db.execute("UPDATE datasets SET resume_token=NULL WHERE name=?", (target,))
+        return
+
+    lines = sys.stdin.buffer.read().decode("utf-8").splitlines()
+    records = [json.loads(line) for line in lines]
+    if len(records) < 2 or records[0].get("stream", None) == None or records[-1] != {"end": True}:
+        raise ToolError("cannot receive: failed to read from stream")
+
+    with transaction(db):
+        check_imported(db, target)
+
+        for record in records[1:-1]:
+            if "d" in options.keys():
+                dataset = target + ("/" + record["dataset"] if record["dataset"] != "" else "")
+            else:
+                dataset = target
+            receive_dataset(db, dataset, record, "F" in options.keys())
+
+def receive_dataset(db, dataset, record, force):
+    if force and record["source_snapshots"] != None:
+        source_snapshots = record["source_snapshots"]
+        for name,guid in db.execute("SELECT name, guid FROM snapshots WHERE dataset=?", (dataset,)).fetchall():
+            if guid not in source_snapshots.keys():
+                db.execute("DELETE FROM snapshots WHERE dataset=? AND name=?", (dataset, name))
+                db.execute("DELETE FROM properties WHERE name=?", (dataset + "@" + name,))
+            elif source_snapshots[guid] != name:
+                db.execute("UPDATE snapshots SET name=? WHERE dataset=? AND name=?", (source_snapshots[guid], dataset, name))
+                db.execute("UPDATE properties SET name=? WHERE name=?", (dataset + "@" + source_snapshots[guid], dataset + "@" + name))
+
+    existing = db.execute("SELECT name, guid, txg FROM snapshots WHERE dataset=? ORDER BY txg, rowid", (dataset,)).fetchall()
+
+    if record["base_guid"] == None:
+        if len(existing) > 0 and not force:
+            raise ToolError("cannot receive new filesystem stream: destination '" + dataset + "' exists\nmust specify -F to overwrite it")
+        newer = existing
+    else:
+        base = [row for row in existing if row[1] == record["base_guid"]]
+        if len(base) == 0:
+            raise ToolError("cannot receive incremental stream: most recent snapshot of " + dataset + " does not\nmatch incremental source")
+        newer = existing[existing.index(base[0])+1:]
+        if len(newer) > 0 and not force:
+            raise ToolError("cannot receive incremental stream: destination " + dataset + " has been modified\nsince most recent snapshot")
+
+    # -F: roll back to the base snapshot
+    for name,guid,txg in newer:
+        db.execute("DELETE FROM snapshots WHERE dataset=? AND name=?", (dataset, name))
+        db.execute("DELETE FROM properties WHERE name=?", (dataset + "@" + name,))
+
+    if not dataset_exists(db, dataset):
+        parent = dataset.rpartition('/')[0]
+        if not dataset_exists(db, parent):
+            raise ToolError("cannot receive new filesystem stream: parent of '" + dataset + "' does not exist")
+        db.execute("INSERT INTO datasets VALUES (?, ?, ?, ?, 0, NULL)", (dataset, new_guid(), current_txg(db), time.time()))
+
+    for snapshot in record["snapshots"]:
+        if snapshot_row(db, dataset, snapshot["name"]) != None:
+            raise ToolError("cannot receive: destination snapshot '" + dataset + "@" + snapshot["name"] + "' exists")
+        db.execute("INSERT INTO snapshots VALUES (?, ?, ?, ?, ?, ?)", (dataset, snapshot["name"], snapshot["guid"], next_txg(db), snapshot["creation"], snapshot["referenced"]))
+        db.executemany("INSERT OR REPLACE INTO properties VALUES (?, ?, ?)", [(dataset + "@" + snapshot["name"], key, value) for key,value in snapshot["properties"].items()])
+        db.execute("UPDATE datasets SET received=? WHERE name=?", (snapshot["referenced"], dataset))
+
+def zfs_diff(db, args):
+    options,positional = parse_options(args)
+    dataset,_,prev_snapshot = positional[0].partition('@')
+    new_snapshot = positional[1].partition('@')[2]
+
+    check_imported(db, dataset)
+    prev_row = snapshot_row(db, dataset, prev_snapshot)
+    new_row = snapshot_row(db, dataset, new_snapshot)
+    if prev_row == None or new_row == None:
+        raise ToolError("Unable to obtain diffs: \n   Cannot open snapshot: " + (positional[0] if prev_row == None else positional[1]))
+
+    prev_txg = prev_row[1]
+    new_txg = new_row[1]
+    removed = set()
+    added = set()
+
+    for path,birth,death in db.execute("SELECT path, birth, death FROM files WHERE dataset=? AND ((birth>? AND birth<=?) OR (death>? AND death<=?))", (dataset, prev_txg, new_txg, prev_txg, new_txg)):
+        if birth <= prev_txg:
+            removed.add(path)
+        elif death == None or death > new_txg:
+            added.add(path)
+
+    timestamp = "%.9f" % new_row[2]
+    out = sys.stdout
+    for path in sorted(removed | added):
+        difftype = "M" if path in removed and path in added else ("-" if path in removed else "+")
+        out.write(timestamp + "\t" + difftype + "\tF\t/" + dataset + path + "\n")
+
+def zfs(db, args):
+    commands = {"list": zfs_list, "get": zfs_get, "set": zfs_set, "snapshot": zfs_snapshot, "rename": zfs_rename, "destroy": zfs_destroy,
+                "send": zfs_send, "recv": zfs_recv, "receive": zfs_recv, "diff": zfs_diff}
+    if len(args) == 0 or args[0] not in commands.keys():
+        raise ToolError("unrecognized command '" + (args[0] if len(args) > 0 else "") + "'", 2)
+    commands[args[0]](db, args[1:])
+
+# zpool
+
+def pool_row(db, name):
+    row = db.execute("SELECT name, device, imported, health, size, scrub_start, scrub_end, scrub_total FROM pools WHERE name=?", (name,)).fetchone()
+    if row == None or not row[2]:
+        raise ToolError("cannot open '" + name + "': no such pool")
+    return row
+
+def allocated(db, name):
+    return sum([referenced(db, dataset) for dataset in datasets_of(db, name)])
+
+def zpool_create(db, args):
+    options,positional = parse_options(args, "o")
+    name,device = positional
+    if not os.path.exists(device):
+        raise ToolError("cannot open '" + device + "': No such device or address")
+    add_pool(db, name, device)
+
+def read_cachefile(filepath):
+    if not os.path.exists(filepath):
+        return dict()
+    with open(filepath) as f:
+        return json.load(f)
+
+def update_cachefile(filepath, name, device):
+    pools = read_cachefile(filepath)
+    if device != None:
+        pools[name] = device
+    elif name in pools.keys():
+        del pools[name]
+    with open(filepath, "w") as f:
+        json.dump(pools, f)
+
+def all_devices(root):
+    directories = [device_directory(root, "disk-by-id"), device_directory(root, "mapper"), os.path.join(root, "dev")]
+    return [os.path.join(directory, entry) for directory in directories for entry in os.listdir(directory) if os.path.isfile(os.path.join(directory, entry))]
+
+def zpool_import(db, args):
+    options,positional = parse_options(args, "dco")
+    name = positional[0]
+
+    if "c" in options.keys():
+        cached = read_cachefile(options["c"])
+        searched = [cached[name]] if name in cached.keys() else list()
+        scanned = 0
+    elif "d" in options.keys():
+        searched = [options["d"]] if not os.path.isdir(options["d"]) else [os.path.join(options["d"], entry) for entry in os.listdir(options["d"])]
+        scanned = len(searched)
+    else:
+        searched = all_devices(get_root())
+        scanned = len(searched)
+
+    time.sleep(scanned * float(get_config(db, "device-scan-seconds")))
+
+    cachefile = options["o"].partition("cachefile=")[2] if "o" in options.keys() and options["o"].startswith("cachefile=") else None
+
+    with transaction(db):
+        row = db.execute("SELECT device, imported FROM pools WHERE name=?", (name,)).fetchone()
+        if row == None or row[1] or not os.path.exists(row[0]) or row[0] not in searched:
+            raise ToolError("cannot import '" + name + "': no such pool available")
+        db.execute("UPDATE pools SET imported=1, cachefile=? WHERE name=?", (cachefile, name))
+        if cachefile != None:
+            update_cachefile(cachefile, name, row[0])
+
+def zpool_export(db, args):
+    options,positional = parse_options(args)
+
+    with transaction(db):
+        pool_row(db, positional[0])
+        cachefile, = db.execute("SELECT cachefile FROM pools WHERE name=?", (positional[0],)).fetchone()
+        db.execute("UPDATE pools SET imported=0, cachefile=NULL WHERE name=?", (positional[0],))
+        if cachefile != None:
+            update_cachefile(cachefile, positional[0], None)
+
+def zpool_list(db, args):
+    options,positional = parse_options(args, "o")
+    properties = options.get("o", "name,size,alloc,free,frag,cap,health").split(',')
+
+    for name,health,size in db.execute("SELECT name, health, size FROM pools WHERE imported=1 ORDER BY name").fetchall():
+        alloc = allocated(db, name)
+        values = {"name": name, "health": health, "size": str(size), "allocated": str(alloc), "alloc": str(alloc), "free": str(size - alloc),
+                  "fragmentation": "0", "frag": "0", "capacity": str(alloc * 100 // size), "cap": str(alloc * 100 // size)}
+        print("\t".join([values.get(property_name, "-") for property_name in properties]))
+
+# returns (state, examined bytes, total bytes) of the last scrub
+def scrub_progress(row):
+    name,device,imported,health,size,scrub_start,scrub_end,scrub_total = row
+    if scrub_start == None:
+        return (None, 0, 0)
+    now = time.time()
+    if now >= scrub_end:
+        return ("FINISHED", scrub_total, scrub_total)
+    return ("SCANNING", int(scrub_total * (now - scrub_start) / max(scrub_end - scrub_start, 0.001)), scrub_total)
+
+def zpool_status(db, args):
+    options,positional = parse_options(args)
+
+    if "x" in options.keys():
+        unhealthy = db.execute("SELECT name, health FROM pools WHERE imported=1 AND health!='ONLINE' ORDER BY name").fetchall()
+        if len(unhealthy) == 0:
+            print("all pools are healthy")
+        for name,health in unhealthy:
+            print("  pool: " + name + "\n state: " + health + "\n")
+        return
+
+    row = pool_row(db, positional[0])
+    name,device,imported,health,size,scrub_start,scrub_end,scrub_total = row
+    state,examined,total = scrub_progress(row)
+
+    if "j" in options.keys():
+        scan_stats = None
+        if state != None:
+            scan_stats = {"function": "SCRUB", "state": state, "start_time": int(scrub_start), "end_time": int(scrub_end) if state == "FINISHED" else 0,
+                          "to_examine": total, "examined": examined, "skipped": 0, "processed": 0, "errors": 0,
+                          "bytes_per_scan": examined, "pass_start": int(scrub_start), "scrub_pause": 0, "scrub_spent_paused": 0,
+                          "issued_bytes_per_scan": examined, "issued": examined}
+        print(json.dumps({"output_version": {"command": "zpool status", "vers_major": 0, "vers_minor": 1},
+                          "pools": {name: {"name": name, "state": health, "vdevs": {name: {"name": name, "path": device, "state": health}}, "scan_stats": scan_stats}}}))
+        return
+
+    if state == None:
+        scan = "none requested"
+    elif state == "SCANNING":
+        elapsed = max(time.time() - scrub_start, 0.001)
+        rate = examined / elapsed
+        eta = (total - examined) / rate if rate > 0 else 0
+        scan = ("scrub in progress since " + time.ctime(scrub_start) + "\n\t" + format_size(examined) + " scanned at " + format_size(rate) + "/s, " +
+                format_size(examined) + " issued at " + format_size(rate) + "/s, " + format_size(total) + " total\n\t0B repaired, " +
+                "%.2f%% done, " % (examined * 100 / max(total, 1)) + format_seconds(eta) + " to go")
+    else:
+        scan = "scrub repaired 0B in " + format_seconds(scrub_end - scrub_start) + " with 0 errors on " + time.ctime(scrub_end)
+
+    print("  pool: " + name + "\n state: " + health + "\n  scan: " + scan + "\nconfig:\n\n\tNAME" + " "*20 + "STATE     READ WRITE CKSUM\n\t" +
+          name.ljust(24) + health.ljust(10) + "0     0     0\n\t  " + os.path.basename(device).ljust(22) + health.ljust(10) + "0     0     0\n\nerrors: No known data errors")
+
+def zpool_scrub(db, args):
+    options,positional = parse_options(args)
+
+    with transaction(db):
+        row = pool_row(db, positional[0])
+        if scrub_progress(row)[0] == "SCANNING":
+            raise ToolError("cannot scrub " + positional[0] + ": currently scrubbing; use 'zpool scrub -s' to cancel current scrub")
+        total = allocated(db, positional[0])
+        now = time.time()
+        db.execute("UPDATE pools SET scrub_start=?, scrub_end=?, scrub_total=? WHERE name=?", (now, now + total / float(get_config(db, "scrub-rate")), total, positional[0]))
+
+def zpool_wait(db, args):
+    options,positional = parse_options(args, "tT")
+
+    while True:
+        row = pool_row(db, positional[0])
+        if scrub_progress(row)[0] != "SCANNING":
+            return
+        time.sleep(min(1, max(0.01, row[6] - time.time())))
+
+def zpool(db, args):
+    commands = {"create": zpool_create, "import": zpool_import, "export": zpool_export, "list": zpool_list,
+                "status": zpool_status, "scrub": zpool_scrub, "wait": zpool_wait}
+    if len(args) == 0 or args[0] not in commands.keys():
+        raise ToolError("unrecognized command '" + (args[0] if len(args) > 0 else "") + "'", 2)
+    commands[args[0]](db, args[1:])
+
+# cryptsetup
+
+def check_luks(db, device):
+    if not os.path.exists(device):
+        raise ToolError("Device " + device + " does not exist or access denied.", 4)
+    row = db.execute("SELECT keys FROM luks WHERE device=?", (device,)).fetchone()
+    if row == None:
+        raise ToolError("Device " + device + " is not a valid LUKS device.", 1)
+    return row[0]
+
+def cryptsetup(db, args):
+    options,positional = parse_options(args, ["type", "key-file", "c", "s", "h"])
+    command = positional[0]
+
+    if command == "luksFormat":
+        if not os.path.exists(positional[1]):
+            raise ToolError("Device " + positional[1] + " does not exist or access denied.", 4)
+        db.execute("INSERT OR REPLACE INTO luks VALUES (?, 1)", (positional[1],))
+    elif command == "luksAddKey":
+        keys = check_luks(db, positional[1])
+        db.execute("UPDATE luks SET keys=? WHERE device=?", (keys + 1, positional[1]))
+    elif command == "luksErase":
+        check_luks(db, positional[1])
+        db.execute("UPDATE luks SET keys=0 WHERE device=?", (positional[1],))
+    elif command == "luksDump":
+        keys = check_luks(db, positional[1])
+        print("LUKS header information for " + positional[1] + "\n\nVersion:       \t1\nCipher name:   \taes\nCipher mode:   \txts-plain64\n" +
+              "Hash spec:     \tsha256\nPayload offset:\t4096\nMK bits:       \t256\n")
+    elif command == "open":
+        device,name = positional[1:3]
+        keys = check_luks(db, device)
+        if keys == 0 or "key-file" not in options.keys() or not os.path.exists(options["key-file"]):
+            raise ToolError("No key available with this passphrase.", 2)
+        # the key derivation, as if on a core of its own
+        time.sleep(float(get_config(db, "pbkdf-seconds")))
+        path = os.path.join(device_directory(get_root(), "mapper"), name)
+        if os.path.exists(path):
+            raise ToolError("Device " + name + " already exists.", 5)
+        open(path, "a").close()
+        db.execute("INSERT OR REPLACE INTO mappings VALUES (?, ?)", (name, device))
+    elif command == "close":
+        path = os.path.join(device_directory(get_root(), "mapper"), positional[1])
+        if not os.path.exists(path):
+            raise ToolError("Device " + positional[1] + " is not active.", 4)
+        if db.execute("SELECT 1 FROM pools WHERE device=? AND imported=1", (path,)).fetchone() != None:
+            raise ToolError("Device " + positional[1] + " is still in use.", 5)
+        os.remove(path)
+        db.execute("DELETE FROM mappings WHERE name=?", (positional[1],))
+    else:
+        raise ToolError("Unknown action.", 1)
+
+# sgdisk
+
+def sgdisk(db, args):
+    options,positional = parse_options(args, "ntc")
+    device = positional[0]
+
+    if not os.path.exists(device):
+        raise ToolError("Problem opening " + device + " for reading!", 2)
+
+    if "n" in options.keys():
+        # one partition, named like in /dev/disk/by-id
+        open(device + "-part1", "a").close()
+
+    print("The operation has completed successfully.")
+
+# sendmail
+
+def sendmail(db, args):
+    message = sys.stdin.buffer.read()
+    path = os.path.join(get_root(), "mail", "%.6f-%d.eml" % (time.time(), os.getpid()))
+    with open(path, "wb") as mail_file:
+        mail_file.write(message)
+
+def systemctl(db, args):
+    pass
+
+def log_process(root, tool, args):
+    with open(os.path.join(root, "processes.log"), "a") as log:
+        log.write(" ".join([tool] + args).replace("\n", " ") + "\n")
+
+def install(bindir):
+    os.makedirs(bindir, exist_ok=True)
+    script = os.path.realpath(__file__)
+    for tool in tools:
+        path = os.path.join(bindir, tool)
+        if os.path.lexists(path):
+            os.remove(path)
+        os.symlink(script, path)
+
+def main():
+    tool = os.path.basename(sys.argv[0])
+    args = sys.argv[1:]
+
+    if tool not in tools:
+        if len(args) == 2 and args[0] == "install":
+            install(args[1])
+            return 0
+        print("usage: " + tool + " install BINDIR", file=sys.stderr)
+        return 2
+
+    try:
+        root = get_root()
+        log_process(root, tool, args)
+        db = open_state(root)
+        globals()[tool](db, args)
+    except ToolError as e:
+        print(str(e), file=sys.stderr)
+        return e.returncode
+    except BrokenPipeError:
+        return 1
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
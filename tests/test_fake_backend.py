@@ -0,0 +1,164 @@
+import os
+import sys
+import unittest
+
+repository = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, repository)
+
+import common
+import pool
+import zfsbackend
+import backup_functions
+
+# The backups, diffs and health checks of backup_functions and pool against
+# the in-memory FakeBackend, with a pool "tank" to back up and the backup
+# pools "backup0" and "backup1"
+class FakeBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.backend = zfsbackend.FakeBackend()
+        for name in ["tank", "backup0", "backup1"]:
+            self.backend.add_pool(name)
+        self.backend.add_dataset("tank/home")
+        self.backend.add_dataset("tank/home/user")
+        self.backend.write_file("tank/home", "/notes", 1000)
+        self.backend.write_file("tank/home/user", "/photo", 5000000)
+
+        settings = {"backup-disks": [{"zpool": "backup0"}, {"zpool": "backup1"}]}
+        self.use_settings(settings)
+
+        zfsbackend.set_backend(self.backend)
+        self.addCleanup(zfsbackend.set_backend, None)
+        self.addCleanup(self.invalidate)
+        self.invalidate()
+
+    def use_settings(self, settings):
+        self.addCleanup(setattr, common, "settings", common.settings)
+        common.settings = settings
+
+    def invalidate(self):
+        pool.invalidate_pool_states()
+        for name in ["tank", "backup0", "backup1"]:
+            backup_functions.invalidate_snapshot_catalog(name)
+
+    def assertBackedUp(self, backup_pool, snapshot):
+        for dataset in ["", "/home", "/home/user"]:
+            source = self.backend.snapshot("tank" + dataset + "@" + snapshot)
+            backup = self.backend.snapshot(backup_pool + dataset + "@" + snapshot)
+            self.assertEqual(backup.guid, source.guid)
+            self.assertEqual(backup.files, source.files)
+
+    def first_and_incremental_backup(self):
+        backup_functions.create_snapshot("tank", "backup0_2024-01-01_1")
+        backup_made,errormsg,stats = backup_functions.perform_first_backup("tank", "backup0", "backup0_2024-01-01_1")
+        self.assertTrue(backup_made, errormsg)
+        self.assertBackedUp("backup0", "backup0_2024-01-01_1")
+
+        self.backend.write_file("tank/home/user", "/photo", 6000000)
+        self.backend.write_file("tank/home", "/new", 10)
+        backup_functions.create_snapshot("tank", "backup0_2024-01-01_2")
+        backup_made,errormsg,stats = backup_functions.perform_incremental_backup("tank", "backup0", "backup0_2024-01-01_1", "backup0_2024-01-01_2")
+        self.assertTrue(backup_made, errormsg)
+        self.assertBackedUp("backup0", "backup0_2024-01-01_2")
+
+        return stats
+
+    def test_first_and_incremental_backup(self):
+        stats = self.first_and_incremental_backup()
+        self.assertEqual(stats, None)
+
+    def test_first_and_incremental_backup_relayed(self):
+        self.use_settings(dict(common.settings, **{"send-relay": True}))
+        stats = self.first_and_incremental_backup()
+        self.assertGreater(stats.bytes, 0)
+
+    def test_incremental_backup_of_other_snapshot_fails(self):
+        backup_functions.create_snapshot("tank", "backup0_2024-01-01_1")
+        backup_functions.create_snapshot("tank", "backup0_2024-01-01_2")
+        backup_functions.create_snapshot("tank", "backup0_2024-01-01_3")
+        backup_functions.perform_first_backup("tank", "backup0", "backup0_2024-01-01_1")
+
+        # backup0 does not have backup0_2
+        with self.assertRaises(Exception):
+            backup_functions.perform_incremental_backup("tank", "backup0", "backup0_2024-01-01_2", "backup0_2024-01-01_3")
+
+    def test_fan_out_backup(self):
+        backup_functions.create_snapshot("tank", "backup0:backup1_2024-01-01_1")
+        results = backup_functions.perform_fan_out_backup("tank", ["backup0", "backup1"], None, "backup0:backup1_2024-01-01_1")
+
+        for backup_pool in ["backup0", "backup1"]:
+            backup_made,errormsg,stats = results[backup_pool]
+            self.assertTrue(backup_made, errormsg)
+            self.assertBackedUp(backup_pool, "backup0:backup1_2024-01-01_1")
+
+    def test_fan_out_backup_with_failing_receiver(self):
+        backup_functions.create_snapshot("tank", "backup0:backup1_2024-01-01_1")
+        backup_functions.perform_first_backup("tank", "backup1", "backup0:backup1_2024-01-01_1")
+        backup_functions.create_snapshot("tank", "backup0:backup1_2024-01-01_2")
+
+        # backup0 has no snapshot to receive the incremental stream on
+        results = backup_functions.perform_fan_out_backup("tank", ["backup0", "backup1"], "backup0:backup1_2024-01-01_1", "backup0:backup1_2024-01-01_2")
+
+        self.assertFalse(results["backup0"][0])
+        self.assertTrue(results["backup1"][0], results["backup1"][1])
+        self.assertBackedUp("backup1", "backup0:backup1_2024-01-01_2")
+
+    def test_release_shared_snapshot(self):
+        backup_functions.create_snapshot("tank", "backup0:backup1_2024-01-01_1")
+
+        self.assertFalse(backup_functions.release_snapshot("tank", "backup0:backup1_2024-01-01_1", "backup0"))
+        self.assertFalse(backup_functions.release_snapshot("tank", "backup0:backup1_2024-01-01_1", "backup0"))
+        self.assertEqual(backup_functions.get_snapshot_property("tank", "backup0:backup1_2024-01-01_1", backup_functions.released_property), "backup0")
+        self.assertTrue(backup_functions.release_snapshot("tank", "backup0:backup1_2024-01-01_1", "backup1"))
+        self.assertFalse(backup_functions.snapshot_exists("tank", "backup0:backup1_2024-01-01_1"))
+
+    def diff_text(self):
+        backup_functions.create_snapshot("tank", "backup0_2024-01-01_1")
+        self.backend.write_file("tank/home", "/notes", 2000)
+        self.backend.write_file("tank/home/user", "/new", 10)
+        self.backend.remove_file("tank/home/user", "/photo")
+        backup_functions.create_snapshot("tank", "backup0_2024-01-01_2")
+
+        with backup_functions.create_diff("tank", "backup0_2024-01-01_1", "backup0_2024-01-01_2") as diff_file:
+            diff_file.seek(0)
+            return diff_file.read()
+
+    def test_diff(self):
+        text = self.diff_text()
+        lines = [line.split('\t') for line in text.splitlines() if '\t' in line]
+
+        self.assertEqual([(line[0], line[3]) for line in lines], [("M", "/tank/home/notes"), ("+", "/tank/home/user/new"), ("-", "/tank/home/user/photo")])
+        self.assertLess(text.index("tank/home ("), text.index("tank/home/user ("))
+
+    def test_parallel_diff(self):
+        text = self.diff_text()
+        self.use_settings(dict(common.settings, **{"parallel-diffs": 4}))
+        self.invalidate()
+
+        with backup_functions.create_diff("tank", "backup0_2024-01-01_1", "backup0_2024-01-01_2") as diff_file:
+            diff_file.seek(0)
+            self.assertEqual(diff_file.read(), text)
+
+    def test_no_diff(self):
+        backup_functions.create_snapshot("tank", "backup0_2024-01-01_1")
+        backup_functions.create_snapshot("tank", "backup0_2024-01-01_2")
+
+        with backup_functions.create_diff("tank", "backup0_2024-01-01_1", "backup0_2024-01-01_2") as diff_file:
+            self.assertEqual(diff_file.tell(), 0)
+
+    def test_health(self):
+        healthy,msg = pool.pool_is_healthy("backup0")
+        self.assertTrue(healthy)
+
+        self.backend.pools["backup0"]["health"] = "DEGRADED"
+        pool.invalidate_pool_states()
+        healthy,msg = pool.pool_is_healthy("backup0")
+        self.assertFalse(healthy)
+        self.assertIn("DEGRADED", msg)
+
+        self.backend.export_pool("backup1")
+        pool.invalidate_pool_states()
+        with self.assertRaises(Exception):
+            pool.pool_is_healthy("backup1")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import os
+import sys
+import time
+import threading
+import unittest
+
+repository = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, repository)
+sys.path.insert(0, os.path.join(repository, "sim"))
+
+import backup_functions
+import imapserver
+
+# wait_for_mail_reply() against the IMAP stand-in in sim/imapserver.py, which
+# replies to the approval mail after reply_delay seconds
+class MailApprovalTest(unittest.TestCase):
+    def start_server(self, reply, reply_delay, idle=True):
+        server = imapserver.IMAPServer(("localhost", 0), imapserver.IMAPHandler)
+        server.mailbox = imapserver.Mailbox(reply, reply_delay)
+        server.idle = idle
+
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        return server
+
+    def wait_for_reply(self, server, timeout, idle=True):
+        approve_settings = {"imap-server": "localhost", "imap-port": server.server_address[1], "imap-ssl": False, "imap-idle": idle,
+                            "imap-account": "backup", "imap-password": "secret", "timeout": timeout}
+
+        start = time.monotonic()
+        approved = backup_functions.wait_for_mail_reply(approve_settings, "RANDOMSTRING")
+        return approved, time.monotonic() - start
+
+    def setUp(self):
+        # a missed notification makes the test fail instead of waiting for
+        # the next IDLE or poll
+        for name,value in [("imap_idle_interval", 30), ("imap_poll_interval", 0.2)]:
+            self.addCleanup(setattr, backup_functions, name, getattr(backup_functions, name))
+            setattr(backup_functions, name, value)
+
+    def test_approved_with_idle(self):
+        server = self.start_server("yes", 0.5)
+        approved,seconds = self.wait_for_reply(server, 20)
+
+        self.assertTrue(approved)
+        self.assertLess(seconds, 10)
+
+    def test_reply_before_idle(self):
+        # the reply arrives before IDLE is sent and is reported together
+        # with the continuation, already buffered by imaplib
+        server = self.start_server("yes", 0)
+        approved,seconds = self.wait_for_reply(server, 20)
+
+        self.assertTrue(approved)
+        self.assertLess(seconds, 10)
+
+    def test_declined(self):
+        server = self.start_server("no", 0.5)
+        approved,seconds = self.wait_for_reply(server, 20)
+
+        self.assertFalse(approved)
+        self.assertLess(seconds, 10)
+
+    def test_approved_with_polling(self):
+        server = self.start_server("yes", 0.5, idle=False)
+        approved,seconds = self.wait_for_reply(server, 20, idle=False)
+
+        self.assertTrue(approved)
+        self.assertLess(seconds, 10)
+
+    def test_timeout(self):
+        server = self.start_server("yes", 60)
+        approved,seconds = self.wait_for_reply(server, 2)
+
+        self.assertFalse(approved)
+        self.assertGreaterEqual(seconds, 2)
+        self.assertLess(seconds, 10)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+import os
+import sys
+import random
+import threading
+import unittest
+
+repository = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, repository)
+
+import relay
+
+# StreamBuffer with a reading and a writing thread, for combinations of
+# buffer sizes, chunk sizes and levels that could leave both threads waiting
+class StreamBufferTest(unittest.TestCase):
+    def transfer(self, size, write_start, read_resume, chunk_sizes, total):
+        buffer = relay.StreamBuffer(size, write_start, read_resume)
+        random.seed(size + write_start + read_resume)
+        written = [0]
+        received = [0]
+
+        def reader():
+            while written[0] < total:
+                chunk = b'x' * min(random.choice(chunk_sizes), total - written[0])
+                buffer.put(chunk)
+                written[0] += len(chunk)
+            buffer.finish()
+
+        def writer():
+            while True:
+                chunk = buffer.get()
+                if len(chunk) == 0:
+                    break
+                received[0] += len(chunk)
+
+        threads = [threading.Thread(target=reader, daemon=True), threading.Thread(target=writer, daemon=True)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+
+        self.assertFalse(any([thread.is_alive() for thread in threads]), "deadlock with write_start=" + str(write_start) + ", read_resume=" + str(read_resume))
+        self.assertEqual(received[0], total)
+
+    def test_levels(self):
+        for size in [relay.chunk_size, 2*relay.chunk_size]:
+            for write_start in [0, 10, 50, 94, 99, 100]:
+                for read_resume in [0, 10, 90, 100]:
+                    with self.subTest(size=size, write_start=write_start, read_resume=read_resume):
+                        self.transfer(size, write_start, read_resume, [64*1024, 70*1024, relay.chunk_size], 8*relay.chunk_size)
+
+    def test_too_small(self):
+        with self.assertRaises(Exception):
+            relay.StreamBuffer(relay.chunk_size - 1, 0, 100)
+
+    def test_percent_out_of_range(self):
+        with self.assertRaises(Exception):
+            relay.StreamBuffer(relay.chunk_size, 101, 100)
+
+if __name__ == "__main__":
+    unittest.main()
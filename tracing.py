@@ -0,0 +1,170 @@
+import os
+import json
+import time
+import datetime
+import itertools
+import threading
+import contextlib
+
+import common
+
+# Timing spans for the steps of a run: snapshot creation, LUKS open, pool
+# import, diff, approval, send/recv, verification, pruning, scrub and so on.
+# Spans are nested: the run, the disks and the steps of each disk. A span
+# started in a thread without an open span (a disk backed up in parallel, the
+# approval) belongs to the run.
+#
+# With the setting
+#   "trace": {"file": "/var/log/zfs-offline-backup.trace", "summary": true}
+# every finished span is appended to the file as a JSON line, and a table of
+# the time spent per step is printed at the end of the run.
+
+class Span:
+    def __init__(self, name, parent, attributes):
+        self.id = next(span_ids)
+        self.name = name
+        self.parent = parent
+        self.attributes = attributes
+        self.start = time.time()
+        self.end = None
+        self.bytes = None
+        self.outcome = "ok"
+        self.error = None
+
+        # the disk of a step is the disk of the span it is part of
+        if parent != None and "disk" in parent.attributes.keys() and "disk" not in attributes.keys():
+            self.attributes["disk"] = parent.attributes["disk"]
+
+    def seconds(self):
+        end = self.end if self.end != None else time.time()
+        return end - self.start
+
+    def add_bytes(self, count):
+        self.bytes = count if self.bytes == None else self.bytes + count
+
+    def failed(self, error=None):
+        self.outcome = "error"
+        if error != None:
+            self.error = str(error)
+
+    def record(self):
+        record = {"run": run_id, "span": self.id, "parent": self.parent.id if self.parent != None else None, "name": self.name,
+                  "start": round(self.start, 6), "end": round(self.end, 6) if self.end != None else None, "seconds": round(self.seconds(), 6),
+                  "outcome": self.outcome}
+        if self.bytes != None:
+            record["bytes"] = self.bytes
+        if self.error != None:
+            record["error"] = self.error
+        record.update(self.attributes)
+        return record
+
+span_ids = itertools.count(1)
+run_id = None
+run_span = None
+finished_spans = list()
+trace_lock = threading.Lock()
+local = threading.local()   # the open spans of each thread
+
+def get_trace_settings():
+    settings = common.get_settings()
+    return settings["trace"] if settings != None and "trace" in settings.keys() else dict()
+
+def current_span():
+    stack = getattr(local, "stack", None)
+    return stack[-1] if stack else run_span
+
+def start_span(name, **attributes):
+    new_span = Span(name, current_span(), attributes)
+
+    if getattr(local, "stack", None) == None:
+        local.stack = list()
+    local.stack.append(new_span)
+
+    return new_span
+
+def end_span(ended_span):
+    ended_span.end = time.time()
+
+    if ended_span in local.stack:
+        local.stack.remove(ended_span)
+
+    with trace_lock:
+        finished_spans.append(ended_span)
+        write_span(ended_span)
+
+# with tracing.span("pool-import", pool=name) as s: ... The span fails if an
+# exception passes through, s.failed() marks other failures.
+@contextlib.contextmanager
+def span(name, **attributes):
+    new_span = start_span(name, **attributes)
+    try:
+        yield new_span
+    except BaseException as e:
+        new_span.failed(e)
+        raise
+    finally:
+        end_span(new_span)
+
+def write_span(ended_span):
+    trace_settings = get_trace_settings()
+
+    if "file" not in trace_settings.keys():
+        return
+
+    try:
+        with open(trace_settings["file"], "a") as trace_file:
+            trace_file.write(json.dumps(ended_span.record()) + "\n")
+    except OSError as e:
+        # tracing must never stop a backup
+        print("Could not write trace to " + trace_settings["file"] + ": " + str(e), flush=True)
+
+def start_run(command):
+    global run_id
+    global run_span
+
+    run_id = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S") + "-" + str(os.getpid())
+    run_span = Span("run", None, {"command": command})
+
+# ends the run and returns the summary table, or None if it is not wanted
+def end_run(failed=False):
+    if run_span == None:
+        return None
+
+    if failed:
+        run_span.failed()
+
+    run_span.end = time.time()
+    with trace_lock:
+        write_span(run_span)
+
+    trace_settings = get_trace_settings()
+    if len(trace_settings) == 0 or not trace_settings.get("summary", True):
+        return None
+
+    return summary()
+
+# The time, count, bytes and failures per step and disk, in the order the
+# steps were first started. The time of a span includes the spans in it.
+def summary():
+    rows = dict()
+
+    with trace_lock:
+        for finished_span in sorted(finished_spans, key=lambda s: s.start):
+            key = (finished_span.name, finished_span.attributes.get("disk", "-"))
+            if key not in rows.keys():
+                rows[key] = {"count": 0, "seconds": 0.0, "bytes": None, "errors": 0}
+            row = rows[key]
+            row["count"] += 1
+            row["seconds"] += finished_span.seconds()
+            row["errors"] += 1 if finished_span.outcome != "ok" else 0
+            if finished_span.bytes != None:
+                row["bytes"] = finished_span.bytes + (row["bytes"] if row["bytes"] != None else 0)
+
+    lines = ["Trace summary (run " + run_id + ", %.1f s, %s)" % (run_span.seconds(), run_span.outcome),
+             "  %-24s %-20s %5s %10s %10s %6s" % ("Step", "Disk", "Count", "Seconds", "Bytes", "Errors")]
+
+    for (name,disk),row in rows.items():
+        lines.append("  %-24s %-20s %5d %10.1f %10s %6d" % (name, disk, row["count"], row["seconds"],
+                     common.format_bytes(row["bytes"]) if row["bytes"] != None else "-", row["errors"]))
+
+    return "\n".join(lines)
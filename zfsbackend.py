@@ -0,0 +1,709 @@
+import os
+import io
+import abc
+import re
+import json
+import time
+import random
+import threading
+import subprocess
+
+import common
+import commands
+
+try:
+    import libzfs_core
+except ImportError:
+    libzfs_core = None
+
+# All interaction with ZFS goes through a backend, selected with the setting
+# "zfs-backend":
+#   "cli"           runs the zfs and zpool commands (default)
+#   "libzfs_core"   uses pyzfs for the operations libzfs_core supports and the
+#                   commands for the rest
+#
+# FakeBackend keeps pools in memory, for trying things out and for benchmarks
+# without real pools. It starts empty, so it is not selectable in the config
+# but set up in code and installed with set_backend().
+#
+# Sizes and numbers are returned as exact values (like -p). send, recv and
+# diff return objects that behave like subprocess.Popen.
+
+class ZFSBackend(abc.ABC):
+    # snapshots, all recursive
+    @abc.abstractmethod
+    def create_snapshots(self, pool, snapshot_names): pass
+    @abc.abstractmethod
+    def rename_snapshot(self, pool, old_snapshot_name, new_snapshot_name): pass
+    @abc.abstractmethod
+    def destroy_snapshot(self, pool, snapshot_name): pass
+
+    # returns a list of rows, each a list of the values of properties
+    @abc.abstractmethod
+    def list(self, root, types, properties, depth=None, sort=None): pass
+
+    # Returns a list of (name, property, value). Raises only if no value at
+    # all could be read, some datasets may be missing.
+    @abc.abstractmethod
+    def get(self, name, properties, recursive=False, types=None): pass
+    @abc.abstractmethod
+    def set(self, name, property_name, value): pass
+    @abc.abstractmethod
+    def exists(self, name): pass
+
+    # send, recv and diff
+    @abc.abstractmethod
+    def send(self, pool, new_snapshot, prev_snapshot=None, flags="", **popen_arguments): pass
+    @abc.abstractmethod
+    def send_resume(self, token, **popen_arguments): pass
+    @abc.abstractmethod
+    def estimate_send_size(self, pool, new_snapshot, prev_snapshot=None, flags=""): pass
+    @abc.abstractmethod
+    def recv(self, target, flags, **popen_arguments): pass
+    @abc.abstractmethod
+    def abort_receive(self, dataset): pass
+    @abc.abstractmethod
+    def diff(self, dataset, prev_snapshot, new_snapshot, **popen_arguments): pass
+
+    # pools
+    @abc.abstractmethod
+    def create_pool(self, name, device): pass
+    # device: search only this device or directory instead of all devices
+    # read_cachefile: take the configuration from this cachefile, no search
+    # cachefile: keep the configuration in this cachefile while imported
+    @abc.abstractmethod
+    def import_pool(self, name, device=None, read_cachefile=None, cachefile=None): pass
+    @abc.abstractmethod
+    def export_pool(self, name): pass
+    @abc.abstractmethod
+    def list_pools(self, properties): pass
+    # the output of "zpool status -x"
+    @abc.abstractmethod
+    def unhealthy_pools_status(self): pass
+    # the output of "zpool status <name>"
+    @abc.abstractmethod
+    def pool_status(self, name): pass
+    # like "zpool status -j --json-int", None if not supported
+    @abc.abstractmethod
+    def pool_status_json(self, name): pass
+    # returns True if started
+    @abc.abstractmethod
+    def start_scrub(self, name): pass
+    # returns False if waiting is not supported
+    @abc.abstractmethod
+    def wait_scrub(self, name, timeout=None): pass
+
+
+def run(cmd, check=True):
+    cpinst = commands.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    if check and cpinst.returncode != 0:
+        raise Exception("Error in \"" + cmd + "\":" + cpinst.stderr.decode("utf-8"))
+
+    return cpinst
+
+class CLIBackend(ZFSBackend):
+    def create_snapshots(self, pool, snapshot_names):
+        run("zfs snapshot -r " + " ".join([pool + "@" + snapshot_name for snapshot_name in snapshot_names]))
+
+    def rename_snapshot(self, pool, old_snapshot_name, new_snapshot_name):
+        run("zfs rename -r " + pool + "@" + old_snapshot_name + " @" + new_snapshot_name)
+
+    def destroy_snapshot(self, pool, snapshot_name):
+        run("zfs destroy -r " + pool + "@" + snapshot_name)
+
+    def list(self, root, types, properties, depth=None, sort=None):
+        # -H: without headers and with single tab between columns
+        # -p: exact values
+        cmd = "zfs list -H -p -r " + ("-d " + str(depth) + " " if depth != None else "") + "-t " + types + " -o " + ",".join(properties) + " " + ("-s " + sort + " " if sort != None else "") + root
+        return [line.split('\t') for line in run(cmd).stdout.decode("utf-8").splitlines()]
+
+    def get(self, name, properties, recursive=False, types=None):
+        cmd = "zfs get -H -p " + ("-r " if recursive else "") + ("-t " + types + " " if types != None else "") + "-o name,property,value " + ",".join(properties) + " " + name
+        cpinst = run(cmd, check=False)
+        stdout = cpinst.stdout.decode("utf-8")
+
+        # zfs get may fail for some datasets but still give the value for the others
+        if cpinst.returncode != 0 and len(stdout) == 0:
+            raise Exception("Error in \"" + cmd + "\":" + cpinst.stderr.decode("utf-8"))
+
+        return [tuple(line.split('\t')) for line in stdout.splitlines()]
+
+    def set(self, name, property_name, value):
+        run("zfs set " + property_name + "=" + value + " " + name)
+
+    def exists(self, name):
+        cmd = "zfs list -H " + name
+        cpinst = run(cmd, check=False)
+
+        if cpinst.returncode == 1 and re.search("does not exist", cpinst.stderr.decode("utf-8")):
+            return False
+        elif cpinst.returncode != 0:
+            raise Exception("Error in \"" + cmd + "\":" + cpinst.stderr.decode("utf-8"))
+        else:
+            return True
+
+    def send_arguments(self, pool, new_snapshot, prev_snapshot, flags):
+        if prev_snapshot == None:
+            return ("zfs send -R " + flags + pool + "@" + new_snapshot).split()
+        else:
+            return ("zfs send -R " + flags + "-I " + pool + "@" + prev_snapshot + " " + pool + "@" + new_snapshot).split()
+
+    def send(self, pool, new_snapshot, prev_snapshot=None, flags="", **popen_arguments):
+        return commands.popen(self.send_arguments(pool, new_snapshot, prev_snapshot, flags), **popen_arguments)
+
+    def send_resume(self, token, **popen_arguments):
+        return commands.popen(["zfs", "send", "-t", token], **popen_arguments)
+
+    def estimate_send_size(self, pool, new_snapshot, prev_snapshot=None, flags=""):
+        # -n: dry run, -v: print the estimate, -P: in a parseable format
+        cmd = self.send_arguments(pool, new_snapshot, prev_snapshot, "-nvP " + flags)
+        cpinst = commands.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        if cpinst.returncode != 0:
+            return None
+
+        # depending on the version of zfs the estimate is written to stdout or stderr
+        output = cpinst.stdout.decode("utf-8") + cpinst.stderr.decode("utf-8")
+        match = re.search("^size\t([0-9]+)$", output, re.MULTILINE)
+
+        return int(match[1]) if match != None else None
+
+    def recv(self, target, flags, **popen_arguments):
+        return commands.popen(["zfs", "recv"] + flags.split() + [target], **popen_arguments)
+
+    def abort_receive(self, dataset):
+        run("zfs recv -A " + dataset)
+
+    def diff(self, dataset, prev_snapshot, new_snapshot, **popen_arguments):
+        return commands.popen(["zfs", "diff", "-FHt", dataset + "@" + prev_snapshot, dataset + "@" + new_snapshot], **popen_arguments)
+
+    def create_pool(self, name, device):
+        run("zpool create -o ashift=12 " + name + " " + device)
+
+    def import_pool(self, name, device=None, read_cachefile=None, cachefile=None):
+        run("zpool import -N " + ("-d " + device + " " if device != None else "") + ("-c " + read_cachefile + " " if read_cachefile != None else "") +
+            ("-o cachefile=" + cachefile + " " if cachefile != None else "") + name)
+
+    def export_pool(self, name):
+        run("zpool export " + name)
+
+    def list_pools(self, properties):
+        return [line.split('\t') for line in run("zpool list -H -p -o " + ",".join(properties)).stdout.decode("utf-8").splitlines()]
+
+    def unhealthy_pools_status(self):
+        return run("zpool status -x").stdout.decode("utf-8")
+
+    def pool_status(self, name):
+        return run("zpool status " + name).stdout.decode("utf-8")
+
+    def pool_status_json(self, name):
+        cpinst = run("zpool status -j --json-int " + name, check=False)
+        return json.loads(cpinst.stdout.decode("utf-8")) if cpinst.returncode == 0 else None
+
+    def start_scrub(self, name):
+        return run("zpool scrub " + name, check=False).returncode == 0
+
+    def wait_scrub(self, name, timeout=None):
+        try:
+            cpinst = commands.run(["zpool", "wait", "-t", "scrub", name], stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            return True
+
+        return cpinst.returncode == 0
+
+# Uses libzfs_core (pyzfs) for creating and destroying snapshots and checking
+# if datasets exist, which then need no processes. Recursive renames, send
+# with -R, properties and pools are not supported by libzfs_core and go
+# through the commands.
+class LibZFSCoreBackend(CLIBackend):
+    def datasets(self, pool):
+        return [row[0] for row in self.list(pool, "filesystem,volume", ["name"])]
+
+    def create_snapshots(self, pool, snapshot_names):
+        # all snapshots of all datasets are created atomically, like zfs snapshot -r
+        libzfs_core.lzc_snapshot([(dataset + "@" + snapshot_name).encode("utf-8") for dataset in self.datasets(pool) for snapshot_name in snapshot_names])
+
+    def destroy_snapshot(self, pool, snapshot_name):
+        # all in one call, which is atomic and ignores datasets without the snapshot
+        libzfs_core.lzc_destroy_snaps([(dataset + "@" + snapshot_name).encode("utf-8") for dataset in self.datasets(pool)], False)
+
+    def exists(self, name):
+        return libzfs_core.lzc_exists(name.encode("utf-8"))
+
+# A process run in a thread of this process, behaving like subprocess.Popen
+# for the arguments and methods used with the backends. target(stdin, stdout,
+# stderr) gets binary file objects (or None) and returns the exit code.
+class FakeProcess:
+    def __init__(self, args, target, stdin=None, stdout=None, stderr=None, encoding=None):
+        self.args = args
+        self.returncode = None
+        self.killed = False
+        self.reader = None
+        self.output = None
+        self.stdin = self.stdout = self.stderr = None
+        self.stderr_buffer = None
+
+        child_stdin = self.child_file(stdin, "rb")
+        if stdin == subprocess.PIPE:
+            read_fd,write_fd = os.pipe()
+            child_stdin = os.fdopen(read_fd, "rb")
+            self.stdin = os.fdopen(write_fd, "wb") if encoding == None else os.fdopen(write_fd, "w", encoding=encoding)
+
+        child_stdout = self.child_file(stdout, "wb")
+        if stdout == subprocess.PIPE:
+            read_fd,write_fd = os.pipe()
+            child_stdout = os.fdopen(write_fd, "wb")
+            self.stdout = os.fdopen(read_fd, "rb") if encoding == None else os.fdopen(read_fd, "r", encoding=encoding)
+
+        child_stderr = self.child_file(stderr, "wb")
+        if stderr == subprocess.PIPE:
+            self.stderr_buffer = io.BytesIO()
+            child_stderr = self.stderr_buffer
+
+        self.thread = threading.Thread(target=self.run, args=(target, child_stdin, child_stdout, child_stderr), daemon=True)
+        self.thread.start()
+
+    # the child gets its own file descriptor, like a real child process
+    def child_file(self, stream, mode):
+        if stream == None or stream == subprocess.PIPE:
+            return None
+        if stream == subprocess.DEVNULL:
+            return open(os.devnull, mode)
+        return os.fdopen(os.dup(stream if type(stream) == int else stream.fileno()), mode)
+
+    def run(self, target, stdin, stdout, stderr):
+        try:
+            returncode = target(stdin, stdout, stderr)
+        except BrokenPipeError:
+            returncode = 1
+        except Exception as e:
+            if stderr != None:
+                stderr.write(str(e).encode("utf-8") + b"\n")
+            returncode = 1
+        finally:
+            for stream in [stdin, stdout, stderr]:
+                if stream != None and stream != self.stderr_buffer:
+                    try:
+                        stream.close()
+                    except OSError:
+                        pass
+
+        self.returncode = -9 if self.killed else returncode
+
+    def poll(self):
+        return self.returncode if not self.thread.is_alive() else None
+
+    def wait(self, timeout=None):
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            raise subprocess.TimeoutExpired(self.args, timeout)
+        return self.returncode
+
+    def kill(self):
+        self.killed = True
+        # unblock the thread by closing our ends of the pipes
+        for stream in [self.stdin, self.stdout]:
+            if stream != None:
+                try:
+                    stream.close()
+                except OSError:
+                    pass
+
+    def communicate(self, input=None, timeout=None):
+        end_time = time.monotonic() + timeout if timeout != None else None
+        
+        if self.stdin != None and not self.stdin.closed:
+            try:
+                if input != None:
+                    self.stdin.write(input)
+                self.stdin.close()
+            except BrokenPipeError:
+                pass
+        
+        # stdout is read in a thread that a later call continues to wait for
+        # if the timeout expires
+        if self.reader == None and self.stdout != None:
+            self.reader = threading.Thread(target=self.read_output, daemon=True)
+            self.reader.start()
+        if self.reader != None:
+            self.reader.join(timeout)
+            if self.reader.is_alive():
+                raise subprocess.TimeoutExpired(self.args, timeout)
+        
+        self.wait(max(0, end_time - time.monotonic()) if end_time != None else None)
+        return (self.output, self.stderr_buffer.getvalue() if self.stderr_buffer != None else None)
+
+    def read_output(self):
+        self.output = self.stdout.read()
+
+class FakeSnapshot:
+    def __init__(self, guid, createtxg, files, properties):
+        self.guid = guid
+        self.createtxg = createtxg
+        self.files = files              # path: (size, version)
+        self.properties = properties    # user properties
+
+class FakeDataset:
+    def __init__(self):
+        self.files = dict()             # path: (size, version)
+        self.snapshots = dict()         # name: FakeSnapshot, in creation order
+        self.properties = dict()
+
+# Pools, datasets, snapshots and files in memory. Files have a size and a
+# version, which is enough for written, referenced and diff.
+class FakeBackend(ZFSBackend):
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.pools = dict()     # name: dict with "imported", "health", "size", "scrub"
+        self.datasets = dict()  # name: FakeDataset
+        self.txg = 1
+        self.version = 1
+
+    # helpers for setting up the state
+    def add_pool(self, name, size=1024**4, imported=True):
+        with self.lock:
+            self.pools[name] = {"imported": imported, "health": "ONLINE", "size": size, "scrub": None}
+            self.datasets[name] = FakeDataset()
+
+    def add_dataset(self, name):
+        with self.lock:
+            self.datasets[name] = FakeDataset()
+
+    def write_file(self, dataset, path, size):
+        with self.lock:
+            self.version += 1
+            self.datasets[dataset].files[path] = (size, self.version)
+
+    def remove_file(self, dataset, path):
+        with self.lock:
+            del self.datasets[dataset].files[path]
+
+    def pool_of(self, name):
+        return name.split('@')[0].split('/')[0]
+
+    def check_imported(self, name):
+        pool = self.pool_of(name)
+        if pool not in self.pools or not self.pools[pool]["imported"]:
+            raise Exception("cannot open '" + name + "': dataset does not exist")
+
+    def datasets_of(self, pool):
+        return [name for name in self.datasets if name == pool or name.startswith(pool + "/")]
+
+    def snapshot(self, name):
+        dataset,_,snapshot_name = name.partition('@')
+        if dataset not in self.datasets or snapshot_name not in self.datasets[dataset].snapshots:
+            raise Exception("cannot open '" + name + "': dataset does not exist")
+        return self.datasets[dataset].snapshots[snapshot_name]
+
+    def new_guid(self):
+        return str(random.getrandbits(63))
+
+    def create_snapshots(self, pool, snapshot_names):
+        with self.lock:
+            self.check_imported(pool)
+            datasets = self.datasets_of(pool)
+            for dataset in datasets:
+                for snapshot_name in snapshot_names:
+                    if snapshot_name in self.datasets[dataset].snapshots:
+                        raise Exception("cannot create snapshot '" + dataset + "@" + snapshot_name + "': dataset already exists")
+            self.txg += 1
+            for dataset in datasets:
+                for snapshot_name in snapshot_names:
+                    self.datasets[dataset].snapshots[snapshot_name] = FakeSnapshot(self.new_guid(), self.txg, dict(self.datasets[dataset].files), dict())
+
+    def rename_snapshot(self, pool, old_snapshot_name, new_snapshot_name):
+        with self.lock:
+            self.snapshot(pool + "@" + old_snapshot_name)
+            for dataset in self.datasets_of(pool):
+                snapshots = self.datasets[dataset].snapshots
+                if old_snapshot_name in snapshots:
+                    self.datasets[dataset].snapshots = {(new_snapshot_name if name == old_snapshot_name else name): snapshot for name,snapshot in snapshots.items()}
+
+    def destroy_snapshot(self, pool, snapshot_name):
+        with self.lock:
+            self.snapshot(pool + "@" + snapshot_name)
+            for dataset in self.datasets_of(pool):
+                self.datasets[dataset].snapshots.pop(snapshot_name, None)
+
+    def property_value(self, name, property_name):
+        dataset,_,snapshot_name = name.partition('@')
+        files = self.snapshot(name).files if snapshot_name != '' else self.datasets[dataset].files
+
+        if property_name == "name":
+            return name
+        elif property_name == "guid":
+            return self.snapshot(name).guid if snapshot_name != '' else str(abs(hash(dataset)))
+        elif property_name == "createtxg":
+            return str(self.snapshot(name).createtxg) if snapshot_name != '' else "1"
+        elif property_name in ["referenced", "used"]:
+            return str(sum([size for size,version in files.values()]))
+        elif property_name.startswith("written@"):
+            prev_files = self.snapshot(dataset + "@" + property_name[len("written@"):]).files
+            return str(sum([size for path,(size,version) in files.items() if prev_files.get(path, (0, None))[1] != version]))
+        elif property_name == "receive_resume_token":
+            return "-"
+        elif ':' in property_name:
+            properties = self.snapshot(name).properties if snapshot_name != '' else self.datasets[dataset].properties
+            return properties.get(property_name, "-")
+        else:
+            return "-"
+
+    def names(self, root, types, recursive, depth=None):
+        types = types.split(',')
+        names = list()
+        for dataset in self.datasets_of(root.split('@')[0]) if recursive else [root.split('@')[0]]:
+            dataset_depth = dataset.count('/') - root.count('/')
+            if depth != None and dataset_depth > depth:
+                continue
+            if '@' in root:
+                if dataset + "@" + root.split('@')[1] in self.all_snapshot_names(dataset):
+                    names.append(dataset + "@" + root.split('@')[1])
+                continue
+            if "filesystem" in types or "all" in types:
+                names.append(dataset)
+            if "snapshot" in types or "all" in types:
+                if depth == None or dataset_depth < depth or dataset == root:
+                    names += self.all_snapshot_names(dataset)
+        return names
+
+    def all_snapshot_names(self, dataset):
+        return [dataset + "@" + snapshot_name for snapshot_name in self.datasets[dataset].snapshots]
+
+    def list(self, root, types, properties, depth=None, sort=None):
+        with self.lock:
+            self.check_imported(root)
+            names = self.names(root, types, True, depth)
+            if sort == "creation":
+                names.sort(key=lambda name: int(self.property_value(name, "createtxg")))
+            return [[self.property_value(name, property_name) for property_name in properties] for name in names]
+
+    def get(self, name, properties, recursive=False, types=None):
+        with self.lock:
+            self.check_imported(name)
+            values = list()
+            for dataset_name in self.names(name, types if types != None else "all", recursive):
+                for property_name in properties:
+                    try:
+                        values.append((dataset_name, property_name, self.property_value(dataset_name, property_name)))
+                    except Exception:
+                        pass # for example written@ of a snapshot that does not exist on this dataset
+            if len(values) == 0:
+                raise Exception("cannot open '" + name + "': dataset does not exist")
+            return values
+
+    def set(self, name, property_name, value):
+        with self.lock:
+            self.check_imported(name)
+            dataset,_,snapshot_name = name.partition('@')
+            (self.snapshot(name).properties if snapshot_name != '' else self.datasets[dataset].properties)[property_name] = value
+
+    def exists(self, name):
+        with self.lock:
+            try:
+                self.check_imported(name)
+                if '@' in name:
+                    self.snapshot(name)
+                    return True
+                return name in self.datasets
+            except Exception:
+                return False
+
+    # The stream is JSON with the snapshots of all datasets, from the one
+    # after prev_snapshot (or the first) up to new_snapshot.
+    def stream(self, pool, new_snapshot, prev_snapshot):
+        with self.lock:
+            self.check_imported(pool)
+            self.snapshot(pool + "@" + new_snapshot)
+            if prev_snapshot != None:
+                self.snapshot(pool + "@" + prev_snapshot)
+
+            datasets = list()
+            for dataset in self.datasets_of(pool):
+                names = list(self.datasets[dataset].snapshots)
+                if new_snapshot not in names:
+                    continue
+                first = names.index(prev_snapshot) + 1 if prev_snapshot in names else 0
+                snapshots = [{"name": name, "guid": self.datasets[dataset].snapshots[name].guid, "files": self.datasets[dataset].snapshots[name].files,
+                              "properties": self.datasets[dataset].snapshots[name].properties} for name in names[first:names.index(new_snapshot) + 1]]
+                datasets.append({"name": dataset[len(pool):], "from": self.datasets[dataset].snapshots[prev_snapshot].guid if prev_snapshot in names else None, "snapshots": snapshots})
+
+            return json.dumps({"datasets": datasets}).encode("utf-8")
+
+    def send(self, pool, new_snapshot, prev_snapshot=None, flags="", **popen_arguments):
+        args = CLIBackend.send_arguments(self, pool, new_snapshot, prev_snapshot, flags)
+
+        def target(stdin, stdout, stderr):
+            stdout.write(self.stream(pool, new_snapshot, prev_snapshot))
+            return 0
+
+        return FakeProcess(args, target, **popen_arguments)
+
+    def send_resume(self, token, **popen_arguments):
+        def target(stdin, stdout, stderr):
+            raise Exception("cannot resume send: the sent snapshot no longer exists")
+
+        return FakeProcess(["zfs", "send", "-t", token], target, **popen_arguments)
+
+    def estimate_send_size(self, pool, new_snapshot, prev_snapshot=None, flags=""):
+        try:
+            return len(self.stream(pool, new_snapshot, prev_snapshot))
+        except Exception:
+            return None
+
+    def receive(self, target, stream):
+        with self.lock:
+            self.check_imported(target)
+
+            for dataset_stream in stream["datasets"]:
+                dataset = target + dataset_stream["name"]
+
+                if dataset not in self.datasets:
+                    if dataset_stream["from"] != None:
+                        raise Exception("cannot receive incremental stream: destination '" + dataset + "' does not exist")
+                    self.datasets[dataset] = FakeDataset()
+
+                snapshots = self.datasets[dataset].snapshots
+                if dataset_stream["from"] != None:
+                    # -F: roll back to the snapshot the stream starts from
+                    guids = [snapshot.guid for snapshot in snapshots.values()]
+                    if dataset_stream["from"] not in guids:
+                        raise Exception("cannot receive incremental stream: most recent snapshot of " + dataset + " does not match incremental source")
+                    names = list(snapshots)
+                    self.datasets[dataset].snapshots = {name: snapshots[name] for name in names[:guids.index(dataset_stream["from"]) + 1]}
+                elif len(snapshots) > 0:
+                    raise Exception("cannot receive new filesystem stream: destination has snapshots (eg. " + dataset + "@" + list(snapshots)[0] + ")")
+
+                for snapshot in dataset_stream["snapshots"]:
+                    self.txg += 1
+                    files = {path: tuple(value) for path,value in snapshot["files"].items()}
+                    self.datasets[dataset].snapshots[snapshot["name"]] = FakeSnapshot(snapshot["guid"], self.txg, files, dict(snapshot["properties"]))
+                    self.datasets[dataset].files = dict(files)
+
+    def recv(self, target, flags, **popen_arguments):
+        def receive_target(stdin, stdout, stderr):
+            self.receive(target, json.loads(stdin.read().decode("utf-8")))
+            return 0
+
+        return FakeProcess(["zfs", "recv"] + flags.split() + [target], receive_target, **popen_arguments)
+
+    def abort_receive(self, dataset):
+        pass # receives are never left partial
+
+    def diff(self, dataset, prev_snapshot, new_snapshot, **popen_arguments):
+        def target(stdin, stdout, stderr):
+            with self.lock:
+                prev_files = self.snapshot(dataset + "@" + prev_snapshot).files
+                new_files = self.snapshot(dataset + "@" + new_snapshot).files
+
+            mountpoint = "/" + dataset
+            for path in sorted(set(prev_files) | set(new_files)):
+                if path not in prev_files:
+                    difftype = "+"
+                elif path not in new_files:
+                    difftype = "-"
+                elif prev_files[path][1] != new_files[path][1]:
+                    difftype = "M"
+                else:
+                    continue
+                stdout.write(("%.9f\t%s\tF\t%s%s\n" % (time.time(), difftype, mountpoint, path)).encode("utf-8"))
+            return 0
+
+        return FakeProcess(["zfs", "diff", "-FHt", dataset + "@" + prev_snapshot, dataset + "@" + new_snapshot], target, **popen_arguments)
+
+    def create_pool(self, name, device):
+        with self.lock:
+            if name in self.pools:
+                raise Exception("cannot create '" + name + "': pool already exists")
+            self.add_pool(name)
+
+    def import_pool(self, name, device=None, read_cachefile=None, cachefile=None):
+        with self.lock:
+            if name not in self.pools or self.pools[name]["imported"]:
+                raise Exception("cannot import '" + name + "': no such pool available")
+            self.pools[name]["imported"] = True
+
+    def export_pool(self, name):
+        with self.lock:
+            if name not in self.pools or not self.pools[name]["imported"]:
+                raise Exception("cannot open '" + name + "': no such pool")
+            self.pools[name]["imported"] = False
+
+    def list_pools(self, properties):
+        with self.lock:
+            rows = list()
+            for name,pool in self.pools.items():
+                if not pool["imported"]:
+                    continue
+                allocated = sum([int(self.property_value(dataset, "referenced")) for dataset in self.datasets_of(name)])
+                values = {"name": name, "health": pool["health"], "size": str(pool["size"]), "allocated": str(allocated),
+                          "free": str(pool["size"] - allocated), "fragmentation": "0", "capacity": str(allocated * 100 // pool["size"])}
+                rows.append([values.get(property_name, "-") for property_name in properties])
+            return rows
+
+    def unhealthy_pools_status(self):
+        with self.lock:
+            unhealthy = [name for name,pool in self.pools.items() if pool["imported"] and pool["health"] != "ONLINE"]
+            if len(unhealthy) == 0:
+                return "all pools are healthy\n"
+            return "\n".join(["  pool: " + name + "\n state: " + self.pools[name]["health"] + "\n" for name in unhealthy])
+
+    def pool_status(self, name):
+        with self.lock:
+            if name not in self.pools or not self.pools[name]["imported"]:
+                raise Exception("cannot open '" + name + "': no such pool")
+            scrub = self.pools[name]["scrub"]
+            scan = "none requested" if scrub == None else "scrub repaired 0B in 00:00:00 with 0 errors on " + time.ctime(scrub)
+            return "  pool: " + name + "\n state: " + self.pools[name]["health"] + "\n  scan: " + scan + "\nerrors: No known data errors\n"
+
+    def pool_status_json(self, name):
+        with self.lock:
+            if name not in self.pools or not self.pools[name]["imported"]:
+                return None
+            scrub = self.pools[name]["scrub"]
+            allocated = int(self.list_pools(["name", "allocated"])[[row[0] for row in self.list_pools(["name"])].index(name)][1])
+            scan_stats = None if scrub == None else {"function": "SCRUB", "state": "FINISHED", "start_time": int(scrub), "end_time": int(scrub),
+                                                     "to_examine": allocated, "examined": allocated, "skipped": 0, "processed": 0, "errors": 0,
+                                                     "bytes_per_scan": 0, "pass_start": int(scrub), "scrub_pause": 0, "scrub_spent_paused": 0,
+                                                     "issued_bytes_per_scan": allocated, "issued": allocated}
+            return {"pools": {name: {"name": name, "state": self.pools[name]["health"], "scan_stats": scan_stats}}}
+
+    def start_scrub(self, name):
+        with self.lock:
+            if name not in self.pools or not self.pools[name]["imported"]:
+                return False
+            # the scrub finishes at once
+            self.pools[name]["scrub"] = time.time()
+            return True
+
+    def wait_scrub(self, name, timeout=None):
+        return True
+
+backend = None
+backend_lock = threading.Lock()
+
+# returns the backend selected by the setting "zfs-backend"
+def get_backend():
+    global backend
+
+    with backend_lock:
+        if backend == None:
+            settings = common.get_settings()
+            name = settings["zfs-backend"] if settings != None and "zfs-backend" in settings.keys() else "cli"
+
+            if name == "libzfs_core" and libzfs_core != None:
+                backend = LibZFSCoreBackend()
+            elif name == "libzfs_core":
+                print("pyzfs (libzfs_core) is not installed, using the zfs commands", flush=True)
+                backend = CLIBackend()
+            else:
+                backend = CLIBackend()
+
+        return backend
+
+# for using a backend set up in advance, for example a FakeBackend with pools
+def set_backend(new_backend):
+    global backend
+
+    with backend_lock:
+        backend = new_backend